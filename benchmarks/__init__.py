@@ -0,0 +1,15 @@
+"""
+Benchmarks for the AncestryDNA processing pipeline.
+
+Run a benchmark as a module from the repository root, e.g.:
+    python -m benchmarks.bench_vcf_conversion
+"""
+import os
+
+import django
+
+
+def setup_django():
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE',
+                          'oh_data_uploader.settings')
+    django.setup()
@@ -0,0 +1,79 @@
+"""
+Compare writers for the .vcf.bz2 output: the previous writer, which called
+BZ2File.write once per line, the single stream block writer and the block
+parallel writer with a range of worker counts.
+"""
+import argparse
+import bz2
+import os
+import random
+import tempfile
+import timeit
+
+from . import setup_django
+
+setup_django()
+
+from main.celery_helper import write_bz2  # noqa: E402
+
+
+def legacy_write_bz2(lines, filename):
+    with bz2.BZ2File(filename, 'w') as outfile:
+        for line in lines:
+            outfile.write(line.encode())
+
+
+def synthetic_vcf(snps, seed=0):
+    """
+    Return VCF body lines for random calls on ordered positions.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    for i in range(snps):
+        ref, allele1, allele2 = (rnd.choice('ACGT') for _ in range(3))
+        pos = str(1000 + i * 37)
+        if ref == allele1 == allele2:
+            fields = '.\t.\t.\tEND={}\tGT\t0/0'.format(pos)
+        else:
+            fields = '{}\t.\t.\t.\tGT\t0/1'.format(allele1)
+        lines.append('{}\t{}\trs{}\t{}\t{}\n'.format(
+            i * 22 // snps + 1, pos, rnd.randint(1, 10 ** 8), ref, fields))
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--snps', type=int, default=700000)
+    parser.add_argument('--block-size', type=int, default=4 * 1024 * 1024)
+    parser.add_argument('--workers', type=int, nargs='+',
+                        default=[1, 2, 4, 8])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines = synthetic_vcf(args.snps)
+    expected = ''.join(lines).encode()
+    print('{} lines, {} bytes, {} CPUs'.format(
+        len(lines), len(expected), os.cpu_count()))
+
+    with tempfile.TemporaryDirectory() as tmp_directory:
+        filename = os.path.join(tmp_directory, 'out.vcf.bz2')
+        writers = [('legacy', lambda: legacy_write_bz2(lines, filename))]
+        for workers in args.workers:
+            writers.append((
+                'blocks x{}'.format(workers),
+                lambda workers=workers: write_bz2(
+                    lines, filename, args.block_size, workers)))
+
+        results = {}
+        for name, func in writers:
+            best = min(timeit.repeat(func, number=1, repeat=args.repeat))
+            with bz2.open(filename) as f:
+                assert f.read() == expected
+            results[name] = best
+            print('  {:10} {:8.3f}s {:10d} bytes {:6.2f}x'.format(
+                name, best, os.path.getsize(filename),
+                results['legacy'] / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,260 @@
+"""
+Time the stages of AncestryDNA processing on synthetic full-array files:
+open_archive for each upload format, cleaning, VCF conversion (also
+sharded over processes), sort_vcf and process_file with the Open Humans
+API and S3 calls mocked, without and with a result cache hit.
+
+Results are written as JSON, pass an earlier result file with --compare
+to print the change per benchmark.
+"""
+import argparse
+import contextlib
+import json
+import os
+import platform
+import random
+import subprocess
+import tempfile
+import time
+import timeit
+from unittest import mock
+
+import requests_mock
+
+from . import setup_django
+
+setup_django()
+
+from main import celery  # noqa: E402
+from main.cache_helper import ResultCache  # noqa: E402
+from main.celery_helper import open_archive, sort_vcf  # noqa: E402
+from main.reference_helper import ReferenceIndex  # noqa: E402
+
+from .synthetic import FORMATS, compress, write_ancestrydna  # noqa: E402
+
+DOWNLOAD_URL = 'https://example.com/member-files/{}'
+UPLOAD_URL = 'https://example.com/uploads/'
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+            universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def best_time(func, repeat):
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def exhaust(lines):
+    for _ in lines:
+        pass
+
+
+class Suite(object):
+
+    def __init__(self, directory, snps, seed, repeat, upload_latency,
+                 convert_workers):
+        self.directory = directory
+        self.convert_workers = convert_workers
+        self.snps = snps
+        self.repeat = repeat
+        self.upload_latency = upload_latency
+        self.results = {}
+        self.files = {}
+        self.reference_path = os.path.join(directory, 'reference.txt')
+        for version in ('V1', 'V2'):
+            for sex in ('Male', 'Female'):
+                path = os.path.join(directory, 'AncestryDNA-{}-{}.txt'.format(
+                    version, sex))
+                write_ancestrydna(
+                    path, self.reference_path if not self.files else None,
+                    snps=snps, version=version, sex=sex, seed=seed)
+                self.files[(version, sex)] = path
+        self.reference = ReferenceIndex.from_text(self.reference_path)
+
+    def record(self, name, seconds, rows):
+        self.results[name] = {'seconds': seconds,
+                              'rows_per_second': rows / seconds}
+        print('  {:40} {:8.3f}s {:12.0f} rows/s'.format(
+            name, seconds, rows / seconds))
+
+    def bench_open_archive(self):
+        path = self.files[('V2', 'Male')]
+        for fmt in FORMATS:
+            archive = compress(path, fmt)
+
+            def read():
+                with open(archive, 'rb') as f:
+                    exhaust(open_archive(f))
+
+            self.record('open_archive.' + fmt, best_time(read, self.repeat),
+                        self.snps)
+
+    def clean(self, version, sex, columnar=False):
+        with open(self.files[(version, sex)], 'rb') as f:
+            if columnar:
+                return celery.clean_raw_ancestrydna_columnar(f)
+            return celery.clean_raw_ancestrydna(f)
+
+    def bench_clean(self):
+        for version, sex in sorted(self.files):
+            seconds = best_time(lambda: self.clean(version, sex), self.repeat)
+            self.record('clean_raw_ancestrydna.{}.{}'.format(version, sex),
+                        seconds, self.snps)
+        if celery.columnar_available():
+            seconds = best_time(lambda: self.clean('V2', 'Male', True),
+                                self.repeat)
+            self.record('clean_raw_ancestrydna_columnar.V2.Male', seconds,
+                        self.snps)
+
+    def bench_vcf(self):
+        for sex in ('Male', 'Female'):
+            clean, genome_sex = self.clean('V2', sex)
+            lines = clean.getvalue().splitlines(keepends=True)
+            assert genome_sex == sex
+            seconds = best_time(
+                lambda: exhaust(celery.vcf_from_raw_ancestrydna(
+                    lines, genome_sex)), self.repeat)
+            self.record('vcf_from_raw_ancestrydna.' + sex, seconds,
+                        self.snps)
+        self.vcf_lines = list(celery.vcf_from_raw_ancestrydna(lines, 'Male'))
+        if self.convert_workers > 1:
+            seconds = best_time(
+                lambda: exhaust(celery.vcf_body_sharded(
+                    lines, 'Male', self.reference, self.convert_workers)),
+                self.repeat)
+            self.record('vcf_body_sharded.{}_workers'.format(
+                self.convert_workers), seconds, self.snps)
+
+    def bench_sort_vcf(self):
+        ordered = self.vcf_lines
+        shuffled = list(ordered)
+        random.Random(0).shuffle(shuffled)
+        for name, lines in (('ordered', ordered), ('shuffled', shuffled)):
+            seconds = best_time(lambda: exhaust(sort_vcf(lines)), self.repeat)
+            self.record('sort_vcf.' + name, seconds, len(lines))
+
+    def mock_open_humans(self):
+        """
+        Mock the Open Humans calls of process_file, each upload taking
+        upload_latency seconds.
+        """
+        def upload(path, target):
+            time.sleep(self.upload_latency)
+            return {'bytes': os.path.getsize(path),
+                    'retries': 0, 'seconds': self.upload_latency,
+                    'bytes_per_second': 0}
+
+        stack = contextlib.ExitStack()
+        for patch in (mock.patch('main.upload_helper.start_direct_upload',
+                                 return_value={'url': UPLOAD_URL, 'id': 1}),
+                      mock.patch('main.upload_helper.complete_direct_upload'),
+                      mock.patch.object(celery.UPLOADER, 'upload', upload),
+                      mock.patch.object(celery.api, 'delete_file'),
+                      mock.patch.object(celery.api, 'message')):
+            stack.enter_context(patch)
+        return stack
+
+    def bench_process_file(self):
+        path = self.files[('V2', 'Male')]
+        for fmt in FORMATS:
+            archive = compress(path, fmt)
+            basename = os.path.basename(archive)
+            with open(archive, 'rb') as f:
+                content = f.read()
+            dfile = {'id': 1, 'basename': basename,
+                     'download_url': DOWNLOAD_URL.format(basename)}
+            with requests_mock.Mocker() as m, self.mock_open_humans():
+                m.get(dfile['download_url'], content=content)
+                seconds = best_time(
+                    lambda: celery.process_file(
+                        dfile, 'token', {'project_member_id': 1}, {}),
+                    self.repeat)
+            self.record('process_file.' + fmt, seconds, self.snps)
+
+    def bench_result_cache(self):
+        path = self.files[('V2', 'Male')]
+        with open(path, 'rb') as f:
+            content = f.read()
+        dfile = {'id': 1, 'basename': os.path.basename(path),
+                 'download_url': DOWNLOAD_URL.format('cached.txt')}
+        cache = ResultCache(os.path.join(self.directory, 'results'),
+                            1024 ** 3)
+        with requests_mock.Mocker() as m, \
+                mock.patch.object(celery, 'RESULT_CACHE', cache), \
+                self.mock_open_humans():
+            m.get(dfile['download_url'], content=content)
+            seconds = best_time(
+                lambda: celery.process_file(
+                    dfile, 'token', {'project_member_id': 1}, {}),
+                self.repeat + 1)
+        self.record('process_file.cached', seconds, self.snps)
+
+    def run(self):
+        with mock.patch.object(celery, 'get_ancestrydna_reference',
+                               return_value=self.reference), \
+                mock.patch.object(celery, 'RESULT_CACHE', None):
+            self.bench_open_archive()
+            self.bench_clean()
+            self.bench_vcf()
+            self.bench_sort_vcf()
+            self.bench_process_file()
+            self.bench_result_cache()
+        return self.results
+
+
+def compare(results, previous):
+    print('compared to {}:'.format(previous.get('commit')))
+    for name, result in sorted(results.items()):
+        old = previous['results'].get(name)
+        if old:
+            print('  {:40} {:8.3f}s -> {:8.3f}s {:+7.1f}%'.format(
+                name, old['seconds'], result['seconds'],
+                (result['seconds'] / old['seconds'] - 1) * 100))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--snps', type=int, default=700000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--upload-latency', type=float, default=0,
+                        help='seconds each mocked upload takes')
+    parser.add_argument('--convert-workers', type=int,
+                        default=os.cpu_count() or 1,
+                        help='processes for the sharded VCF conversion')
+    parser.add_argument('--output', default='benchmarks/results.json')
+    parser.add_argument('--compare', help='earlier JSON results')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        print('generating {} SNP files'.format(args.snps))
+        suite = Suite(directory, args.snps, args.seed, args.repeat,
+                      args.upload_latency, args.convert_workers)
+        results = suite.run()
+
+    output = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'cpu_count': os.cpu_count(),
+        'snps': args.snps,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'upload_latency': args.upload_latency,
+        'convert_workers': args.convert_workers,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(output, f, indent=2, sort_keys=True)
+    print('results written to {}'.format(args.output))
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+"""
+Compare the per-SNP cost of VCF conversion against the previous
+implementation, which built a dict, ran two regular expressions and
+indexed alleles with list.index for every line.
+"""
+import argparse
+import random
+import re
+import tempfile
+import timeit
+from unittest import mock
+
+from . import setup_django
+
+setup_django()
+
+from main import celery  # noqa: E402
+from main.reference_helper import ReferenceIndex  # noqa: E402
+from main.vcf_helper import CHROM_MAP, VCF_FIELDS  # noqa: E402
+
+
+def legacy_vcf_lines(raw_ancestrydna, genome_sex, reference):
+    """
+    VCF body conversion as it was before the genotype transcoding table.
+    """
+    for line in raw_ancestrydna:
+        data = line.rstrip().split('\t')
+        if not re.match(r'^[ACGT]$', data[3]):
+            continue
+        if not re.match(r'^[ACGT]$', data[4]):
+            continue
+        vcf_data = {x: '.' for x in VCF_FIELDS}
+        vcf_data['REF'] = reference.get(data[1], data[2])
+        if vcf_data['REF'] is None:
+            continue
+        vcf_data['CHROM'] = CHROM_MAP[data[1]]
+        if data[1] == '24' and genome_sex == 'Female':
+            continue
+        if data[1] in ['23', '24'] and genome_sex == 'Male':
+            alleles = data[3]
+        else:
+            alleles = data[3] + data[4]
+        vcf_data['POS'] = data[2]
+        if data[0].startswith('rs'):
+            vcf_data['ID'] = data[0]
+        alt_alleles = []
+        for alle in alleles:
+            if alle != vcf_data['REF'] and alle not in alt_alleles:
+                alt_alleles.append(alle)
+        if alt_alleles:
+            vcf_data['ALT'] = ','.join(alt_alleles)
+        else:
+            vcf_data['ALT'] = '.'
+            vcf_data['INFO'] = 'END=' + vcf_data['POS']
+        vcf_data['FORMAT'] = 'GT'
+        all_alleles = [vcf_data['REF']] + alt_alleles
+        vcf_data['ANCESTRYDNA_DATA'] = '/'.join(
+            [str(all_alleles.index(x)) for x in alleles])
+        yield '\t'.join([vcf_data[x] for x in VCF_FIELDS]) + '\n'
+
+
+class DictReference(object):
+    """
+    Reference with plain dict lookups, to time the transcoding on its own.
+    """
+
+    def __init__(self, index):
+        self._reference = index.to_dict()
+
+    def get(self, chromosome, position, default=None):
+        return self._reference.get(chromosome, {}).get(position, default)
+
+
+def synthetic_body(snps, seed=0):
+    """
+    Return (body lines, text reference lines) for random called SNPs.
+    """
+    rnd = random.Random(seed)
+    lines = []
+    reference = []
+    for i in range(snps):
+        chrom = str(rnd.randint(1, 24))
+        pos = i + 1
+        ref = rnd.choice('ACGT')
+        reference.append('{}\t{}\t{}\n'.format(chrom, pos, ref))
+        lines.append('rs{}\t{}\t{}\t{}\t{}\n'.format(
+            i, chrom, pos, rnd.choice('ACGT'), rnd.choice('ACGT')))
+    return lines, reference
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--snps', type=int, default=200000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    lines, reference_lines = synthetic_body(args.snps)
+    with tempfile.NamedTemporaryFile('w', suffix='.txt') as ref_file:
+        ref_file.writelines(reference_lines)
+        ref_file.flush()
+        reference = ReferenceIndex.from_text(ref_file.name)
+
+    for reference in (reference, DictReference(reference)):
+        print('reference: {}'.format(type(reference).__name__))
+        run(lines, reference, args.repeat)
+
+
+def run(lines, reference, repeat):
+    def legacy():
+        for _ in legacy_vcf_lines(lines, 'Male', reference):
+            pass
+
+    def table():
+        for _ in celery.vcf_from_raw_ancestrydna(lines, 'Male'):
+            pass
+
+    with mock.patch.object(celery, 'get_ancestrydna_reference',
+                           return_value=reference):
+        assert (list(legacy_vcf_lines(lines, 'Male', reference)) ==
+                list(celery.vcf_from_raw_ancestrydna(lines, 'Male'))[6:])
+        results = {}
+        for name, func in (('legacy', legacy), ('table', table)):
+            best = min(timeit.repeat(func, number=1, repeat=repeat))
+            results[name] = best
+            print('  {:8} {:8.3f}s {:8.2f}us/SNP'.format(
+                name, best, best / len(lines) * 1e6))
+    print('  speedup  {:8.2f}x'.format(results['legacy'] / results['table']))
+
+
+if __name__ == '__main__':
+    main()
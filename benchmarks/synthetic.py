@@ -0,0 +1,138 @@
+"""
+Deterministic generator of synthetic AncestryDNA raw data files.
+
+The files follow the V1 or V2 array exports: the download header, the
+notice for the array version, the column names and about 700,000 SNPs
+with CRLF line endings. SNPs are spread over the chromosomes roughly by
+length and include X, Y, pseudoautosomal (25) and mitochondrial (26)
+rows. Genotypes are drawn against a matching synthetic reference, with a
+realistic share of no-calls and the sex specific X/Y patterns that the
+sex inference looks at.
+"""
+import bz2
+import gzip
+import os
+import random
+import shutil
+import zipfile
+
+from main.vcf_helper import HEADER_V1, HEADER_V2
+
+HEADERS = {'V1': HEADER_V1, 'V2': HEADER_V2}
+
+FORMATS = ('txt', 'zip', 'gz', 'bz2')
+
+# Approximate chromosome lengths in Mb, AncestryDNA chromosome codes.
+CHROMOSOME_LENGTHS = {
+    '1': 249, '2': 243, '3': 198, '4': 191, '5': 181, '6': 171, '7': 159,
+    '8': 146, '9': 141, '10': 136, '11': 135, '12': 134, '13': 115,
+    '14': 107, '15': 103, '16': 90, '17': 81, '18': 78, '19': 59, '20': 63,
+    '21': 48, '22': 51, '23': 155, '24': 57, '25': 3, '26': 0.017,
+}
+
+# Share of SNPs on the sex chromosomes, PAR and MT, the rest is autosomal.
+CHROMOSOME_SHARES = {'23': 0.025, '24': 0.0012, '25': 0.001, '26': 0.0003}
+
+# The VCF conversion has no name for chromosome 26 (MT), so it is left out
+# of the reference, as MT rows are never converted.
+UNREFERENCED = ('26',)
+
+
+def chromosome_counts(snps):
+    """
+    Split a number of SNPs over the chromosomes.
+    """
+    counts = {chrom: int(snps * share)
+              for chrom, share in CHROMOSOME_SHARES.items()}
+    autosomes = [str(i) for i in range(1, 23)]
+    total = sum(CHROMOSOME_LENGTHS[chrom] for chrom in autosomes)
+    remaining = snps - sum(counts.values())
+    for chrom in autosomes:
+        counts[chrom] = int(remaining * CHROMOSOME_LENGTHS[chrom] / total)
+    counts['1'] += snps - sum(counts.values())
+    return counts
+
+
+def genotype(rnd, ref, chrom, sex, no_call_rate):
+    """
+    Draw two alleles for a SNP with reference base ref.
+    """
+    if rnd.random() < no_call_rate or (chrom == '24' and sex == 'Female'):
+        return '0', '0'
+    if rnd.random() < 0.002:
+        return rnd.choice('DI'), rnd.choice('DI')
+    alt = rnd.choice([base for base in 'ACGT' if base != ref])
+    allele1 = ref if rnd.random() < 0.7 else alt
+    if chrom in ('23', '24') and sex == 'Male' and rnd.random() < 0.99:
+        # Haploid calls are reported twice.
+        return allele1, allele1
+    allele2 = ref if rnd.random() < 0.7 else alt
+    return allele1, allele2
+
+
+def snp_id(rnd):
+    if rnd.random() < 0.03:
+        return 'VGXS{}'.format(rnd.randint(1, 10 ** 6))
+    return 'rs{}'.format(rnd.randint(1, 10 ** 9))
+
+
+def write_ancestrydna(path, reference_path=None, snps=700000, version='V2',
+                      sex='Male', seed=0, no_call_rate=0.015):
+    """
+    Write a synthetic AncestryDNA file, and optionally the matching text
+    reference. The same arguments always produce the same files. SNP sites
+    only depend on seed and snps, so files of either version and sex share
+    one reference.
+    """
+    sites = random.Random('{}-{}'.format(seed, snps))
+    calls = random.Random('{}-{}-{}-{}'.format(seed, snps, version, sex))
+    reference = open(reference_path, 'w') if reference_path else None
+    try:
+        with open(path, 'w', newline='') as f:
+            f.write('#AncestryDNA raw data download\r\n')
+            f.write('#This file was generated by AncestryDNA at: '
+                    '09/25/2017 09:32:22 MDT\r\n')
+            f.write('#Data was collected using AncestryDNA array version: '
+                    '{}.0\r\n'.format(version))
+            f.write('#Data is formatted using AncestryDNA converter '
+                    'version: V1.0\r\n')
+            for line in HEADERS[version]:
+                f.write(line + '\r\n')
+            f.write('rsid\tchromosome\tposition\tallele1\tallele2\r\n')
+            counts = chromosome_counts(snps)
+            for chrom in sorted(counts, key=int):
+                length = int(CHROMOSOME_LENGTHS[chrom] * 10 ** 6)
+                positions = sorted(sites.sample(range(1, length),
+                                                counts[chrom]))
+                for position in positions:
+                    ref = sites.choice('ACGT')
+                    rsid = snp_id(sites)
+                    if reference and chrom not in UNREFERENCED:
+                        reference.write('{}\t{}\t{}\n'.format(
+                            chrom, position, ref))
+                    allele1, allele2 = genotype(calls, ref, chrom, sex,
+                                                no_call_rate)
+                    f.write('{}\t{}\t{}\t{}\t{}\r\n'.format(
+                        rsid, chrom, position, allele1, allele2))
+    finally:
+        if reference:
+            reference.close()
+    return path
+
+
+def compress(path, fmt):
+    """
+    Store a .txt file the way it is uploaded in format fmt, returns the
+    path of the new file.
+    """
+    if fmt == 'txt':
+        return path
+    if fmt == 'zip':
+        zip_path = os.path.splitext(path)[0] + '.zip'
+        with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as f:
+            f.write(path, os.path.basename(path))
+        return zip_path
+    opener = {'gz': gzip.open, 'bz2': bz2.open}[fmt]
+    with open(path, 'rb') as f, opener(path + '.' + fmt, 'wb') as out:
+        shutil.copyfileobj(f, out)
+    return path + '.' + fmt
@@ -0,0 +1,216 @@
+"""
+Asyncio client for the Open Humans API, used by the async views.
+
+Each event loop gets one httpx.AsyncClient, which keeps connections to
+Open Humans and file storage alive. It uses the pool size, retries and
+timeouts of the sync session in main.http_helper. Needs httpx.
+
+Metrics and file reads may block, on Redis or the disk, so they run on
+threads rather than on the event loop.
+"""
+import asyncio
+import contextlib
+import json
+import time
+import weakref
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+from .metrics import OH_API_SECONDS
+
+OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
+OH_TOKEN_URL = OH_BASE_URL + '/oauth2/token/'
+OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
+OH_EXCHANGE_MEMBER = OH_API_BASE + '/project/exchange-member/'
+OH_DELETE_FILES = OH_API_BASE + '/project/files/delete/'
+OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
+OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+# Like the sync session, requests that may have had an effect are sent
+# once.
+REPEATABLE_METHODS = ('GET', 'HEAD', 'OPTIONS', 'DELETE')
+
+_clients = weakref.WeakKeyDictionary()
+
+
+def async_available():
+    return httpx is not None
+
+
+def build_client(pool_size, max_connections, retries, timeout):
+    """
+    Return a client keeping up to pool_size connections alive, opening at
+    most max_connections at a time. Failed connections are retried.
+    """
+    limits = httpx.Limits(max_connections=max_connections,
+                          max_keepalive_connections=pool_size)
+    transport = httpx.AsyncHTTPTransport(limits=limits, retries=retries)
+    return httpx.AsyncClient(transport=transport,
+                             timeout=httpx.Timeout(timeout[1],
+                                                   connect=timeout[0]))
+
+
+def client():
+    """
+    Return the client of the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        return _clients[loop]
+    except KeyError:
+        _clients[loop] = build_client(
+            settings.OH_HTTP_POOL_SIZE, settings.OH_ASYNC_HTTP_MAX_CONNECTIONS,
+            settings.OH_HTTP_RETRIES,
+            (settings.OH_HTTP_CONNECT_TIMEOUT, settings.OH_HTTP_READ_TIMEOUT))
+        return _clients[loop]
+
+
+@contextlib.asynccontextmanager
+async def timed(endpoint):
+    """
+    Time a block in OH_API_SECONDS like OH_API_SECONDS.time, recording it
+    on a thread.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        await sync_to_async(OH_API_SECONDS.observe, thread_sensitive=False)(
+            time.perf_counter() - start, endpoint=endpoint)
+
+
+async def request(method, url, **kwargs):
+    """
+    Send a request, retrying 429 and 5xx responses with exponential
+    backoff if the method is safe to repeat.
+    """
+    retries = (settings.OH_HTTP_RETRIES if method in REPEATABLE_METHODS
+               else 0)
+    for attempt in range(retries + 1):
+        response = await client().request(method, url, **kwargs)
+        if response.status_code not in RETRY_STATUSES or attempt == retries:
+            return response
+        await asyncio.sleep(settings.OH_HTTP_BACKOFF * 2 ** attempt)
+
+
+def check_status(response, expected_code):
+    """
+    Raise the error ohapi raises for an unexpected status code.
+    """
+    if response.status_code != expected_code:
+        raise Exception('API response status code {}:\n{}'.format(
+            response.status_code, response.content))
+
+
+async def oauth2_token_exchange(client_id, client_secret, redirect_uri,
+                                code):
+    async with timed('oauth2_token_exchange'):
+        response = await request(
+            'POST', OH_TOKEN_URL,
+            data={'grant_type': 'authorization_code',
+                  'redirect_uri': redirect_uri,
+                  'code': code},
+            auth=(client_id, client_secret))
+    check_status(response, 200)
+    return response.json()
+
+
+async def refresh_tokens(client_id, client_secret, refresh_token):
+    """
+    Exchange a refresh token for new tokens, returns the response.
+    """
+    async with timed('oauth2_token'):
+        return await request(
+            'POST', OH_TOKEN_URL,
+            data={'grant_type': 'refresh_token',
+                  'refresh_token': refresh_token},
+            auth=(client_id, client_secret))
+
+
+async def exchange_oauth2_member(access_token):
+    """
+    Return the data of a member, including all their files.
+    """
+    async with timed('exchange_oauth2_member'):
+        response = await request('GET', OH_EXCHANGE_MEMBER,
+                                 params={'access_token': access_token})
+        check_status(response, 200)
+        member_data = response.json()
+        returned = member_data.copy()
+        while member_data.get('next'):
+            response = await request('GET', member_data['next'])
+            check_status(response, 200)
+            member_data = response.json()
+            returned['data'] = returned['data'] + member_data['data']
+    return returned
+
+
+async def delete_files(access_token, project_member_id, file_id=None,
+                       all_files=False):
+    """
+    Delete one file of a member by its ID, or all of them.
+    """
+    if bool(file_id) == bool(all_files):
+        raise ValueError('One (and only one) of file_id or all_files '
+                         'must be specified.')
+    data = {'project_member_id': project_member_id}
+    if file_id:
+        data['file_id'] = file_id
+    else:
+        data['all_files'] = True
+    async with timed('delete_files'):
+        response = await request('POST', OH_DELETE_FILES, data=data,
+                                 params={'access_token': access_token})
+    check_status(response, 200)
+    return response
+
+
+async def _file_chunks(filehandle):
+    """
+    Yield the chunks of an UploadedFile, reading them on a thread.
+    """
+    chunks = iter(filehandle.chunks())
+    read = sync_to_async(next, thread_sensitive=False)
+    while True:
+        chunk = await read(chunks, None)
+        if chunk is None:
+            return
+        yield chunk
+
+
+async def upload_file(access_token, project_member_id, filehandle, metadata):
+    """
+    Upload a Django UploadedFile with the direct upload process, streaming
+    it to the storage target. Returns the Open Humans ID of the file.
+    """
+    params = {'access_token': access_token}
+    async with timed('upload_direct'):
+        response = await request(
+            'POST', OH_DIRECT_UPLOAD, params=params,
+            data={'project_member_id': project_member_id,
+                  'filename': filehandle.name,
+                  'metadata': json.dumps(metadata)})
+    check_status(response, 201)
+    target = response.json()
+
+    # Storage needs the length up front, the stream can't be sent again.
+    async with timed('upload_s3'):
+        response = await client().put(
+            target['url'], content=_file_chunks(filehandle),
+            headers={'Content-Length': str(filehandle.size)})
+    check_status(response, 200)
+
+    async with timed('upload_complete'):
+        response = await request(
+            'POST', OH_DIRECT_UPLOAD_COMPLETE, params=params,
+            data={'project_member_id': project_member_id,
+                  'file_id': target['id']})
+    check_status(response, 200)
+    return int(target['id'])
@@ -0,0 +1,159 @@
+"""
+Async versions of the views that call the Open Humans API, served by the
+ASGI application (see ASYNC_VIEWS). Requests to Open Humans go through the
+asyncio client, so a slow API doesn't hold up other requests to the same
+worker. Database access and rendering run in threads.
+"""
+import json
+import logging
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth import login
+from django.shortcuts import redirect, render
+
+from project_admin.models import ProjectConfiguration, FileMetaData
+from . import async_helper
+from .celery import clean_uploaded_file
+from .helpers import save_member, OH_OAUTH2_REDIRECT_URI
+from .member_helper import (aget_member_data, cache_member_data,
+                            invalidate_member_data)
+from .models import ProcessedFile
+from .views import file_upload_prep_context, overview_context
+
+logger = logging.getLogger(__name__)
+
+arender = sync_to_async(render)
+aget_config = sync_to_async(ProjectConfiguration.get_cached)
+
+
+@sync_to_async
+def get_member(request):
+    """
+    Return the OpenHumansMember of the logged in user, None if the user is
+    anonymous or the admin.
+    """
+    if request.user.is_authenticated and request.user.username != 'admin':
+        return request.user.openhumansmember
+    return None
+
+
+async def delete_file(request, file_id):
+    """
+    Delete specified file in Open Humans for this project member.
+    """
+    oh_member = await get_member(request)
+    if oh_member is None:
+        return redirect('index')
+    proj_config = await aget_config()
+    access_token = await oh_member.aget_access_token(
+        **proj_config.client_info)
+    await async_helper.delete_files(access_token, oh_member.oh_id,
+                                    file_id=file_id)
+    await sync_to_async(invalidate_member_data)(oh_member.oh_id)
+    return redirect('list')
+
+
+async def upload_file_to_oh(oh_member, filehandle, metadata):
+    """
+    Upload a file with the Open Humans direct upload process and queue it
+    for processing, like main.views.upload_file_to_oh.
+    """
+    proj_config = await aget_config()
+    access_token = await oh_member.aget_access_token(
+        **proj_config.client_info)
+    file_id = await async_helper.upload_file(access_token, oh_member.oh_id,
+                                             filehandle, metadata)
+    await sync_to_async(invalidate_member_data)(oh_member.oh_id)
+    await sync_to_async(ProcessedFile.objects.mark_queued)(
+        oh_member.oh_id, file_id, str(filehandle.name))
+    await sync_to_async(clean_uploaded_file.delay)(access_token, file_id)
+
+
+async def iterate_files_upload(request, oh_member):
+    """
+    iterate over all files to upload them to OH.
+    """
+    uploaded_files = await sync_to_async(lambda: request.FILES)()
+    for file in await sync_to_async(FileMetaData.get_cached)():
+        uploaded_file = uploaded_files.get('file_{}'.format(file.id))
+        if uploaded_file is not None:
+            metadata = {'tags': json.loads(file.tags),
+                        'description': file.description}
+            await upload_file_to_oh(oh_member, uploaded_file, metadata)
+
+
+async def login_member(request, proj_config):
+    """
+    Exchange the code for tokens and log in the member.
+    """
+    code = request.GET.get('code', '')
+    if not (proj_config.oh_client_secret and
+            proj_config.oh_client_id and code):
+        logger.error('OH_CLIENT_SECRET or code are unavailable')
+        return
+    data = await async_helper.oauth2_token_exchange(
+        client_id=proj_config.oh_client_id,
+        client_secret=proj_config.oh_client_secret,
+        redirect_uri=OH_OAUTH2_REDIRECT_URI,
+        code=code)
+    if 'access_token' not in data:
+        logger.error('Error in token exchange: {}'.format(data))
+        return
+    member = await async_helper.exchange_oauth2_member(data['access_token'])
+    await sync_to_async(cache_member_data)(member['project_member_id'],
+                                           member)
+    oh_member = await sync_to_async(save_member)(
+        member['project_member_id'], data)
+    await sync_to_async(login)(
+        request, oh_member.user,
+        backend='django.contrib.auth.backends.ModelBackend')
+
+
+async def complete(request):
+    """
+    Receive user from Open Humans. Store data, start data upload task.
+    """
+    logger.debug("Received user returning from Open Humans.")
+
+    proj_config = await aget_config()
+
+    if request.method == 'GET':
+        await login_member(request, proj_config)
+        oh_member = await get_member(request)
+        if oh_member is None:
+            logger.debug('Invalid code exchange. User returned to start page.')
+            return redirect('/')
+        context = await sync_to_async(file_upload_prep_context)(
+            oh_member, proj_config)
+        return await arender(request, 'main/complete.html',
+                             context=context)
+
+    elif request.method == 'POST':
+        oh_member = await get_member(request)
+        if oh_member is not None:
+            await iterate_files_upload(request, oh_member)
+        return redirect('index')
+
+
+async def overview(request):
+    oh_member = await get_member(request)
+    if oh_member is None:
+        return redirect('index')
+    proj_config = await aget_config()
+    access_token = await oh_member.aget_access_token(
+        **proj_config.client_info)
+    context = await sync_to_async(overview_context)(
+        oh_member, proj_config, access_token)
+    return await arender(request, 'main/overview.html', context=context)
+
+
+async def list_files(request):
+    oh_member = await get_member(request)
+    if oh_member is None:
+        return redirect('index')
+    proj_config = await aget_config()
+    access_token = await oh_member.aget_access_token(
+        **proj_config.client_info)
+    data = await aget_member_data(oh_member.oh_id, access_token)
+    return await arender(request, 'main/list.html',
+                         context={'files': data['data']})
@@ -0,0 +1,141 @@
+"""
+Content-addressed store of processed files on local disk.
+
+Entries are directories named by a key, holding the processed files under
+the names they are uploaded with. Aliases map further keys to an entry.
+The least recently used entries are removed when the store grows beyond
+its size budget. Several worker processes can share a store: entries are
+written to a temporary directory and renamed into place.
+"""
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+
+logger = logging.getLogger(__name__)
+
+ALIAS_SUFFIX = '.alias'
+
+
+def _link_or_copy(source, target):
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copyfile(source, target)
+
+
+class ResultCache(object):
+    """
+    Processed files keyed by the hash of their input and the versions of
+    everything that produced them.
+    """
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    @staticmethod
+    def key(*parts):
+        return hashlib.sha256(
+            '\0'.join(str(part) for part in parts).encode()).hexdigest()
+
+    def _entry(self, key):
+        """
+        Return the directory of an entry, following an alias, or None.
+        """
+        entry = os.path.join(self.directory, key)
+        if os.path.isdir(entry):
+            return entry
+        try:
+            with open(entry + ALIAS_SUFFIX) as f:
+                entry = os.path.join(self.directory, f.read().strip())
+        except OSError:
+            return None
+        return entry if os.path.isdir(entry) else None
+
+    def fetch(self, key, directory, names=None):
+        """
+        Link the files of an entry, or only those with the given names,
+        into directory. Returns their paths or None if there is no entry.
+        """
+        entry = self._entry(key)
+        if entry is None:
+            return None
+        try:
+            filenames = []
+            for name in names or sorted(os.listdir(entry)):
+                filenames.append(os.path.join(directory, name))
+                _link_or_copy(os.path.join(entry, name), filenames[-1])
+            # The entry's mtime orders eviction.
+            os.utime(entry)
+        except OSError:
+            # Evicted by another process while linking. Links are removed,
+            # so writing to those paths can't change another entry.
+            for filename in filenames:
+                try:
+                    os.unlink(filename)
+                except OSError:
+                    pass
+            return None
+        return filenames
+
+    def store(self, key, filenames, aliases=()):
+        """
+        Add files under key, unless another process already did, and
+        point the aliases at it.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        tmp_entry = tempfile.mkdtemp(dir=self.directory, prefix='.tmp-')
+        try:
+            for filename in filenames:
+                _link_or_copy(filename, os.path.join(
+                    tmp_entry, os.path.basename(filename)))
+            os.rename(tmp_entry, os.path.join(self.directory, key))
+        except OSError:
+            shutil.rmtree(tmp_entry, ignore_errors=True)
+        for alias in aliases:
+            self.alias(alias, key)
+        self.evict()
+
+    def alias(self, alias, key):
+        fd, tmp_name = tempfile.mkstemp(dir=self.directory, prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            f.write(key)
+        os.replace(tmp_name, os.path.join(self.directory,
+                                          alias + ALIAS_SUFFIX))
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the store fits its
+        size budget, and aliases of removed entries.
+        """
+        entries = []
+        aliases = []
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(ALIAS_SUFFIX):
+                aliases.append(path)
+                continue
+            if name.startswith('.') or not os.path.isdir(path):
+                continue
+            try:
+                size = sum(os.path.getsize(os.path.join(path, f))
+                           for f in os.listdir(path))
+                entries.append((os.path.getmtime(path), size, path))
+            except OSError:
+                continue
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            logger.info('Evicting cached result %s', path)
+            shutil.rmtree(path, ignore_errors=True)
+            total -= size
+        for path in aliases:
+            if self._entry(os.path.basename(path)[:-len(ALIAS_SUFFIX)]) \
+                    is None:
+                try:
+                    os.unlink(path)
+                except OSError:
+                    pass
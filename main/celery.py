@@ -1,22 +1,37 @@
 from django.conf import settings
 import os
-from celery import Celery
+import bz2
+import concurrent.futures
+import itertools
+import multiprocessing
+import shutil
+from celery import Celery, chain
+from celery.signals import worker_init
 import tempfile
 import json
-from ohapi import api
-import requests
 
-import bz2
 import logging
 import re
-import shutil
 
 from io import StringIO
 from datetime import datetime
 
 import arrow
-from .celery_helper import vcf_header, temp_join, open_archive, sort_vcf
-from .vcf_helper import HEADER_V1, HEADER_V2, HEADER_V3, CHROM_MAP
+from .celery_helper import (vcf_header, temp_join, open_archive, split_vcf,
+                            write_bz2, download_file, Download, StageTimer,
+                            VcfShards)
+from .metrics import (OH_API_SECONDS, RESULT_CACHE_LOOKUPS, STAGE_SECONDS,
+                      TASKS)
+from .columnar_helper import (columnar_available, clean_body,
+                              vcf_body_from_columns)
+from .cache_helper import ResultCache
+from .http_helper import ohapi_api as api
+from .member_helper import invalidate_member_data
+from .transfer_helper import PresignedTarget, Uploader
+from .reference_helper import (ReferenceIndex, file_digest, get_reference,
+                               get_reference_digest)
+from .vcf_helper import (HEADER_V1, HEADER_V2, HEADER_V3, CHROM_MAP, BASES,
+                         GENOTYPE_TABLE, genotype_vcf_fields)
 
 # set the default Django settings module for the 'celery' program.
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'oh_data_uploader.settings')
@@ -25,6 +40,63 @@ OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 
 REF_ANCESTRYDNA_FILE = os.path.join(
     os.path.dirname(__file__), 'references/reference_b37.txt')
+REF_ANCESTRYDNA_INDEX = os.path.join(
+    os.path.dirname(__file__), 'references/reference_b37.idx')
+
+# Recorded with each processed file. Increase when the output changes.
+CONVERTER_VERSION = '1'
+
+# Local store of processed files, to skip processing re-uploads. Least
+# recently used results are removed beyond the size budget in bytes.
+RESULT_CACHE = None
+if settings.ANCESTRYDNA_RESULT_CACHE_DIR:
+    RESULT_CACHE = ResultCache(settings.ANCESTRYDNA_RESULT_CACHE_DIR,
+                               settings.ANCESTRYDNA_RESULT_CACHE_MAX_SIZE)
+
+# Buffer size in bytes for reading and writing files while processing.
+STREAM_BUFFER_SIZE = settings.ANCESTRYDNA_STREAM_BUFFER_SIZE
+
+# Block size and threads for compressing the VCF output.
+COMPRESS_BLOCK_SIZE = settings.ANCESTRYDNA_COMPRESS_BLOCK_SIZE
+COMPRESS_WORKERS = settings.ANCESTRYDNA_COMPRESS_WORKERS
+
+# Record wall and CPU time, bytes and lines of the processing stages.
+STAGE_TIMING = settings.ANCESTRYDNA_STAGE_TIMING
+
+# Threads uploading the processed files, so uploads overlap conversion.
+UPLOAD_WORKERS = settings.ANCESTRYDNA_UPLOAD_WORKERS
+
+# Uploads the processed files to their storage target.
+UPLOADER = Uploader(settings.ANCESTRYDNA_UPLOAD_RETRIES,
+                    settings.OH_HTTP_BACKOFF)
+
+# Processes converting the clean file to VCF, one chromosome at a time.
+# Files smaller than CONVERT_SHARD_MIN_SIZE bytes are converted in-process.
+CONVERT_WORKERS = settings.ANCESTRYDNA_CONVERT_WORKERS
+CONVERT_SHARD_MIN_SIZE = settings.ANCESTRYDNA_CONVERT_SHARD_MIN_SIZE
+
+# Run download, conversion and upload as separate tasks: conversion on the
+# CPU queue, download and uploads on the I/O queue, so I/O workers can run
+# many threads. The tasks pass files through SCRATCH_DIR, which has to be
+# storage shared by all workers, so processing is only split with it set.
+SCRATCH_DIR = settings.ANCESTRYDNA_SCRATCH_DIR
+SPLIT_TASKS = settings.ANCESTRYDNA_SPLIT_TASKS and bool(SCRATCH_DIR)
+CPU_QUEUE = settings.ANCESTRYDNA_CPU_QUEUE
+IO_QUEUE = settings.ANCESTRYDNA_IO_QUEUE
+
+# Limits for downloading the uploaded file.
+DOWNLOAD_CHUNK_SIZE = settings.ANCESTRYDNA_DOWNLOAD_CHUNK_SIZE
+DOWNLOAD_MAX_SIZE = settings.ANCESTRYDNA_DOWNLOAD_MAX_SIZE
+DOWNLOAD_TIMEOUT = (settings.ANCESTRYDNA_DOWNLOAD_CONNECT_TIMEOUT,
+                    settings.ANCESTRYDNA_DOWNLOAD_READ_TIMEOUT)
+
+# Parse the file body into NumPy columns instead of line by line. Meant for
+# bulk reprocessing, requires numpy.
+COLUMNAR_PARSER = settings.ANCESTRYDNA_COLUMNAR_PARSER
+if COLUMNAR_PARSER and not columnar_available():
+    logging.getLogger(__name__).warning(
+        'ANCESTRYDNA_COLUMNAR_PARSER is set but numpy is not installed.')
+    COLUMNAR_PARSER = False
 
 # Was used to generate reference genotypes in the previous file.
 REFERENCE_GENOME_URL = ('http://hgdownload-test.cse.ucsc.edu/' +
@@ -37,6 +109,12 @@ VCF_FIELDS = ['CHROM', 'POS', 'ID', 'REF', 'ALT', 'QUAL', 'FILTER',
 # The only non-commented-out header line. We want to ignore it.
 EXPECTED_COLUMNS_HEADER = 'rsid\tchromosome\tposition\tallele1\tallele2'
 
+# Body lines of the AncestryDNA file, and the subsets on the Y chromosome.
+LINE_RE = re.compile(
+    r'(rs|VGXS)[0-9]+\t[1-9][0-9]?\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
+REPORTED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
+CALLED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI]\t[ACGTDI]')
+
 logger = logging.getLogger(__name__)
 
 app = Celery('proj')
@@ -68,6 +146,23 @@ def read_reference(ref_file):
     return reference
 
 
+def get_ancestrydna_reference():
+    return get_reference(REF_ANCESTRYDNA_FILE, REF_ANCESTRYDNA_INDEX)
+
+
+@worker_init.connect
+def preload_reference(**kwargs):
+    """
+    Load the reference when the worker boots, before the pool forks, so
+    its child processes share the already mapped index.
+    """
+    try:
+        get_ancestrydna_reference()
+    except OSError:
+        logger.warning('Reference %s not available at worker boot.',
+                       REF_ANCESTRYDNA_FILE)
+
+
 def check_header_lines(input_lines, header_lines, header_name):
     if not len(input_lines) == len(header_lines):
         if header_name:
@@ -81,17 +176,44 @@ def check_header_lines(input_lines, header_lines, header_name):
     return all(matched_lines)
 
 
-def vcf_from_raw_ancestrydna(raw_ancestrydna, genome_sex):
-    output = StringIO()
-
-    reference = read_reference(REF_ANCESTRYDNA_FILE)
-
+def vcf_ancestrydna_header():
     header = vcf_header(
         source='open_humans_data_importer.ancestry_dna',
         reference=REFERENCE_GENOME_URL,
         format_info=['<ID=GT,Number=1,Type=String,Description="Genotype">'])
-    for line in header:
-        output.write(line + '\n')
+    return [line + '\n' for line in header]
+
+
+def vcf_from_raw_ancestrydna(raw_ancestrydna, genome_sex):
+    """
+    Convert cleaned AncestryDNA lines to VCF, yielding one line at a time.
+    """
+    reference = get_ancestrydna_reference()
+    for line in vcf_ancestrydna_header():
+        yield line
+    for line in vcf_body_from_raw_ancestrydna(raw_ancestrydna, genome_sex,
+                                              reference):
+        yield line
+
+
+def vcf_from_ancestrydna_columns(body, genome_sex):
+    """
+    Convert an AncestryDNABody from clean_raw_ancestrydna_columnar to VCF.
+    The body lines are grouped by chromosome rather than in input order,
+    pass them through sort_vcf.
+    """
+    reference = get_ancestrydna_reference()
+    for line in vcf_ancestrydna_header():
+        yield line
+    for line in vcf_body_from_columns(body, genome_sex, reference):
+        yield line
+    for line in vcf_body_from_raw_ancestrydna(body.extra_lines, genome_sex,
+                                              reference):
+        yield line
+
+
+def vcf_body_from_raw_ancestrydna(raw_ancestrydna, genome_sex, reference):
+    haploid_chroms = ('23', '24') if genome_sex == 'Male' else ()
     for line in raw_ancestrydna:
         # Skip header
         if line.startswith('#'):
@@ -102,63 +224,94 @@ def vcf_from_raw_ancestrydna(raw_ancestrydna, genome_sex):
         data = line.rstrip().split('\t')
 
         # Skip uncalled and genotyping without explicit base calls
-        if not re.match(r'^[ACGT]$', data[3]):
-            continue
-        if not re.match(r'^[ACGT]$', data[4]):
+        if data[3] not in BASES or data[4] not in BASES:
             continue
-        vcf_data = {x: '.' for x in VCF_FIELDS}
 
         # Chromosome. Determine correct reporting according to genome_sex.
-        try:
-            vcf_data['REF'] = reference[data[1]][data[2]]
-        except KeyError:
+        # Skip if we don't have ref.
+        ref = reference.get(data[1], data[2])
+        if ref is None:
             continue
-        vcf_data['CHROM'] = CHROM_MAP[data[1]]
+        chrom = CHROM_MAP[data[1]]
         if data[1] == '24' and genome_sex == 'Female':
             continue
-        if data[1] in ['23', '24'] and genome_sex == 'Male':
-            alleles = data[3]
-        else:
-            alleles = data[3] + data[4]
-
-        # Position, dbSNP ID, reference. Skip if we don't have ref.
-        vcf_data['POS'] = data[2]
-        if data[0].startswith('rs'):
-            vcf_data['ID'] = data[0]
-
-        # Figure out the alternate alleles.
-        alt_alleles = []
-        for alle in alleles:
-            if alle != vcf_data['REF'] and alle not in alt_alleles:
-                alt_alleles.append(alle)
-        if alt_alleles:
-            vcf_data['ALT'] = ','.join(alt_alleles)
-        else:
-            vcf_data['ALT'] = '.'
-            vcf_data['INFO'] = 'END=' + vcf_data['POS']
 
-        # Get allele-indexed genotype.
-        vcf_data['FORMAT'] = 'GT'
-        all_alleles = [vcf_data['REF']] + alt_alleles
-        genotype_indexed = '/'.join([str(all_alleles.index(x))
-                                     for x in alleles])
-        vcf_data['ANCESTRYDNA_DATA'] = genotype_indexed
-        output_line = '\t'.join([vcf_data[x] for x in VCF_FIELDS])
-        output.write(output_line + '\n')
+        # Alternate alleles, INFO and allele-indexed genotype.
+        genotype = (ref, data[3], data[4], data[1] in haploid_chroms)
+        try:
+            fields, info_end, genotype_fields = GENOTYPE_TABLE[genotype]
+        except KeyError:
+            fields, info_end, genotype_fields = GENOTYPE_TABLE.setdefault(
+                genotype, genotype_vcf_fields(*genotype))
 
-    return output
+        # Position, dbSNP ID, reference.
+        snp_id = data[0] if data[0].startswith('rs') else '.'
+        line = '\t'.join([chrom, data[2], snp_id, fields])
+        if info_end:
+            line += data[2]
+        yield line + genotype_fields
 
 
-def clean_raw_ancestrydna(closed_input_file):
+def convert_shard(body, genome_sex, reference_slice):
     """
-    Create clean file in AncestryDNA format from downloaded version
-    Obsessively careful processing that ensures AncestryDNA file format changes
-    won't inadvertantly result in unexpected information, e.g. names.
+    Convert the cleaned body lines of one VCF chromosome, run on the
+    conversion pool. Returns the VCF text in position order and its line
+    count.
     """
-    inputfile = open_archive(closed_input_file)
+    reference = ReferenceIndex(reference_slice)
+    lines = list(vcf_body_from_raw_ancestrydna(body.splitlines(), genome_sex,
+                                               reference))
+    positions = [int(line.split('\t', 2)[1]) for line in lines]
+    if any(a > b for a, b in zip(positions, positions[1:])):
+        lines = [line for _, line in sorted(zip(positions, lines))]
+    return ''.join(lines), len(lines)
 
-    output = StringIO()
 
+def shard_pool(workers):
+    """
+    Return a pool of worker processes. Daemonic processes, like the pool
+    workers of Celery's prefork worker, can't have children, so there the
+    shards are converted one after another on a thread.
+    """
+    if multiprocessing.current_process().daemon:
+        return concurrent.futures.ThreadPoolExecutor(1)
+    return concurrent.futures.ProcessPoolExecutor(workers)
+
+
+def vcf_body_sharded(raw_ancestrydna, genome_sex, reference, workers):
+    """
+    Convert cleaned AncestryDNA lines to VCF on a pool of worker processes,
+    one shard per VCF chromosome. Each worker only gets the reference of
+    its chromosome. Returns a VcfShards.
+    """
+    shards = dict()
+    for line in raw_ancestrydna:
+        fields = line.split('\t', 2)
+        # Skips the header, and chromosomes without a VCF name.
+        chrom = CHROM_MAP.get(fields[1]) if len(fields) > 2 else None
+        if chrom is not None:
+            shards.setdefault(chrom, dict()).setdefault(
+                fields[1], []).append(line)
+
+    body = VcfShards()
+    with shard_pool(workers) as pool:
+        futures = dict()
+        for chrom, chromosomes in shards.items():
+            # Chromosome 25 (PAR) lines are part of the X shard.
+            futures[chrom] = pool.submit(
+                convert_shard,
+                ''.join(itertools.chain(*chromosomes.values())),
+                genome_sex, reference.slice(chromosomes))
+        for chrom, future in futures.items():
+            body.add(chrom, *future.result())
+    return body
+
+
+def clean_raw_ancestrydna_header(inputfile, output):
+    """
+    Write the clean AncestryDNA header and column names to output, leaving
+    inputfile positioned at the first body line.
+    """
     header_l1 = inputfile.readline()
     logger.warn(header_l1)
     expected_header_l1 = '#AncestryDNA raw data download'
@@ -216,23 +369,41 @@ def clean_raw_ancestrydna(closed_input_file):
     if data_header.rstrip() == EXPECTED_COLUMNS_HEADER:
         output.write(EXPECTED_COLUMNS_HEADER + '\n')
 
+
+def genome_sex_from_y(reported_Y, called_Y):
+    """
+    AncestryDNA always reports two alleles for all X and Y positions.
+    For XY individuals, haplozygous positions are redundantly reported.
+    For XX individuals this means Y positions are "0".
+    Note the above two statements are not ALWAYS true! The raw data
+    ocassionally reports 'heterozygous' calls for X and Y in XY individuals,
+    and Y calls in XX individuals. So our test is forgiving of these.
+    """
+    if reported_Y and called_Y / reported_Y > 0.5:
+        return 'Male'
+    return 'Female'
+
+
+def clean_raw_ancestrydna(closed_input_file, output=None):
+    """
+    Create clean file in AncestryDNA format from downloaded version
+    Obsessively careful processing that ensures AncestryDNA file format changes
+    won't inadvertantly result in unexpected information, e.g. names.
+    Lines are written to output as they are read, if no output file is given
+    they are collected in a StringIO.
+    """
+    inputfile = open_archive(closed_input_file)
+
+    if output is None:
+        output = StringIO()
+
+    clean_raw_ancestrydna_header(inputfile, output)
+
     next_line = inputfile.readline()
     bad_format = False
-    # AncestryDNA always reports two alleles for all X and Y positions.
-    # For XY individuals, haplozygous positions are redundantly reported.
-    # For XX individuals this means Y positions are "0".
-    # Note the above two statements are not ALWAYS true! The raw data
-    # ocassionally reports 'heterozygous' calls for X and Y in XY individuals,
-    # and Y calls in XX individuals. So our test is forgiving of these.
-    genome_sex = 'Female'
     called_Y = 0
     reported_Y = 0
 
-    LINE_RE = re.compile(
-        r'(rs|VGXS)[0-9]+\t[1-9][0-9]?\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
-    REPORTED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI0]\t[ACGTDI0]')
-    CALLED_Y = re.compile(r'(rs|VGXS)[0-9]+\t24\t[0-9]+\t[ACGTDI]\t[ACGTDI]')
-
     while next_line:
         if LINE_RE.match(next_line):
             if REPORTED_Y.match(next_line):
@@ -254,92 +425,451 @@ def clean_raw_ancestrydna(closed_input_file):
         except StopIteration:
             next_line = None
 
-    if reported_Y == 0:
-        genome_sex = 'Female'
-    elif called_Y / reported_Y > 0.5:
-        genome_sex = 'Male'
+    return output, genome_sex_from_y(reported_Y, called_Y)
+
+
+def clean_raw_ancestrydna_columnar(closed_input_file, output=None):
+    """
+    Same as clean_raw_ancestrydna, but validates the body in bulk with
+    NumPy. Also returns the body columns for vcf_from_ancestrydna_columns.
+    """
+    inputfile = open_archive(closed_input_file)
+
+    if output is None:
+        output = StringIO()
+
+    clean_raw_ancestrydna_header(inputfile, output)
+    clean_text, body, reported_Y, called_Y = clean_body(
+        inputfile.read(), LINE_RE, REPORTED_Y, CALLED_Y)
+    output.write(clean_text)
+
+    return output, genome_sex_from_y(reported_Y, called_Y), body
+
+
+def result_cache_key(content_hash):
+    """
+    Key of processing results of content with this hash, with the current
+    converter and reference.
+    """
+    get_ancestrydna_reference()
+    return ResultCache.key(content_hash, CONVERTER_VERSION,
+                           get_reference_digest(REF_ANCESTRYDNA_FILE))
+
+
+def clean_to_file(tf_in, raw_filename, size, timer):
+    """
+    Clean a downloaded AncestryDNA file into raw_filename. Returns the
+    genome sex, and the body columns if the columnar parser is used.
+    """
+    body = None
+    with timer.stage('clean') as stats, \
+            open(raw_filename, 'w', buffering=STREAM_BUFFER_SIZE) as raw_file:
+        if COLUMNAR_PARSER:
+            _, chr_sex, body = clean_raw_ancestrydna_columnar(
+                tf_in, output=raw_file)
+            stats['lines'] = len(body)
+        else:
+            _, chr_sex = clean_raw_ancestrydna(tf_in, output=raw_file)
+        stats['bytes_in'] = size
+        stats['bytes_out'] = raw_file.tell()
+    return chr_sex, body
+
+
+def write_vcf(vcf_filename, header, body_filename):
+    """
+    Write a bz2 compressed VCF file from its header lines and a bz2 file of
+    its body, as consecutive streams of a multi-stream bz2 file.
+    """
+    with open(vcf_filename, 'wb') as outfile, \
+            open(body_filename, 'rb') as body:
+        outfile.write(bz2.compress(''.join(header).encode()))
+        shutil.copyfileobj(body, outfile, STREAM_BUFFER_SIZE)
+
+
+def convert_to_vcf(raw_filename, vcf_filename, chr_sex, body, timer,
+                   body_filename=None):
+    """
+    Convert the clean file to a bz2 compressed VCF file, spilling the lines
+    to disk to put them in order, then compressing the ordered lines. The
+    genome sex is only known once cleaning has read the Y calls at the end
+    of the file, so conversion starts from the clean file on disk rather
+    than chaining onto the cleaning. With body_filename, the body is also
+    kept there without the header, which holds the date of the run.
+    """
+    with timer.stage('convert_vcf') as stats:
+        if COLUMNAR_PARSER:
+            header, orderer = split_vcf(
+                vcf_from_ancestrydna_columns(body, chr_sex))
+        elif (CONVERT_WORKERS > 1 and
+              os.path.getsize(raw_filename) >= CONVERT_SHARD_MIN_SIZE):
+            header = vcf_ancestrydna_header()
+            with open(raw_filename, buffering=STREAM_BUFFER_SIZE) as raw_file:
+                orderer = vcf_body_sharded(
+                    raw_file, chr_sex, get_ancestrydna_reference(),
+                    CONVERT_WORKERS)
+        else:
+            with open(raw_filename, buffering=STREAM_BUFFER_SIZE) as raw_file:
+                header, orderer = split_vcf(
+                    vcf_from_raw_ancestrydna(raw_file, chr_sex))
+        stats['lines'] = orderer.lines
+        stats['bytes_out'] = orderer.size
+    with timer.stage('sort_vcf') as stats:
+        orderer.sort()
+        stats['lines'] = orderer.lines
+    with timer.stage('compress_vcf') as stats:
+        if body_filename:
+            write_bz2(orderer, body_filename, COMPRESS_BLOCK_SIZE,
+                      COMPRESS_WORKERS)
+            write_vcf(vcf_filename, header, body_filename)
+        else:
+            write_bz2(itertools.chain(header, orderer), vcf_filename,
+                      COMPRESS_BLOCK_SIZE, COMPRESS_WORKERS)
+        stats['lines'] = orderer.lines
+        stats['bytes_in'] = orderer.size
+        stats['bytes_out'] = os.path.getsize(vcf_filename)
+
+
+def raw_file_metadata():
+    return {
+        'description': 'AncestryDNA full genotyping data, original format',
+        'tags': ['AncestryDNA', 'genotyping'],
+        'creation_date': arrow.get().format(),
+    }
+
+
+def vcf_file_metadata():
+    return {
+        'description': 'AncestryDNA full genotyping data, VCF format',
+        'tags': ['AncestryDNA', 'genotyping', 'vcf'],
+        'creation_date': arrow.get().format(),
+    }
+
+
+def download_to_scratch(dfile, scratch, timer):
+    """
+    Download an uploaded file into the scratch directory. Returns its path
+    and the Download.
+    """
+    infile_suffix = dfile['basename'].split(".")[-1]
+    input_path = os.path.join(scratch, 'upload.' + infile_suffix)
+    with timer.stage('download') as stats, open(input_path, 'wb') as tf_in:
+        download = download_file(dfile['download_url'], tf_in,
+                                 DOWNLOAD_CHUNK_SIZE, DOWNLOAD_MAX_SIZE,
+                                 DOWNLOAD_TIMEOUT)
+        stats['bytes_in'] = download.size
+    logger.info('Downloaded file %s: %d bytes, sha256 %s',
+                dfile['id'], download.size, download.sha256)
+    return input_path, download
+
+
+def process_download(input_path, download, scratch, timer, on_clean=None):
+    """
+    Clean a downloaded file and convert it to VCF in the scratch directory,
+    or take the results from the result cache. on_clean is called with the
+    clean file as soon as it is ready. Returns the paths of the clean and
+    the VCF file.
+    """
+    filename_base = 'AncestryDNA-genotyping'
+
+    # Save clean Ancestry genotyping to temp file.
+    raw_filename = filename_base + '.txt'
+    raw_filename = temp_join(scratch, raw_filename)
+    vcf_filename = filename_base + '.vcf.bz2'
+    vcf_filename = temp_join(scratch, vcf_filename)
+    # The cache keeps the VCF body, a hit gets a header of this run.
+    vcf_body_filename = temp_join(scratch, filename_base + '.vcf.body.bz2')
+    cached_names = [os.path.basename(raw_filename),
+                    os.path.basename(vcf_body_filename)]
+
+    # Uploads of already processed content skip straight to uploading.
+    # Results are stored by the hash of the clean file, and aliased by
+    # the hash of the upload.
+    cache_keys = []
+    cached = None
+    if RESULT_CACHE:
+        with timer.stage('cache_lookup'):
+            cache_keys.append(result_cache_key(download.sha256))
+            cached = RESULT_CACHE.fetch(cache_keys[0], scratch, cached_names)
+    if cached is None:
+        with open(input_path, 'rb') as tf_in:
+            chr_sex, body = clean_to_file(tf_in, raw_filename, download.size,
+                                          timer)
+        if RESULT_CACHE:
+            with timer.stage('cache_lookup_clean'):
+                cache_keys.insert(0, result_cache_key(
+                    file_digest(raw_filename)))
+                cached = RESULT_CACHE.fetch(cache_keys[0], scratch,
+                                            cached_names[1:])
+            if cached is not None:
+                RESULT_CACHE.alias(cache_keys[1], cache_keys[0])
+    if RESULT_CACHE:
+        RESULT_CACHE_LOOKUPS.inc(result='miss' if cached is None else 'hit')
+
+    if on_clean:
+        on_clean(raw_filename)
+
+    if cached is None:
+        convert_to_vcf(raw_filename, vcf_filename, chr_sex, body, timer,
+                       vcf_body_filename if RESULT_CACHE else None)
+        if RESULT_CACHE:
+            RESULT_CACHE.store(cache_keys[0],
+                               [raw_filename, vcf_body_filename],
+                               aliases=cache_keys[1:])
+    else:
+        with timer.stage('write_vcf'):
+            write_vcf(vcf_filename, vcf_ancestrydna_header(),
+                      vcf_body_filename)
+    return raw_filename, vcf_filename
+
+
+def upload_result(access_token, project_member_id, timer, stage, filename,
+                  metadata):
+    """
+    Upload a processed file to Open Humans, returns its file ID.
+    """
+    # Imported here, as this module is loaded before the app registry.
+    from .upload_helper import start_direct_upload, complete_direct_upload
+    with timer.stage(stage) as stats:
+        target = start_direct_upload(access_token, project_member_id,
+                                     os.path.basename(filename), metadata)
+        upload = UPLOADER.upload(filename, PresignedTarget(target['url']))
+        stats['bytes_out'] = upload['bytes']
+        stats['retries'] = upload['retries']
+        stats['bytes_per_second'] = upload['bytes_per_second']
+        complete_direct_upload(access_token, project_member_id, target['id'])
+    return int(target['id'])
+
+
+def report_broken_file(access_token):
+    with OH_API_SECONDS.time(endpoint='message'):
+        api.message(
+            "AncestryDNA integration: A broken file was deleted",
+            "While processing your AncestryDNA file "
+            "we noticed that your file does not conform "
+            "to the expected specifications and it was "
+            "thus deleted. Please make sure you upload "
+            "the right file:\nWe expect the file to be a "
+            "single txt file (either unzipped, bz2 zipped or gzipped) "
+            "or a .zip file that contains a single txt file (this is "
+            " what you can download from Ancestry right away) Please "
+            "do not alter the original txt file, as unexpected "
+            "additions can invalidate the file.",
+            access_token, base_url=OH_BASE_URL)
+
+
+def delete_source_file(access_token, project_member_id, file_id):
+    """
+    Delete the processed upload. Processing is over by then, so the
+    member's cached file list is dropped.
+    """
+    try:
+        with OH_API_SECONDS.time(endpoint='delete_file'):
+            api.delete_file(access_token, project_member_id,
+                            file_id=str(file_id), base_url=OH_BASE_URL)
+    finally:
+        invalidate_member_data(project_member_id)
+
+
+def record_stages(timer):
+    for stage, stats in timer.report().items():
+        STAGE_SECONDS.observe(stats['wall'], stage=stage)
+
 
-    return output, genome_sex
+def log_stages(file_id, stages):
+    if STAGE_TIMING:
+        logger.info('Processed file %s, stages: %s', file_id,
+                    json.dumps(stages),
+                    extra={'file_id': file_id, 'stages': stages})
 
 
 def process_file(dfile, access_token, member, metadata):
+    """
+    Clean an uploaded AncestryDNA file, convert it to VCF and upload both.
+    Returns the hash of the upload, the timing of the processing stages
+    and the IDs of the uploaded files.
+    """
+    timer = StageTimer(STAGE_TIMING)
+    scratch = tempfile.mkdtemp()
+    project_member_id = str(member['project_member_id'])
     try:
-        infile_suffix = dfile['basename'].split(".")[-1]
-        tf_in = tempfile.NamedTemporaryFile(suffix="."+infile_suffix)
-        tf_in.write(requests.get(dfile['download_url']).content)
-        tf_in.flush()
-        tmp_directory = tempfile.mkdtemp()
-        filename_base = 'AncestryDNA-genotyping'
-        raw_ancestry, chr_sex = clean_raw_ancestrydna(tf_in)
-        raw_ancestry.seek(0)
-        vcf_ancestry_unsort = vcf_from_raw_ancestrydna(raw_ancestry, chr_sex)
-
-        # Save raw Ancestry genotyping to temp file.
-        raw_filename = filename_base + '.txt'
-        raw_filename = temp_join(tmp_directory, raw_filename)
-        metadata = {
-                    'description':
-                    'AncestryDNA full genotyping data, original format',
-                    'tags': ['AncestryDNA', 'genotyping'],
-                    'creation_date': arrow.get().format(),
-            }
-        with open(raw_filename, 'w') as raw_file:
-            raw_ancestry.seek(0)
-            shutil.copyfileobj(raw_ancestry, raw_file)
-            raw_file.flush()
-
-        api.upload_aws(raw_filename, metadata,
-                       access_token, base_url=OH_BASE_URL,
-                       project_member_id=str(member['project_member_id']))
-
-        # Save VCF Ancestry genotyping to temp file.
-        vcf_filename = filename_base + '.vcf.bz2'
-        vcf_filename = temp_join(tmp_directory, vcf_filename)
-
-        metadata = {
-            'description': 'AncestryDNA full genotyping data, VCF format',
-            'tags': ['AncestryDNA', 'genotyping', 'vcf'],
-            'creation_date': arrow.get().format()
-        }
-
-        vcf_ancestry_unsort.seek(0)
-        vcf_ancestry = sort_vcf(vcf_ancestry_unsort)
-
-        with bz2.BZ2File(vcf_filename, 'w') as vcf_file:
-            vcf_ancestry.seek(0)
-            for i in vcf_ancestry:
-                vcf_file.write(i)
-
-        api.upload_aws(vcf_filename, metadata,
-                       access_token, base_url=OH_BASE_URL,
-                       project_member_id=str(member['project_member_id']))
+        input_path, download = download_to_scratch(dfile, scratch, timer)
+
+        with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+            uploads = []
+
+            def upload_raw(raw_filename):
+                # Upload the clean file while the VCF is built from it.
+                uploads.append(pool.submit(
+                    upload_result, access_token, project_member_id, timer,
+                    'upload_raw', raw_filename, raw_file_metadata()))
+
+            _, vcf_filename = process_download(input_path, download, scratch,
+                                               timer, on_clean=upload_raw)
+            uploads.append(pool.submit(
+                upload_result, access_token, project_member_id, timer,
+                'upload_vcf', vcf_filename, vcf_file_metadata()))
+            # Raise the first upload error, if any.
+            output_file_ids = [future.result() for future in uploads]
+
+        TASKS.inc(status='processed')
+        return {'sha256': download.sha256,
+                'stages': timer.report(),
+                'output_file_ids': output_file_ids}
 
     except:
-        api.message("AncestryDNA integration: A broken file was deleted",
-                    "While processing your AncestryDNA file "
-                    "we noticed that your file does not conform "
-                    "to the expected specifications and it was "
-                    "thus deleted. Please make sure you upload "
-                    "the right file:\nWe expect the file to be a "
-                    "single txt file (either unzipped, bz2 zipped or gzipped) "
-                    "or a .zip file that contains a single txt file (this is "
-                    " what you can download from Ancestry right away) Please "
-                    "do not alter the original txt file, as unexpected "
-                    "additions can invalidate the file.",
-                    access_token, base_url=OH_BASE_URL)
+        TASKS.inc(status='failed')
+        report_broken_file(access_token)
         raise
 
     finally:
-        api.delete_file(access_token,
-                        str(member['project_member_id']),
-                        file_id=str(dfile['id']),
-                        base_url=OH_BASE_URL)
+        delete_source_file(access_token, project_member_id, dfile['id'])
+        shutil.rmtree(scratch, ignore_errors=True)
+        record_stages(timer)
+        log_stages(dfile['id'], timer.report())
+
+
+def ledger_entry(file_id):
+    # Imported here, as this module is loaded before the app registry.
+    from .models import ProcessedFile
+    return ProcessedFile.objects.get(file_id=file_id)
+
+
+def check_scratch(state):
+    """
+    Fail a file whose scratch files are gone, without deleting the upload,
+    so process_files queues it again.
+    """
+    if not os.path.isdir(state['scratch']):
+        TASKS.inc(status='failed')
+        error = 'Scratch directory {} is gone.'.format(state['scratch'])
+        ledger_entry(state['file_id']).failed(error, CONVERTER_VERSION)
+        raise FileNotFoundError(error)
+
+
+def processing_failed(state, access_token, error):
+    """
+    Clean up after a failed split processing task.
+    """
+    TASKS.inc(status='failed')
+    try:
+        report_broken_file(access_token)
+    finally:
+        delete_source_file(access_token, state['project_member_id'],
+                           state['file_id'])
+        shutil.rmtree(state['scratch'], ignore_errors=True)
+        ledger_entry(state['file_id']).failed(repr(error), CONVERTER_VERSION)
+
+
+def start_processing(dfile, access_token, member):
+    """
+    Queue the download of an uploaded file and the upload of the results on
+    the I/O queue, and its conversion on the CPU queue. The tasks pass a
+    state dict with the paths of the files in the shared scratch directory.
+    """
+    state = {'file_id': dfile['id'],
+             'project_member_id': str(member['project_member_id']),
+             'scratch': tempfile.mkdtemp(dir=SCRATCH_DIR or None)}
+    chain(download_uploaded_file.s(state, dfile, access_token).set(
+              queue=IO_QUEUE),
+          convert_uploaded_file.s(access_token).set(
+              queue=CPU_QUEUE),
+          upload_processed_files.s(access_token).set(
+              queue=IO_QUEUE)).delay()
+    return state
+
+
+@app.task
+def download_uploaded_file(state, dfile, access_token):
+    check_scratch(state)
+    timer = StageTimer(STAGE_TIMING)
+    try:
+        state['input'], download = download_to_scratch(
+            dfile, state['scratch'], timer)
+    except Exception as e:
+        processing_failed(state, access_token, e)
+        raise
+    finally:
+        record_stages(timer)
+    state.update(size=download.size, sha256=download.sha256,
+                 stages=timer.report())
+    return state
+
+
+@app.task
+def convert_uploaded_file(state, access_token):
+    check_scratch(state)
+    timer = StageTimer(STAGE_TIMING)
+    try:
+        state['raw'], state['vcf'] = process_download(
+            state['input'], Download(state['size'], state['sha256']),
+            state['scratch'], timer)
+    except Exception as e:
+        processing_failed(state, access_token, e)
+        raise
+    finally:
+        record_stages(timer)
+    state['stages'].update(timer.report())
+    return state
+
+
+@app.task
+def upload_processed_files(state, access_token):
+    check_scratch(state)
+    timer = StageTimer(STAGE_TIMING)
+    try:
+        with concurrent.futures.ThreadPoolExecutor(UPLOAD_WORKERS) as pool:
+            uploads = [
+                pool.submit(upload_result, access_token,
+                            state['project_member_id'], timer, 'upload_raw',
+                            state['raw'], raw_file_metadata()),
+                pool.submit(upload_result, access_token,
+                            state['project_member_id'], timer, 'upload_vcf',
+                            state['vcf'], vcf_file_metadata())]
+            output_file_ids = [future.result() for future in uploads]
+    except Exception as e:
+        processing_failed(state, access_token, e)
+        raise
+    finally:
+        record_stages(timer)
+    state['stages'].update(timer.report())
+    delete_source_file(access_token, state['project_member_id'],
+                       state['file_id'])
+    shutil.rmtree(state['scratch'], ignore_errors=True)
+    TASKS.inc(status='processed')
+    result = {'sha256': state['sha256'],
+              'stages': state['stages'],
+              'output_file_ids': output_file_ids}
+    ledger_entry(state['file_id']).processed(
+        converter_version=CONVERTER_VERSION, **result)
+    log_stages(state['file_id'], state['stages'])
+    return dict(result, file_id=state['file_id'])
 
 
 @app.task(bind=True)
 def clean_uploaded_file(self, access_token, file_id):
-    member = api.exchange_oauth2_member(access_token, base_url=OH_BASE_URL)
+    with OH_API_SECONDS.time(endpoint='exchange_oauth2_member'):
+        member = api.exchange_oauth2_member(access_token,
+                                            base_url=OH_BASE_URL)
+    # Imported here, as this module is loaded before the app registry.
+    from .models import ProcessedFile
+
+    result = {}
     for dfile in member['data']:
         if dfile['id'] == file_id:
-            process_file(dfile, access_token, member, dfile['metadata'])
-    pass
+            entry, _ = ProcessedFile.objects.update_or_create(
+                file_id=file_id,
+                defaults={'oh_id': str(member['project_member_id']),
+                          'basename': dfile['basename'],
+                          'status': ProcessedFile.PROCESSING})
+            if SPLIT_TASKS:
+                # The remaining tasks record the result.
+                return start_processing(dfile, access_token, member)
+            try:
+                result = process_file(dfile, access_token, member,
+                                      dfile['metadata'])
+            except Exception as e:
+                entry.failed(repr(e), CONVERTER_VERSION)
+                raise
+            entry.processed(converter_version=CONVERTER_VERSION, **result)
+    # Stored as the task result, for result backends that keep them.
+    return dict(result, file_id=file_id)
@@ -1,49 +1,270 @@
+import array
+import collections
+import concurrent.futures
+import contextlib
 import zipfile
 import bz2
 import gzip
+import hashlib
 import io
 import os
 from datetime import date
 import logging
-import subprocess
 import tempfile
+import threading
+import time
+from .http_helper import session
 from .vcf_helper import VCF_FIELDS, CHROM_ORDER
 logger = logging.getLogger(__name__)
 
+Download = collections.namedtuple('Download', ['size', 'sha256'])
 
-def sort_vcf(input_file):
-    outputfile = tempfile.TemporaryFile()
-    sortingfile = tempfile.TemporaryFile()
-    next_line = input_file.readline()
-    while next_line and next_line.startswith('#'):
-        outputfile.write(next_line.encode())
-        try:
-            next_line = input_file.readline()
-        except StopIteration:
-            next_line = None
-            break
-    while next_line:
-        for key in CHROM_ORDER:
-            if next_line.startswith(key + '\t'):
-                out_line = "{}\t{}".format(CHROM_ORDER[key], next_line)
-                sortingfile.write(out_line.encode())
-                break
+
+class VcfOrderer(object):
+    """
+    Put VCF body lines in chromosome and position order.
+
+    Lines are spilled to a temporary file while only their chromosome rank,
+    position and file offset are kept in memory. Input that is already in
+    order, the usual case, is streamed back as is. Otherwise chromosomes
+    are read back in CHROM_ORDER order, sorted by position if needed.
+    """
+
+    def __init__(self):
+        self._spill = tempfile.TemporaryFile()
+        self._buckets = dict()
+        self._last_key = None
+        self.ordered = True
+        self.size = 0
+        self.lines = 0
+
+    def add(self, line):
+        fields = line.split('\t', 2)
+        rank = CHROM_ORDER.get(fields[0])
+        if rank is None or len(fields) < 3:
+            return
+        key = (int(rank), int(fields[1]), line)
+        data = line.encode()
+        bucket = self._buckets.get(key[0])
+        if bucket is None:
+            bucket = self._buckets[key[0]] = {
+                'positions': array.array('q'),
+                'offsets': array.array('q'),
+                'ordered': True,
+                'last_key': key}
+        elif key < bucket['last_key']:
+            bucket['ordered'] = False
+        if self.ordered and self._last_key and key < self._last_key:
+            self.ordered = False
+        bucket['positions'].append(key[1])
+        bucket['offsets'].append(self.size)
+        bucket['last_key'] = key
+        self._last_key = key
+        self._spill.write(data)
+        self.size += len(data)
+        self.lines += 1
+
+    def _read_lines(self, offsets):
+        position = None
+        for offset in offsets:
+            if offset != position:
+                self._spill.seek(offset)
+            line = self._spill.readline()
+            position = offset + len(line)
+            yield line.decode()
+
+    def sort(self):
+        """
+        Sort the offsets of chromosomes that were added out of order.
+        Called by iteration, can be called before to time it separately.
+        """
+        for bucket in self._buckets.values():
+            if not bucket['ordered']:
+                lines = self._read_lines(bucket['offsets'])
+                order = sorted(zip(bucket['positions'], lines,
+                                   bucket['offsets']))
+                bucket['offsets'] = array.array(
+                    'q', [offset for _, _, offset in order])
+                bucket['ordered'] = True
+
+    def __iter__(self):
+        self.sort()
+        self._spill.seek(0)
+        if self.ordered:
+            for line in self._spill:
+                yield line.decode()
+        else:
+            for rank in sorted(self._buckets):
+                for line in self._read_lines(self._buckets[rank]['offsets']):
+                    yield line
+        self._spill.close()
+
+
+class VcfShards(object):
+    """
+    VCF body converted per chromosome, with the VcfOrderer interface.
+
+    Each shard is the text of one chromosome, already in position order,
+    so putting the body in order only orders the shards.
+    """
+
+    def __init__(self):
+        self._shards = []
+        self.size = 0
+        self.lines = 0
+
+    def add(self, chrom, text, lines):
+        self._shards.append((int(CHROM_ORDER[chrom]), text))
+        self.size += len(text)
+        self.lines += lines
+
+    def sort(self):
+        self._shards.sort(key=lambda shard: shard[0])
+
+    def __iter__(self):
+        self.sort()
+        for _, text in self._shards:
+            yield text
+
+
+class StageTimer(object):
+    """
+    Record wall time, CPU time, bytes and lines of the stages of a task.
+
+    CPU time is process CPU time for stages run on the thread that created
+    the timer, including threads they use, and thread CPU time for stages
+    run on other threads. A disabled timer records nothing.
+    """
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.stages = collections.OrderedDict()
+        self._thread = threading.current_thread()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """
+        Time a block. Yields a stats dict, for the block to add its byte
+        and line counts to.
+        """
+        stats = {'bytes_in': 0, 'bytes_out': 0, 'lines': 0}
+        if not self.enabled:
+            yield stats
+            return
+        if threading.current_thread() is self._thread:
+            cpu_time = time.process_time
+        else:
+            cpu_time = time.thread_time
+        cpu = cpu_time()
+        start = time.perf_counter()
         try:
-            next_line = input_file.readline()
-        except StopIteration:
-            next_line = None
-            break
-    sortingfile.seek(0)
-    sort_proc = subprocess.Popen(['sort', '-k', '1n,1', '-k', '3n,3'],
-                                 stdin=sortingfile,
-                                 stdout=subprocess.PIPE)
-    cut_proc = subprocess.Popen(['cut', '-f', '2-'],
-                                stdin=sort_proc.stdout,
-                                stdout=subprocess.PIPE)
-    for line in cut_proc.stdout:
-        outputfile.write(line)
-    outputfile.seek(0)
-    return outputfile
+            yield stats
+        finally:
+            stats['wall'] = round(time.perf_counter() - start, 6)
+            stats['cpu'] = round(cpu_time() - cpu, 6)
+            self.stages[name] = stats
+
+    def report(self):
+        return dict(self.stages)
+
+
+def split_vcf(vcf_lines):
+    """
+    Collect VCF lines as a list of header lines and a VcfOrderer with the
+    body lines.
+    """
+    header = []
+    orderer = VcfOrderer()
+    for line in vcf_lines:
+        if line.startswith('#'):
+            header.append(line)
+        else:
+            orderer.add(line)
+    return header, orderer
+
+
+def sort_vcf(vcf_lines):
+    """
+    Sort VCF lines by chromosome and position, yielding the sorted lines.
+    Header lines are passed through as they arrive.
+    """
+    orderer = VcfOrderer()
+    for next_line in vcf_lines:
+        if next_line.startswith('#'):
+            yield next_line
+        else:
+            orderer.add(next_line)
+    for line in orderer:
+        yield line
+
+
+def iter_blocks(lines, block_size):
+    """
+    Join lines into blocks of at least block_size characters.
+    """
+    block = []
+    size = 0
+    for line in lines:
+        block.append(line)
+        size += len(line)
+        if size >= block_size:
+            yield ''.join(block)
+            block = []
+            size = 0
+    if block:
+        yield ''.join(block)
+
+
+def write_bz2(lines, filename, block_size, workers=1):
+    """
+    Compress lines to a bz2 file, writing them in blocks of block_size.
+
+    With more than one worker, blocks are compressed independently on a
+    thread pool (bz2 releases the GIL while compressing) and written in
+    order as consecutive streams of a multi-stream bz2 file.
+    """
+    if workers <= 1:
+        with bz2.BZ2File(filename, 'w') as outfile:
+            for block in iter_blocks(lines, block_size):
+                outfile.write(block.encode())
+        return
+
+    with open(filename, 'wb') as outfile, \
+            concurrent.futures.ThreadPoolExecutor(workers) as pool:
+        # Bound the blocks held in memory to two per worker.
+        pending = collections.deque()
+        for block in iter_blocks(lines, block_size):
+            pending.append(pool.submit(bz2.compress, block.encode()))
+            if len(pending) >= 2 * workers:
+                outfile.write(pending.popleft().result())
+        while pending:
+            outfile.write(pending.popleft().result())
+
+
+def download_file(url, outfile, chunk_size, max_size, timeout):
+    """
+    Stream url to the binary file outfile in chunks of chunk_size bytes,
+    hashing the data as it is written. Fails with a ValueError once more
+    than max_size bytes are received. timeout is passed to requests, a
+    (connect, read) tuple or a number for both.
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with session().get(url, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        length = response.headers.get('Content-Length')
+        if length and length.isdigit() and int(length) > max_size:
+            raise ValueError('Download of {} bytes exceeds the maximum '
+                             'of {} bytes.'.format(length, max_size))
+        for chunk in response.iter_content(chunk_size=chunk_size):
+            size += len(chunk)
+            if size > max_size:
+                raise ValueError('Download exceeds the maximum of {} '
+                                 'bytes.'.format(max_size))
+            digest.update(chunk)
+            outfile.write(chunk)
+    outfile.flush()
+    return Download(size, digest.hexdigest())
 
 
 def vcf_header(source=None, reference=None, format_info=None):
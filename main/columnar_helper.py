@@ -0,0 +1,265 @@
+"""
+Optional NumPy-backed columnar processing of the AncestryDNA body.
+
+The body is parsed in bulk from its bytes into rsid, chromosome, position,
+allele1 and allele2 columns, then validated, counted and converted with
+array operations. Lines that don't pass the strict column checks are
+handed back to be handled line by line, so the output is identical to the
+line based functions in main.celery.
+"""
+import logging
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from .vcf_helper import BASES, CHROM_MAP, GENOTYPE_TABLE, genotype_vcf_fields
+
+logger = logging.getLogger(__name__)
+
+BODY_COLUMNS = ('rsid', 'chromosome', 'position', 'allele1', 'allele2')
+
+CALLED_ALLELES = b'ACGTDI'
+REPORTED_ALLELES = CALLED_ALLELES + b'0'
+BASE_BYTES = ''.join(BASES).encode()
+
+# Longer positions are left to the line by line check.
+MAX_POSITION_DIGITS = 10
+
+# GENOTYPE_TABLE as object arrays indexed by base codes, per haploid flag.
+_genotype_arrays = dict()
+
+
+def columnar_available():
+    return np is not None
+
+
+def _byte_table(allowed):
+    """
+    Boolean lookup table of the byte values in allowed.
+    """
+    table = np.zeros(256, dtype=bool)
+    table[np.frombuffer(allowed, dtype=np.uint8)] = True
+    return table
+
+
+class AncestryDNABody(object):
+    """
+    Clean AncestryDNA body. Rows validated in bulk are kept as columns:
+    chromosome and position as integers, alleles as byte values, and rsid
+    and position text as (start, end) offsets into data. Lines accepted one
+    at a time are kept in extra_lines.
+    """
+
+    def __init__(self, data, columns, extra_lines):
+        self.data = data
+        self.columns = columns
+        self.extra_lines = extra_lines
+
+    def __len__(self):
+        return len(self.columns['chromosome']) + len(self.extra_lines)
+
+    def text(self, name, selected):
+        start, end = self.columns[name]
+        return [self.data[s:e].decode() for s, e in
+                zip(start[selected].tolist(), end[selected].tolist())]
+
+
+def _parse_rows(data):
+    """
+    Split body bytes into lines and parse the lines with five fields that
+    pass the strict column checks. Returns the line count, the line
+    numbers of the parsed rows and their columns.
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    newlines = np.flatnonzero(buf == ord('\n'))
+    starts = np.concatenate([[0], newlines + 1])
+    ends = np.concatenate([newlines, [len(buf)]])
+    if not len(buf) or buf[-1] == ord('\n'):
+        # A trailing newline leaves an empty remainder that isn't a line.
+        starts, ends = starts[:-1], ends[:-1]
+
+    tabs = np.flatnonzero(buf == ord('\t'))
+    first_tab = np.searchsorted(tabs, starts)
+    candidates = np.flatnonzero(np.searchsorted(tabs, ends) - first_tab ==
+                                len(BODY_COLUMNS) - 1)
+    tab = tabs[first_tab[candidates, None] +
+               np.arange(len(BODY_COLUMNS) - 1)]
+    start = np.column_stack([starts[candidates], tab + 1])
+    end = np.column_stack([tab, ends[candidates]])
+    length = end - start
+
+    # Fields are all digits if no non-digit bytes are counted in between.
+    non_digits = np.concatenate(
+        [[0], np.cumsum((buf < ord('0')) | (buf > ord('9')))])
+
+    def digits(field_start, field_end):
+        return ((field_end > field_start) &
+                (non_digits[field_end] == non_digits[field_start]))
+
+    def byte_at(offset):
+        return np.take(buf, offset, mode='clip') if len(buf) else offset
+
+    rsid = start[:, 0]
+    valid = ((byte_at(rsid) == ord('r')) & (byte_at(rsid + 1) == ord('s')) &
+             digits(rsid + 2, end[:, 0]))
+    vgxs = digits(rsid + 4, end[:, 0])
+    for i, char in enumerate(b'VGXS'):
+        vgxs &= byte_at(rsid + i) == char
+    valid |= vgxs
+    valid &= (digits(start[:, 1], end[:, 1]) & (length[:, 1] <= 2) &
+              (byte_at(start[:, 1]) != ord('0')))
+    valid &= (digits(start[:, 2], end[:, 2]) &
+              (length[:, 2] <= MAX_POSITION_DIGITS))
+    reported = _byte_table(REPORTED_ALLELES)
+    for column in (3, 4):
+        valid &= (length[:, column] == 1) & reported[byte_at(start[:, column])]
+    start, end, length = start[valid], end[valid], length[valid]
+
+    chromosome = byte_at(start[:, 1]).astype(np.int64) - ord('0')
+    two_digits = length[:, 1] == 2
+    chromosome[two_digits] = (chromosome[two_digits] * 10 +
+                              byte_at(start[two_digits, 1] + 1) - ord('0'))
+    position = np.zeros(len(start), dtype=np.int64)
+    for i in range(MAX_POSITION_DIGITS):
+        more = length[:, 2] > i
+        position[more] = (position[more] * 10 +
+                          byte_at(start[more, 2] + i) - ord('0'))
+
+    columns = {
+        'rsid': (start[:, 0], end[:, 0]),
+        'chromosome': chromosome,
+        'position': position,
+        'position_text': (start[:, 2], end[:, 2]),
+        'allele1': byte_at(start[:, 3]).astype(np.uint8),
+        'allele2': byte_at(start[:, 4]).astype(np.uint8),
+    }
+    return len(starts), candidates[valid], columns
+
+
+def clean_body(body, line_re, reported_y_re, called_y_re):
+    """
+    Validate AncestryDNA body text. Returns the clean body text, the body
+    as an AncestryDNABody and the reported and called Y counts.
+    """
+    data = body.encode()
+    line_count, parsed, columns = _parse_rows(data)
+    accepted = np.zeros(line_count, dtype=bool)
+    accepted[parsed] = True
+
+    called = _byte_table(CALLED_ALLELES)
+    y_rows = columns['chromosome'] == 24
+    reported_Y = int(y_rows.sum())
+    called_Y = int((y_rows & called[columns['allele1']] &
+                    called[columns['allele2']]).sum())
+
+    extra_lines = []
+    if not accepted.all():
+        lines = body.split('\n')[:line_count]
+        newline = ['\n'] * line_count
+        if line_count and not body.endswith('\n'):
+            newline[-1] = ''
+    bad_format = False
+    for i in np.flatnonzero(~accepted):
+        line = lines[i] + newline[i]
+        if line_re.match(line):
+            accepted[i] = True
+            extra_lines.append(line)
+            if reported_y_re.match(line):
+                reported_Y += 1
+                if called_y_re.match(line):
+                    called_Y += 1
+        elif not bad_format:
+            # Only report this type of format issue once.
+            bad_format = True
+            logger.warn('AncestryDNA body did not conform to expected format.')
+            logger.warn('Bad format: "%s"', line)
+
+    if accepted.all():
+        clean_text = body
+    else:
+        clean_text = ''.join([lines[i] + newline[i]
+                              for i in np.flatnonzero(accepted)])
+    return (clean_text, AncestryDNABody(data, columns, extra_lines),
+            reported_Y, called_Y)
+
+
+def _genotype_table(haploid):
+    """
+    GENOTYPE_TABLE entries as an object array indexed by base codes.
+    """
+    if haploid not in _genotype_arrays:
+        table = np.empty(len(BASES) ** 3, dtype=object)
+        for i, ref in enumerate(BASES):
+            for j, allele1 in enumerate(BASES):
+                for k, allele2 in enumerate(BASES):
+                    table[(i * len(BASES) + j) * len(BASES) + k] = (
+                        GENOTYPE_TABLE[(ref, allele1, allele2, haploid)])
+        _genotype_arrays[haploid] = table
+    return _genotype_arrays[haploid]
+
+
+def _genotype_fields(refs, allele1, allele2, haploid):
+    """
+    Look up the VCF fields for byte arrays of REF bases and called alleles.
+    """
+    codes = np.full(256, -1, dtype=np.int64)
+    codes[np.frombuffer(BASE_BYTES, dtype=np.uint8)] = np.arange(len(BASES))
+    ref_codes = codes[refs]
+    index = ((ref_codes * len(BASES) + codes[allele1]) * len(BASES) +
+             codes[allele2])
+    known = ref_codes >= 0
+    fields = np.empty(len(refs), dtype=object)
+    fields[known] = _genotype_table(haploid)[index[known]]
+    for i in np.flatnonzero(~known):
+        genotype = (chr(refs[i]), chr(allele1[i]), chr(allele2[i]), haploid)
+        fields[i] = GENOTYPE_TABLE.get(genotype) or genotype_vcf_fields(
+            *genotype)
+    return fields
+
+
+def vcf_body_from_columns(body, genome_sex, reference):
+    """
+    Convert the bulk validated rows of an AncestryDNABody to VCF lines.
+    Lines are grouped by chromosome, sort_vcf restores the final order.
+    """
+    columns = body.columns
+    bases = _byte_table(BASE_BYTES)
+    chrom = columns['chromosome']
+    called = bases[columns['allele1']] & bases[columns['allele2']]
+    for chromosome in np.unique(chrom[called]).tolist():
+        selected = np.flatnonzero(called & (chrom == chromosome))
+        chromosome = str(chromosome)
+        arrays = reference.arrays(chromosome)
+        if arrays is None or not len(arrays[0]):
+            continue
+        ref_positions = np.frombuffer(arrays[0], dtype=np.uint32)
+        ref_bases = np.frombuffer(arrays[1], dtype=np.uint8)
+
+        # Skip if we don't have ref.
+        positions = columns['position'][selected]
+        index = np.searchsorted(ref_positions, positions)
+        index = np.minimum(index, len(ref_positions) - 1)
+        found = ref_positions[index] == positions
+        selected = selected[found]
+        if not len(selected):
+            continue
+        refs = ref_bases[index[found]]
+
+        vcf_chrom = CHROM_MAP[chromosome]
+        if chromosome == '24' and genome_sex == 'Female':
+            continue
+        haploid = chromosome in ('23', '24') and genome_sex == 'Male'
+        genotypes = _genotype_fields(refs, columns['allele1'][selected],
+                                     columns['allele2'][selected], haploid)
+
+        for snp_id, position, (fields, info_end, genotype_fields) in zip(
+                body.text('rsid', selected),
+                body.text('position_text', selected), genotypes):
+            if not snp_id.startswith('rs'):
+                snp_id = '.'
+            line = '\t'.join([vcf_chrom, position, snp_id, fields])
+            if info_end:
+                line += position
+            yield line + genotype_fields
@@ -1,8 +1,10 @@
-import ohapi
 from django.conf import settings
 from open_humans.models import OpenHumansMember
 import logging
 from project_admin.models import ProjectConfiguration
+from .http_helper import ohapi_api
+from .member_helper import cache_member_data
+from .metrics import OH_API_SECONDS
 
 logger = logging.getLogger(__name__)
 OH_OAUTH2_REDIRECT_URI = '{}/complete'.format(settings.OPENHUMANS_APP_BASE_URL)
@@ -14,9 +16,18 @@ def get_create_member(data):
     use the data returned by `ohapi.api.oauth2_token_exchange`
     and return an oh_member object
     '''
-    oh_id = ohapi.api.exchange_oauth2_member(
-        access_token=data['access_token'],
-        base_url=OH_BASE_URL)['project_member_id']
+    with OH_API_SECONDS.time(endpoint='exchange_oauth2_member'):
+        member = ohapi_api.exchange_oauth2_member(
+            access_token=data['access_token'],
+            base_url=OH_BASE_URL)
+    cache_member_data(member['project_member_id'], member)
+    return save_member(member['project_member_id'], data)
+
+
+def save_member(oh_id, data):
+    '''
+    store the tokens of member oh_id, creating the member if needed
+    '''
     try:
         oh_member = OpenHumansMember.objects.get(oh_id=oh_id)
         logger.debug('Member {} re-authorized.'.format(oh_id))
@@ -38,17 +49,18 @@ def oh_code_to_member(code):
     Exchange code for token, use this to create and return OpenHumansMember.
     If a matching OpenHumansMember already exists in db, update and return it.
     """
-    proj_config = ProjectConfiguration.objects.get(id=1)
+    proj_config = ProjectConfiguration.get_cached()
     if not (proj_config.oh_client_secret and
             proj_config.oh_client_id and code):
         logger.error('OH_CLIENT_SECRET or code are unavailable')
         return None
-    data = ohapi.api.oauth2_token_exchange(
-        client_id=proj_config.oh_client_id,
-        client_secret=proj_config.oh_client_secret,
-        code=code,
-        redirect_uri=OH_OAUTH2_REDIRECT_URI,
-        base_url=OH_BASE_URL)
+    with OH_API_SECONDS.time(endpoint='oauth2_token_exchange'):
+        data = ohapi_api.oauth2_token_exchange(
+            client_id=proj_config.oh_client_id,
+            client_secret=proj_config.oh_client_secret,
+            code=code,
+            redirect_uri=OH_OAUTH2_REDIRECT_URI,
+            base_url=OH_BASE_URL)
     if 'error' in data:
         logger.error('Error in token exchange: {}'.format(data))
         return None
@@ -0,0 +1,147 @@
+"""
+Helpers for making many HTTP requests to the same hosts.
+"""
+import os
+import threading
+import time
+import types
+from urllib.parse import urlparse
+
+from django.conf import settings
+import ohapi.api
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+_sessions = dict()
+_sessions_lock = threading.Lock()
+
+
+class RateLimiter(object):
+    """
+    Space out requests to each host to at most rate per second, across
+    threads. A rate of 0 or less disables the limit.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate > 0 else 0
+        self._next = dict()
+        self._lock = threading.Lock()
+
+    def wait(self, url):
+        """
+        Block until a request to the host of url is allowed.
+        """
+        if not self.interval:
+            return
+        host = urlparse(url).netloc
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next.get(host, now))
+            self._next[host] = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class TimeoutSession(requests.Session):
+    """
+    Session with a default timeout for requests that don't set one.
+    """
+
+    def __init__(self, timeout):
+        super(TimeoutSession, self).__init__()
+        self.timeout = timeout
+
+    def request(self, method, url, **kwargs):
+        kwargs.setdefault('timeout', self.timeout)
+        return super(TimeoutSession, self).request(method, url, **kwargs)
+
+
+def build_session(pool_size, retries, backoff, timeout):
+    """
+    Return a session keeping up to pool_size connections alive per host.
+    Failed connections are retried, and so are 429 and 5xx responses to
+    requests that are safe to repeat. POST requests (token refreshes,
+    messages, upload completion) are not repeated once they were sent.
+    """
+    session = TimeoutSession(timeout)
+    retry = Retry(total=retries, backoff_factor=backoff,
+                  status_forcelist=(429, 500, 502, 503, 504),
+                  raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size,
+                          max_retries=retry)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+
+def session(retries=None):
+    """
+    Return the session of this process, shared by its threads. Processes
+    forked from it, like Celery's pool workers, create their own. Callers
+    that retry on their own, like uploads, take one with retries=0.
+    """
+    if retries is None:
+        retries = settings.OH_HTTP_RETRIES
+    key = (os.getpid(), retries)
+    try:
+        return _sessions[key]
+    except KeyError:
+        pass
+    with _sessions_lock:
+        if key not in _sessions:
+            for other in [k for k in _sessions if k[0] != key[0]]:
+                del _sessions[other]
+            _sessions[key] = build_session(
+                settings.OH_HTTP_POOL_SIZE, retries,
+                settings.OH_HTTP_BACKOFF,
+                (settings.OH_HTTP_CONNECT_TIMEOUT,
+                 settings.OH_HTTP_READ_TIMEOUT))
+        return _sessions[key]
+
+
+class SessionRequests(object):
+    """
+    Stand-in for the requests module that sends through session(), for
+    libraries calling requests.get and requests.post.
+    """
+
+    def __getattr__(self, name):
+        return getattr(requests, name)
+
+    def request(self, method, url, **kwargs):
+        return session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return session().get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return session().post(url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return session().put(url, **kwargs)
+
+
+def session_module(module):
+    """
+    Return a copy of module whose functions send their requests through
+    session(), leaving the module itself as it is. The functions of the
+    copy call each other, so nested requests go through session() too.
+    """
+    copy = types.ModuleType(module.__name__)
+    copy.__dict__.update(vars(module))
+    copy.requests = SessionRequests()
+    for name, value in vars(module).items():
+        if (isinstance(value, types.FunctionType) and
+                value.__module__ == module.__name__):
+            function = types.FunctionType(value.__code__, copy.__dict__,
+                                          name, value.__defaults__,
+                                          value.__closure__)
+            function.__kwdefaults__ = value.__kwdefaults__
+            function.__doc__ = value.__doc__
+            setattr(copy, name, function)
+    return copy
+
+
+# ohapi.api sending through the shared session, for the calls of this app.
+ohapi_api = session_module(ohapi.api)
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+from main.celery import REF_ANCESTRYDNA_FILE, REF_ANCESTRYDNA_INDEX
+from main.reference_helper import build_reference_index
+
+
+class Command(BaseCommand):
+    help = 'Build the binary reference index used for VCF conversion'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--infile', type=str,
+                            default=REF_ANCESTRYDNA_FILE,
+                            help='text reference (chromosome, position, base)')
+        parser.add_argument('--outfile', type=str,
+                            default=REF_ANCESTRYDNA_INDEX,
+                            help='path of the index to write')
+
+    def handle(self, *args, **options):
+        count = build_reference_index(options['infile'], options['outfile'])
+        self.stdout.write('Indexed {} reference positions to {}'.format(
+            count, options['outfile']))
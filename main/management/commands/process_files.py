@@ -1,12 +1,46 @@
+import concurrent.futures
+import logging
+
+from django.conf import settings
 from django.core.management.base import BaseCommand
-from open_humans.models import OpenHumansMember
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+from open_humans.models import OpenHumansMember, OH_TOKEN_URL
+from project_admin.models import ProjectConfiguration
 from main.celery import clean_uploaded_file
-from ohapi import api
+from main.http_helper import RateLimiter, ohapi_api as api
+from main.metrics import OH_API_SECONDS
+from main.models import ProcessedFile, Watermark
+
+logger = logging.getLogger(__name__)
+
+OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
+
+WATERMARK = 'process_files'
+# Per member watermarks of scans that failed, so those members are scanned
+# again while the others move on.
+FAILED_PREFIX = WATERMARK + ':failed:'
 
 
 class Command(BaseCommand):
     help = 'Requeue all unprocessed files for Celery'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=8,
+                            help='members scanned at the same time')
+        parser.add_argument('--rate', type=float, default=10,
+                            help='requests per second to each host, '
+                                 '0 for no limit')
+        parser.add_argument('--progress', type=int, default=100,
+                            help='report progress every this many members')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='only report the files that would be '
+                                 'requeued')
+        parser.add_argument('--full', action='store_true',
+                            help='scan all members, not only those with '
+                                 'changes since the last run')
+
     def check_file_raw_valid(self, file_object):
         if file_object['basename'] != 'AncestryDNA-genotyping.txt':
             return False
@@ -30,16 +64,111 @@ class Command(BaseCommand):
             return False
         return True
 
+    def get_access_token(self, ohmember):
+        """
+        Return a valid access token, refreshing it with the project
+        credentials if it is about to expire.
+        """
+        if ohmember.token_expiring(settings.OH_TOKEN_REFRESH_AHEAD):
+            self.limiter.wait(OH_TOKEN_URL)
+        try:
+            return ohmember.get_access_token(**self.client_info)
+        finally:
+            # Refreshing saves the member on this thread's connection.
+            connection.close()
+
     def iterate_member_files(self, ohmember):
-        ohmember_data = api.exchange_oauth2_member(
-                                ohmember.get_access_token())
-        files = ohmember_data['data']
+        """
+        Return an access token and the unprocessed files of a member.
+        """
+        access_token = self.get_access_token(ohmember)
+        self.limiter.wait(OH_BASE_URL)
+        with OH_API_SECONDS.time(endpoint='exchange_oauth2_member'):
+            ohmember_data = api.exchange_oauth2_member(
+                access_token, base_url=OH_BASE_URL)
+        return access_token, [f for f in ohmember_data['data']
+                              if not self.check_file_valid(f)]
+
+    def requeue(self, ohmember, access_token, files):
         for f in files:
-            if not self.check_file_valid(f):
-                clean_uploaded_file.delay(ohmember.access_token,
-                                          f['id'])
+            if self.dry_run:
+                self.stdout.write('{}: file {}'.format(ohmember.oh_id,
+                                                       f['id']))
+                continue
+            ProcessedFile.objects.mark_queued(ohmember.oh_id, f['id'],
+                                              f['basename'])
+            clean_uploaded_file.delay(access_token, f['id'])
+
+    def members_to_scan(self, full):
+        """
+        All members for a full scan or the first run. Otherwise only
+        members who joined since the last run, whose last scan failed, or
+        with files that failed since or never finished.
+        """
+        members = OpenHumansMember.objects.all()
+        since = None if full else Watermark.get_timestamp(WATERMARK)
+        if since is not None:
+            failed = [name[len(FAILED_PREFIX):] for name in
+                      Watermark.objects.filter(name__startswith=FAILED_PREFIX)
+                      .values_list('name', flat=True)]
+            members = members.filter(
+                Q(oh_id__in=ProcessedFile.objects.members_to_requeue(since)) |
+                Q(oh_id__in=failed) |
+                Q(user__date_joined__gt=since))
+        return list(members)
+
+    def record_scans(self, started, succeeded, failed):
+        """
+        Move the watermark on, and keep a watermark for each member whose
+        scan failed until a scan of that member succeeds.
+        """
+        Watermark.set_timestamp(WATERMARK, started)
+        Watermark.objects.filter(
+            name__in=[FAILED_PREFIX + oh_id for oh_id in succeeded]).delete()
+        for oh_id in failed:
+            Watermark.objects.get_or_create(name=FAILED_PREFIX + oh_id,
+                                            defaults={'timestamp': started})
+
+    def report(self, scanned, total, files, errors):
+        self.stdout.write(
+            '{}/{} members scanned, {} files {}, {} errors'.format(
+                scanned, total, files,
+                'to requeue' if self.dry_run else 'requeued', errors))
 
     def handle(self, *args, **options):
-        open_humans_members = OpenHumansMember.objects.all()
-        for ohmember in open_humans_members:
-            self.iterate_member_files(ohmember)
+        self.dry_run = options['dry_run']
+        self.limiter = RateLimiter(options['rate'])
+        self.client_info = ProjectConfiguration.objects.get(id=1).client_info
+        started = timezone.now()
+        open_humans_members = self.members_to_scan(options['full'])
+        total = len(open_humans_members)
+        scanned = files = errors = 0
+        succeeded, failed = [], []
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max(options['workers'], 1)) as pool:
+            futures = {pool.submit(self.iterate_member_files, ohmember):
+                       ohmember for ohmember in open_humans_members}
+            for future in concurrent.futures.as_completed(futures):
+                scanned += 1
+                try:
+                    access_token, member_files = future.result()
+                except Exception:
+                    errors += 1
+                    failed.append(futures[future].oh_id)
+                    logger.exception('Could not scan files of %s',
+                                     futures[future])
+                else:
+                    succeeded.append(futures[future].oh_id)
+                    files += len(member_files)
+                    # Requeued here, so only the main thread writes to
+                    # the ledger.
+                    self.requeue(futures[future], access_token,
+                                 member_files)
+                if options['progress'] and \
+                        scanned % options['progress'] == 0 and \
+                        scanned < total:
+                    self.report(scanned, total, files, errors)
+        if not self.dry_run:
+            self.record_scans(started, succeeded, failed)
+        self.report(scanned, total, files, errors)
@@ -0,0 +1,42 @@
+"""
+Rendered HTML of the markdown project texts, cached by content hash.
+
+Rendered texts are kept in the Django cache, shared by all processes if it
+is Redis, for MARKDOWN_CACHE_TTL seconds, and the most recently used ones
+also in the memory of each process. The project admin renders texts when
+they are saved, so pages don't have to.
+"""
+import functools
+import hashlib
+
+import markdown as markdown_library
+from django.conf import settings
+from django.core.cache import cache
+
+KEY_PREFIX = 'markdown:'
+
+# Texts rendered per process, the project has five.
+LOCAL_CACHE_SIZE = 32
+
+
+@functools.lru_cache(maxsize=LOCAL_CACHE_SIZE)
+def render_markdown(text):
+    """
+    Return the HTML of markdown text.
+    """
+    key = KEY_PREFIX + hashlib.sha256(text.encode()).hexdigest()
+    html = cache.get(key)
+    if html is None:
+        html = markdown_library.markdown(text)
+        # Content addressed, so entries never go stale, but old texts
+        # expire.
+        cache.set(key, html, timeout=settings.MARKDOWN_CACHE_TTL)
+    return html
+
+
+def prerender_markdown(*texts):
+    """
+    Render texts into the cache ahead of the pages showing them.
+    """
+    for text in texts:
+        render_markdown(text)
@@ -0,0 +1,72 @@
+"""
+Short-lived cache of the member data returned by the Open Humans member
+exchange, which lists all files of a member.
+
+Entries are kept in the Django cache, so web processes and workers share
+them if it is Redis. They expire after OH_MEMBER_CACHE_TTL seconds and are
+dropped whenever this app changes the member's files.
+"""
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+
+from . import async_helper
+from .http_helper import ohapi_api
+from .metrics import MEMBER_CACHE_LOOKUPS, OH_API_SECONDS
+
+OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
+
+KEY_PREFIX = 'oh-member:'
+
+
+def _key(oh_id):
+    return KEY_PREFIX + str(oh_id)
+
+
+def cache_member_data(oh_id, data):
+    if settings.OH_MEMBER_CACHE_TTL > 0:
+        cache.set(_key(oh_id), data, settings.OH_MEMBER_CACHE_TTL)
+
+
+def cached_member_data(oh_id):
+    """
+    Return the cached data of member oh_id, or None.
+    """
+    if settings.OH_MEMBER_CACHE_TTL <= 0:
+        return None
+    data = cache.get(_key(oh_id))
+    MEMBER_CACHE_LOOKUPS.inc(result='miss' if data is None else 'hit')
+    return data
+
+
+def invalidate_member_data(oh_id):
+    """
+    Drop the cached data of member oh_id, after their files changed.
+    """
+    cache.delete(_key(oh_id))
+
+
+def get_member_data(oh_id, access_token):
+    """
+    Return the data of member oh_id, exchanging access_token for it on a
+    miss.
+    """
+    data = cached_member_data(oh_id)
+    if data is None:
+        with OH_API_SECONDS.time(endpoint='exchange_oauth2_member'):
+            data = ohapi_api.exchange_oauth2_member(access_token,
+                                                    base_url=OH_BASE_URL)
+        cache_member_data(oh_id, data)
+    return data
+
+
+async def aget_member_data(oh_id, access_token):
+    """
+    Return the data of member oh_id like get_member_data, with the asyncio
+    client.
+    """
+    data = await sync_to_async(cached_member_data)(oh_id)
+    if data is None:
+        data = await async_helper.exchange_oauth2_member(access_token)
+        await sync_to_async(cache_member_data)(oh_id, data)
+    return data
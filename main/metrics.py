@@ -0,0 +1,265 @@
+"""
+Counters and histograms for the web app and workers, exported in the
+Prometheus text format by the /metrics view.
+
+With METRICS_REDIS_URL (REDIS_URL by default) set, metrics are kept in
+Redis so the view reports the totals of all web and worker processes.
+Otherwise they are kept in the memory of the process that records them.
+Recording a metric never raises, a failing Redis only loses the update.
+After a failure updates are dropped for RETRY_AFTER seconds, so a Redis
+that is down doesn't add its timeout to every recording.
+"""
+import bisect
+import contextlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'metrics:'
+
+RETRY_AFTER = 30
+
+
+class LocalBackend(object):
+    """
+    Metric values in a dict of this process.
+    """
+
+    def __init__(self):
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def increment(self, key, fields):
+        with self._lock:
+            values = self._values.setdefault(key, dict())
+            for field, amount in fields.items():
+                values[field] = values.get(field, 0) + amount
+
+    def values(self, key):
+        with self._lock:
+            return dict(self._values.get(key, {}))
+
+
+class RedisBackend(object):
+    """
+    Metric values in Redis hashes, shared by all processes.
+    """
+
+    def __init__(self, url):
+        self._redis = redis.Redis.from_url(
+            url, socket_connect_timeout=1, socket_timeout=1)
+        self._retry_at = 0
+
+    def increment(self, key, fields):
+        if time.monotonic() < self._retry_at:
+            return
+        pipe = self._redis.pipeline(transaction=False)
+        for field, amount in fields.items():
+            pipe.hincrbyfloat(KEY_PREFIX + key, field, amount)
+        try:
+            pipe.execute()
+        except redis.RedisError:
+            self._retry_at = time.monotonic() + RETRY_AFTER
+            raise
+
+    def values(self, key):
+        return {field.decode(): float(value) for field, value in
+                self._redis.hgetall(KEY_PREFIX + key).items()}
+
+
+def _label_string(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('"', '\\"'))
+                    for name, value in sorted(labels.items()))
+
+
+def _number(value):
+    return repr(int(value)) if float(value).is_integer() else repr(value)
+
+
+class Metric(object):
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        REGISTRY.register(self)
+
+    def _label_string(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{} takes labels {}'.format(
+                self.name, ', '.join(self.labels)))
+        return _label_string(labels)
+
+    def _increment(self, fields):
+        try:
+            REGISTRY.backend.increment(self.name, fields)
+        except Exception:
+            logger.debug('Could not record metric %s', self.name,
+                         exc_info=True)
+
+    def header(self):
+        return ['# HELP {} {}'.format(self.name, self.documentation),
+                '# TYPE {} {}'.format(self.name, self.kind)]
+
+
+class Counter(Metric):
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        self._increment({self._label_string(labels): amount})
+
+    def render(self, values):
+        lines = self.header()
+        for labels, value in sorted(values.items()):
+            lines.append('{}{{{}}} {}'.format(self.name, labels,
+                                              _number(value)))
+        return lines
+
+
+class Histogram(Metric):
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(), buckets=()):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        labels = self._label_string(labels)
+        # Buckets are stored cumulatively, like they are exported.
+        fields = {'{}|{}'.format(labels, bucket): 1 for bucket in
+                  self.buckets[bisect.bisect_left(self.buckets, value):]}
+        fields[labels + '|+Inf'] = 1
+        fields[labels + '|sum'] = value
+        self._increment(fields)
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self, values):
+        lines = self.header()
+        series = sorted({field.rsplit('|', 1)[0] for field in values})
+        for labels in series:
+            separator = ',' if labels else ''
+            for bucket in self.buckets + ('+Inf',):
+                lines.append('{}_bucket{{{}{}le="{}"}} {}'.format(
+                    self.name, labels, separator, bucket, _number(
+                        values.get('{}|{}'.format(labels, bucket), 0))))
+            lines.append('{}_sum{{{}}} {}'.format(
+                self.name, labels, _number(values.get(labels + '|sum', 0))))
+            lines.append('{}_count{{{}}} {}'.format(
+                self.name, labels, _number(values.get(labels + '|+Inf', 0))))
+        return lines
+
+
+class Registry(object):
+
+    def __init__(self):
+        self.metrics = []
+        self._backend = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+
+    @property
+    def backend(self):
+        if self._backend is None:
+            url = settings.METRICS_REDIS_URL
+            if url and redis is not None:
+                self._backend = RedisBackend(url)
+            else:
+                self._backend = LocalBackend()
+        return self._backend
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                values = self.backend.values(metric.name)
+            except Exception:
+                logger.warning('Could not read metric %s', metric.name,
+                               exc_info=True)
+                continue
+            lines.extend(metric.render(values))
+        lines.extend(queue_depth_lines())
+        return '\n'.join(lines) + '\n'
+
+
+def queue_depth_lines():
+    """
+    Length of the Celery queues in the Redis broker, read when rendered.
+    """
+    if redis is None:
+        return []
+    try:
+        broker = redis.Redis.from_url(settings.METRICS_BROKER_URL,
+                                      socket_connect_timeout=1,
+                                      socket_timeout=1)
+        depths = [(queue, broker.llen(queue))
+                  for queue in settings.METRICS_QUEUES]
+    except redis.RedisError:
+        logger.debug('Could not read queue lengths', exc_info=True)
+        return []
+    lines = ['# HELP celery_queue_length Tasks waiting in the broker queue.',
+             '# TYPE celery_queue_length gauge']
+    for queue, depth in depths:
+        lines.append('celery_queue_length{{queue="{}"}} {}'.format(
+            queue, depth))
+    return lines
+
+
+REGISTRY = Registry()
+
+TASKS = Counter(
+    'ancestrydna_tasks_total',
+    'AncestryDNA files processed, by status (processed or failed).',
+    labels=('status',))
+
+RESULT_CACHE_LOOKUPS = Counter(
+    'ancestrydna_result_cache_lookups_total',
+    'Lookups of processed files in the result cache, by result.',
+    labels=('result',))
+
+STAGE_SECONDS = Histogram(
+    'ancestrydna_stage_seconds',
+    'Wall time of the stages of processing an AncestryDNA file.',
+    labels=('stage',),
+    buckets=(0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300))
+
+OH_API_SECONDS = Histogram(
+    'oh_api_request_seconds',
+    'Latency of Open Humans API calls, by endpoint.',
+    labels=('endpoint',),
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+
+UPLOAD_BYTES_PER_SECOND = Histogram(
+    'ancestrydna_upload_bytes_per_second',
+    'Throughput of processed file uploads.',
+    buckets=(1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8))
+
+MEMBER_CACHE_LOOKUPS = Counter(
+    'oh_member_cache_lookups_total',
+    'Lookups of member data in the member cache, by result (hit or miss).',
+    labels=('result',))
+
+TOKEN_REFRESHES = Counter(
+    'oh_token_refreshes_total',
+    'Open Humans access token refreshes, by status (success or failure).',
+    labels=('status',))
@@ -0,0 +1,42 @@
+# Generated by Django 4.2.16 on 2026-10-17 17:41
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    initial = True
+
+    dependencies = [
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Watermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=64, unique=True)),
+                ('timestamp', models.DateTimeField()),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ProcessedFile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('file_id', models.IntegerField(help_text='Open Humans ID of the uploaded source file.', unique=True)),
+                ('oh_id', models.CharField(db_index=True, max_length=16)),
+                ('basename', models.TextField(blank=True)),
+                ('sha256', models.CharField(blank=True, max_length=64)),
+                ('status', models.CharField(choices=[('queued', 'Queued'), ('processing', 'Processing'), ('processed', 'Processed'), ('failed', 'Failed')], max_length=16)),
+                ('stages', models.TextField(blank=True, help_text='Timing of the processing stages, stored as JSON.')),
+                ('output_file_ids', models.TextField(blank=True, help_text='Open Humans IDs of the processed files, stored as a JSON-formatted array.')),
+                ('converter_version', models.CharField(blank=True, max_length=16)),
+                ('error', models.TextField(blank=True)),
+                ('created', models.DateTimeField(auto_now_add=True)),
+                ('updated', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['status', 'updated'], name='main_proces_status_694bdc_idx')],
+            },
+        ),
+    ]
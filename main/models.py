@@ -0,0 +1,118 @@
+import json
+
+from django.db import models
+from django.utils import timezone
+
+
+class ProcessedFileQuerySet(models.QuerySet):
+
+    def for_member(self, oh_id):
+        return self.filter(oh_id=oh_id)
+
+    def with_status(self, *statuses):
+        return self.filter(status__in=statuses)
+
+    def updated_since(self, timestamp):
+        return self.filter(updated__gt=timestamp)
+
+    def members_to_requeue(self, since):
+        """
+        IDs of members with files that failed since the given time, or
+        that were queued or started before it and never finished. Files
+        queued since may still be waiting or in flight.
+        """
+        pending = self.with_status(ProcessedFile.QUEUED,
+                                   ProcessedFile.PROCESSING).filter(
+                                       updated__lt=since)
+        failed = self.with_status(ProcessedFile.FAILED).updated_since(since)
+        return set((pending | failed).values_list('oh_id', flat=True))
+
+    def mark_queued(self, oh_id, file_id, basename):
+        entry, _ = self.update_or_create(
+            file_id=file_id,
+            defaults={'oh_id': oh_id, 'basename': basename,
+                      'status': ProcessedFile.QUEUED})
+        return entry
+
+
+class ProcessedFile(models.Model):
+    """
+    Ledger of the uploaded files that were queued and processed.
+    """
+    QUEUED = 'queued'
+    PROCESSING = 'processing'
+    PROCESSED = 'processed'
+    FAILED = 'failed'
+    STATUS_CHOICES = ((QUEUED, 'Queued'),
+                      (PROCESSING, 'Processing'),
+                      (PROCESSED, 'Processed'),
+                      (FAILED, 'Failed'))
+
+    file_id = models.IntegerField(
+        unique=True,
+        help_text='Open Humans ID of the uploaded source file.')
+    oh_id = models.CharField(max_length=16, db_index=True)
+    basename = models.TextField(blank=True)
+    sha256 = models.CharField(max_length=64, blank=True)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES)
+    stages = models.TextField(
+        blank=True,
+        help_text='Timing of the processing stages, stored as JSON.')
+    output_file_ids = models.TextField(
+        blank=True,
+        help_text='Open Humans IDs of the processed files, stored as a '
+                  'JSON-formatted array.')
+    converter_version = models.CharField(max_length=16, blank=True)
+    error = models.TextField(blank=True)
+    created = models.DateTimeField(auto_now_add=True)
+    updated = models.DateTimeField(auto_now=True)
+
+    objects = ProcessedFileQuerySet.as_manager()
+
+    class Meta:
+        indexes = [models.Index(fields=['status', 'updated'])]
+
+    def __str__(self):
+        return "<ProcessedFile(file_id={}, status='{}')>".format(
+            self.file_id, self.status)
+
+    def get_stages(self):
+        return json.loads(self.stages) if self.stages else {}
+
+    def get_output_file_ids(self):
+        return json.loads(self.output_file_ids) if self.output_file_ids else []
+
+    def processed(self, sha256, stages, output_file_ids, converter_version):
+        self.status = self.PROCESSED
+        self.sha256 = sha256
+        self.stages = json.dumps(stages)
+        self.output_file_ids = json.dumps(output_file_ids)
+        self.converter_version = converter_version
+        self.error = ''
+        self.save()
+
+    def failed(self, error, converter_version):
+        self.status = self.FAILED
+        self.converter_version = converter_version
+        self.error = error
+        self.save()
+
+
+class Watermark(models.Model):
+    """
+    Time up to which a recurring job has handled all changes.
+    """
+    name = models.CharField(max_length=64, unique=True)
+    timestamp = models.DateTimeField()
+
+    @classmethod
+    def get_timestamp(cls, name):
+        try:
+            return cls.objects.get(name=name).timestamp
+        except cls.DoesNotExist:
+            return None
+
+    @classmethod
+    def set_timestamp(cls, name, timestamp=None):
+        cls.objects.update_or_create(
+            name=name, defaults={'timestamp': timestamp or timezone.now()})
@@ -0,0 +1,278 @@
+import array
+import bisect
+import collections
+import hashlib
+import io
+import logging
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Layout of a reference index file:
+#   magic, chromosome count,
+#   one table entry per chromosome (name, SNP count, offsets),
+#   per chromosome: sorted uint32 positions, then one REF base byte each.
+# Positions are stored in native byte order, the index is meant to be
+# built on the host that uses it (see the build_reference_index command).
+INDEX_MAGIC = b'OHREFIX1'
+INDEX_HEADER = struct.Struct('<8sI')
+INDEX_ENTRY = struct.Struct('<8sIQQ')
+
+CachedReference = collections.namedtuple(
+    'CachedReference', ['index', 'mtime', 'digest'])
+
+# Process-level cache of loaded references, keyed by text reference path.
+_reference_cache = dict()
+_reference_lock = threading.Lock()
+
+
+def _read_text_reference(ref_file):
+    """
+    Group a tab separated (chromosome, position, base) reference by
+    chromosome as lists of (position, base) tuples.
+    """
+    chromosomes = dict()
+    with open(ref_file) as f:
+        for line in f:
+            data = line.rstrip().split('\t')
+            if len(data) < 3:
+                continue
+            chromosomes.setdefault(data[0], []).append(
+                (int(data[1]), data[2]))
+    return chromosomes
+
+
+def _serialize_index(chromosomes, outfile):
+    """
+    Write chromosome -> [(position, base)] data as a binary index.
+    """
+    arrays = []
+    for name in sorted(chromosomes):
+        snps = sorted(chromosomes[name])
+        positions = array.array('I', [pos for pos, _ in snps])
+        bases = ''.join(base[0] for _, base in snps).encode('ascii')
+        arrays.append((name, positions.tobytes(), bases))
+    _write_index(arrays, outfile)
+
+
+def _write_index(arrays, outfile):
+    """
+    Write (name, positions, bases) tuples of sorted chromosome names as a
+    binary index, with positions as uint32 bytes and bases as ASCII bytes.
+    """
+    table_size = INDEX_HEADER.size + INDEX_ENTRY.size * len(arrays)
+    offset = table_size + (-table_size % 4)
+    entries = []
+    blobs = []
+    for name, positions, bases in arrays:
+        pos_offset = offset
+        base_offset = pos_offset + len(positions)
+        offset = base_offset + len(bases)
+        padding = -offset % 4
+        offset += padding
+        entries.append(INDEX_ENTRY.pack(
+            name.encode('ascii'), len(bases), pos_offset, base_offset))
+        blobs.append((positions, bases, b'\0' * padding))
+
+    outfile.write(INDEX_HEADER.pack(INDEX_MAGIC, len(arrays)))
+    for entry in entries:
+        outfile.write(entry)
+    outfile.write(b'\0' * (-table_size % 4))
+    for positions, bases, padding in blobs:
+        outfile.write(positions)
+        outfile.write(bases)
+        outfile.write(padding)
+
+
+def _umask():
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+
+def build_reference_index(ref_file, index_file):
+    """
+    Convert the text reference into a binary index. The index is written
+    to a temporary file first and moved in place, so readers never see a
+    partially written index.
+    """
+    chromosomes = _read_text_reference(ref_file)
+    index_dir = os.path.dirname(os.path.abspath(index_file))
+    fd, tmp_name = tempfile.mkstemp(dir=index_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            _serialize_index(chromosomes, outfile)
+        # mkstemp creates the file readable by this user only, give the
+        # index the mode of a file created with open.
+        os.chmod(tmp_name, 0o644 & ~_umask())
+        os.replace(tmp_name, index_file)
+    except BaseException:
+        os.unlink(tmp_name)
+        raise
+    return sum(len(snps) for snps in chromosomes.values())
+
+
+class ReferenceIndex(object):
+    """
+    Read-only lookup of reference bases by chromosome and position.
+
+    Backed by a memory-mapped index file, so all processes that open the
+    same index share one copy of its pages.
+    """
+
+    def __init__(self, buffer, source=None):
+        self._buffer = buffer
+        self.source = source
+        view = memoryview(buffer)
+        magic, count = INDEX_HEADER.unpack_from(view, 0)
+        if magic != INDEX_MAGIC:
+            raise ValueError('Not a reference index: {}'.format(source))
+        self._chromosomes = dict()
+        for i in range(count):
+            name, snps, pos_offset, base_offset = INDEX_ENTRY.unpack_from(
+                view, INDEX_HEADER.size + i * INDEX_ENTRY.size)
+            positions = view[pos_offset:base_offset].cast('I')
+            bases = view[base_offset:base_offset + snps]
+            self._chromosomes[name.rstrip(b'\0').decode('ascii')] = (
+                positions, bases)
+
+    @classmethod
+    def open(cls, index_file):
+        with open(index_file, 'rb') as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return cls(buffer, source=index_file)
+
+    @classmethod
+    def from_text(cls, ref_file):
+        """
+        Build an in-memory index straight from the text reference.
+        """
+        with tempfile.TemporaryFile() as outfile:
+            _serialize_index(_read_text_reference(ref_file), outfile)
+            outfile.seek(0)
+            return cls(outfile.read(), source=ref_file)
+
+    def __len__(self):
+        return sum(len(positions)
+                   for positions, _ in self._chromosomes.values())
+
+    @property
+    def nbytes(self):
+        return len(self._buffer)
+
+    def chromosomes(self):
+        return list(self._chromosomes)
+
+    def arrays(self, chromosome):
+        """
+        Return (positions, bases) memoryviews for a chromosome, or None.
+        """
+        return self._chromosomes.get(chromosome)
+
+    def slice(self, chromosomes):
+        """
+        Return the index of only the given chromosomes as bytes, for
+        ReferenceIndex(buffer) in another process.
+        """
+        arrays = []
+        for name in sorted(chromosomes):
+            if name in self._chromosomes:
+                positions, bases = self._chromosomes[name]
+                arrays.append((name, positions.tobytes(), bases.tobytes()))
+        outfile = io.BytesIO()
+        _write_index(arrays, outfile)
+        return outfile.getvalue()
+
+    def get(self, chromosome, position, default=None):
+        """
+        Return the reference base at a position, or default if unknown.
+        """
+        try:
+            positions, bases = self._chromosomes[chromosome]
+            position = int(position)
+        except (KeyError, ValueError):
+            return default
+        i = bisect.bisect_left(positions, position)
+        if i < len(positions) and positions[i] == position:
+            return chr(bases[i])
+        return default
+
+    def to_dict(self):
+        """
+        Return the reference as nested chromosome/position dicts, the
+        format produced by main.celery.read_reference.
+        """
+        return {name: {str(pos): chr(base)
+                       for pos, base in zip(positions, bases)}
+                for name, (positions, bases) in self._chromosomes.items()}
+
+
+def load_reference_index(ref_file, index_file):
+    """
+    Open the index for a text reference, (re)building it first if it is
+    missing or older than the text file. Falls back to an in-memory index
+    if the index can't be written next to the reference.
+    """
+    try:
+        stale = (not os.path.exists(index_file) or
+                 os.path.getmtime(index_file) < os.path.getmtime(ref_file))
+    except OSError:
+        stale = not os.path.exists(index_file)
+    if stale:
+        try:
+            build_reference_index(ref_file, index_file)
+        except OSError:
+            logger.warning('Could not write reference index %s, '
+                           'using an in-memory index.', index_file)
+            return ReferenceIndex.from_text(ref_file)
+    return ReferenceIndex.open(index_file)
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def get_reference(ref_file, index_file):
+    """
+    Return the reference index for ref_file, loading it once per process.
+    The cached index is only reloaded if the text reference changes: a
+    new mtime triggers a hash check, and only a new hash triggers a load.
+    """
+    with _reference_lock:
+        try:
+            mtime = os.path.getmtime(ref_file)
+        except OSError:
+            mtime = None
+        cached = _reference_cache.get(ref_file)
+        if cached and cached.mtime == mtime:
+            return cached.index
+
+        digest = file_digest(ref_file) if mtime is not None else None
+        if cached and cached.digest == digest:
+            _reference_cache[ref_file] = cached._replace(mtime=mtime)
+            return cached.index
+
+        start = time.time()
+        index = load_reference_index(ref_file, index_file)
+        logger.info('Loaded reference %s (%d positions, %d bytes) in %.2fs',
+                    index.source, len(index), index.nbytes,
+                    time.time() - start)
+        _reference_cache[ref_file] = CachedReference(index, mtime, digest)
+        return index
+
+
+def get_reference_digest(ref_file):
+    """
+    Return the hash of the cached reference, identifying its version.
+    """
+    cached = _reference_cache.get(ref_file)
+    return cached.digest if cached else None
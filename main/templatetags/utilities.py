@@ -1,7 +1,8 @@
-import markdown as markdown_library
 from django import template
 from django.utils.safestring import mark_safe
 
+from main.markdown_helper import render_markdown
+
 register = template.Library()
 
 
@@ -10,7 +11,7 @@ def markdown(value):
     """
     Translate markdown to a safe subset of HTML.
     """
-    md_text = markdown_library.markdown(value)
+    md_text = render_markdown(value)
     return mark_safe(md_text)
 
 
@@ -3,13 +3,33 @@ import vcr
 from django.conf import settings
 from django.core.management import call_command
 from open_humans.models import OpenHumansMember
-from main.celery import read_reference, clean_raw_ancestrydna
-from main.celery_helper import vcf_header
+from main.celery import (read_reference, clean_raw_ancestrydna,
+                         clean_raw_ancestrydna_columnar,
+                         vcf_body_from_raw_ancestrydna, vcf_body_sharded)
+from main.cache_helper import ResultCache
+from main.columnar_helper import columnar_available
+from main.celery_helper import (vcf_header, sort_vcf, download_file,
+                                write_bz2, StageTimer)
+from main.vcf_helper import GENOTYPE_TABLE
+from main import http_helper, metrics
+from main.reference_helper import (ReferenceIndex, build_reference_index,
+                                   load_reference_index, get_reference)
+import billiard
+import bz2
+import hashlib
+import ohapi
 import os
 import tempfile
+import unittest
+from unittest import mock
 import requests
 import requests_mock
-from main.celery import process_file
+from main.celery import (process_file, clean_uploaded_file,
+                         download_uploaded_file, convert_uploaded_file,
+                         upload_processed_files, process_download)
+from main.celery_helper import Download
+from main.models import ProcessedFile
+from main.transfer_helper import PresignedTarget, Uploader
 
 
 class ParsingTestCase(TestCase):
@@ -33,6 +53,13 @@ class ParsingTestCase(TestCase):
         self.user = self.oh_member.user
         self.user.set_password('foobar')
         self.user.save()
+        # The cassettes replay the file uploads in the recorded order.
+        patcher = mock.patch('main.celery.UPLOAD_WORKERS', 1)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch('main.celery.RESULT_CACHE', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
 
     def test_read_reference(self):
         """
@@ -43,6 +70,47 @@ class ParsingTestCase(TestCase):
         ref = read_reference(REF_ANCESTRYDNA_FILE)
         self.assertEqual(ref, {'1': {'82154': 'A', '752566': 'G'}})
 
+    def test_reference_index(self):
+        """
+        Test building and reading the binary reference index.
+        """
+        REF_ANCESTRYDNA_FILE = os.path.join(os.path.dirname(__file__),
+                                            'fixtures/test_reference.txt')
+        tmp_directory = tempfile.mkdtemp()
+        index_file = os.path.join(tmp_directory, 'test_reference.idx')
+        self.assertEqual(
+            build_reference_index(REF_ANCESTRYDNA_FILE, index_file), 2)
+        umask = os.umask(0o022)
+        os.umask(umask)
+        self.assertEqual(os.stat(index_file).st_mode & 0o777,
+                         0o644 & ~umask)
+        ref = ReferenceIndex.open(index_file)
+        self.assertEqual(ref.get('1', '82154'), 'A')
+        self.assertEqual(ref.get('1', 752566), 'G')
+        self.assertIsNone(ref.get('1', '82155'))
+        self.assertIsNone(ref.get('2', '82154'))
+        self.assertEqual(ref.to_dict(), read_reference(REF_ANCESTRYDNA_FILE))
+        ref = load_reference_index(REF_ANCESTRYDNA_FILE, index_file)
+        self.assertEqual(len(ref), 2)
+
+    def test_reference_cache(self):
+        """
+        Test that the reference is only reloaded when its content changes.
+        """
+        tmp_directory = tempfile.mkdtemp()
+        ref_file = os.path.join(tmp_directory, 'reference.txt')
+        index_file = os.path.join(tmp_directory, 'reference.idx')
+        with open(ref_file, 'w') as f:
+            f.write('1\t82154\tA\n')
+        ref = get_reference(ref_file, index_file)
+        self.assertIs(get_reference(ref_file, index_file), ref)
+        os.utime(ref_file, (0, 0))
+        self.assertIs(get_reference(ref_file, index_file), ref)
+        with open(ref_file, 'w') as f:
+            f.write('1\t82154\tC\n')
+        ref = get_reference(ref_file, index_file)
+        self.assertEqual(ref.get('1', '82154'), 'C')
+
     def test_vcf_header(self):
         """
         Test function to create a VCF header
@@ -61,6 +129,180 @@ class ParsingTestCase(TestCase):
                                   '\tINFO\tFORMAT\tANCESTRYDNA_DATA']
         self.assertEqual([i.split("=")[0] for i in hd], expected_header_fields)
 
+    def test_genotype_table(self):
+        """
+        Test precomputed VCF fields for reference, alternate and haploid calls.
+        """
+        self.assertEqual(GENOTYPE_TABLE[('A', 'A', 'A', False)],
+                         ('A\t.\t.\t.\tEND=', True, '\tGT\t0/0\n'))
+        self.assertEqual(GENOTYPE_TABLE[('A', 'G', 'C', False)],
+                         ('A\tG,C\t.\t.\t.', False, '\tGT\t1/2\n'))
+        self.assertEqual(GENOTYPE_TABLE[('A', 'G', 'C', True)],
+                         ('A\tG\t.\t.\t.', False, '\tGT\t1\n'))
+
+    def test_sort_vcf(self):
+        """
+        Test VCF ordering for ordered and unordered input.
+        """
+        header = ['##fileformat=VCFv4.1\n', '#CHROM\tPOS\n']
+        body = ['1\t20\trs1\n', '2\t5\trs2\n', 'X\t100\trs3\n',
+                'Y\t7\trs4\n']
+        self.assertEqual(list(sort_vcf(header + body)), header + body)
+        unordered = [body[2], body[1], 'X\t3\trs5\n', body[3], body[0],
+                     'chr99\t1\trs6\n']
+        self.assertEqual(list(sort_vcf(header + unordered)),
+                         header + [body[0], body[1], 'X\t3\trs5\n',
+                                   body[2], body[3]])
+
+    def test_vcf_body_sharded(self):
+        """
+        Test that sharded conversion matches the sorted in-process one.
+        """
+        tmp_directory = tempfile.mkdtemp()
+        ref_file = os.path.join(tmp_directory, 'reference.txt')
+        with open(ref_file, 'w') as f:
+            f.write('1\t10\tA\n1\t20\tC\n2\t5\tG\n23\t30\tT\n'
+                    '25\t15\tA\n')
+        reference = ReferenceIndex.from_text(ref_file)
+        body = ['rsid\tchromosome\tposition\tallele1\tallele2\n',
+                'rs1\t1\t20\tC\tT\n', 'rs2\t1\t10\tA\tA\n',
+                'rs3\t2\t5\tG\tA\n', 'rs4\t23\t30\tT\tT\n',
+                'rs5\t25\t15\tA\tG\n', 'rs6\t26\t1\tA\tA\n']
+        expected = list(sort_vcf(vcf_body_from_raw_ancestrydna(
+            body, 'Male', reference)))
+        shards = vcf_body_sharded(body, 'Male', reference, 2)
+        self.assertEqual(''.join(shards), ''.join(expected))
+        self.assertEqual(shards.lines, 5)
+        # In a pool worker of the prefork Celery worker.
+        with billiard.Pool(1) as pool:
+            self.assertEqual(
+                pool.apply(convert_sharded, (body, ref_file)),
+                ''.join(expected))
+
+    def test_write_bz2(self):
+        """
+        Test that single and multi-stream bz2 output decompress to the input.
+        """
+        lines = ['1\t{}\trs{}\n'.format(i, i) for i in range(1000)]
+        tmp_directory = tempfile.mkdtemp()
+        filename = os.path.join(tmp_directory, 'test.vcf.bz2')
+        for workers in (1, 3):
+            write_bz2(lines, filename, 100, workers)
+            with bz2.open(filename, 'rt') as f:
+                self.assertEqual(f.read(), ''.join(lines))
+
+    def test_result_cache(self):
+        """
+        Test storing, aliasing and evicting cached results.
+        """
+        tmp_directory = tempfile.mkdtemp()
+        cache = ResultCache(os.path.join(tmp_directory, 'cache'), 10)
+        filenames = []
+        for name in ('a.txt', 'a.vcf.bz2'):
+            filenames.append(os.path.join(tmp_directory, name))
+            with open(filenames[-1], 'w') as f:
+                f.write('12345')
+        key = cache.key('content', '1', 'reference')
+        self.assertNotEqual(key, cache.key('content', '2', 'reference'))
+        self.assertIsNone(cache.fetch(key, tmp_directory))
+        cache.store(key, filenames, aliases=['upload'])
+        target = tempfile.mkdtemp()
+        fetched = cache.fetch('upload', target)
+        self.assertEqual([os.path.basename(f) for f in fetched],
+                         ['a.txt', 'a.vcf.bz2'])
+        with open(fetched[0]) as f:
+            self.assertEqual(f.read(), '12345')
+        # A second entry is over the budget, the older one is evicted.
+        os.utime(os.path.join(cache.directory, key), (0, 0))
+        cache.store(cache.key('other'), filenames[:1])
+        self.assertIsNone(cache.fetch(key, tempfile.mkdtemp()))
+        self.assertIsNone(cache.fetch('upload', tempfile.mkdtemp()))
+        self.assertIsNotNone(cache.fetch(cache.key('other'),
+                                         tempfile.mkdtemp()))
+
+    def test_result_cache_header(self):
+        """
+        Test that a cache hit gets the VCF header of its own run.
+        """
+        input_path = 'main/tests/fixtures/AncestryDNA_valid.txt'
+        with open(input_path, 'rb') as f:
+            download = Download(os.path.getsize(input_path),
+                                hashlib.sha256(f.read()).hexdigest())
+        cache = ResultCache(os.path.join(tempfile.mkdtemp(), 'cache'),
+                            1024 * 1024 * 1024)
+        outputs, timers = [], []
+        with mock.patch('main.celery.RESULT_CACHE', cache):
+            for date in ('20180101', '20990101'):
+                header = ['##fileformat=VCFv4.1\n',
+                          '##fileDate={}\n'.format(date),
+                          '#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\t'
+                          'INFO\tFORMAT\tANCESTRYDNA_DATA\n']
+                timers.append(StageTimer())
+                with mock.patch('main.celery.vcf_ancestrydna_header',
+                                return_value=header):
+                    _, vcf_filename = process_download(
+                        input_path, download, tempfile.mkdtemp(),
+                        timers[-1])
+                with bz2.open(vcf_filename, 'rt') as f:
+                    outputs.append(f.read())
+        self.assertNotIn('write_vcf', timers[0].report())
+        self.assertIn('write_vcf', timers[1].report())
+        self.assertIn('##fileDate=20180101', outputs[0])
+        self.assertIn('##fileDate=20990101', outputs[1])
+        self.assertEqual(outputs[0].replace('20180101', '20990101'),
+                         outputs[1])
+
+    def test_stage_timer(self):
+        """
+        Test that stages are recorded only when timing is enabled.
+        """
+        timer = StageTimer()
+        with timer.stage('convert_vcf') as stats:
+            stats['lines'] = 2
+        self.assertEqual(list(timer.report()), ['convert_vcf'])
+        self.assertEqual(timer.report()['convert_vcf']['lines'], 2)
+        self.assertGreaterEqual(timer.report()['convert_vcf']['wall'], 0)
+        timer = StageTimer(enabled=False)
+        with timer.stage('convert_vcf') as stats:
+            stats['lines'] = 2
+        self.assertEqual(timer.report(), {})
+
+    def test_metrics(self):
+        """
+        Test that recorded metrics are exported by the metrics view.
+        """
+        with mock.patch.object(metrics.REGISTRY, '_backend',
+                               metrics.LocalBackend()), \
+                self.settings(METRICS_TOKEN='secret'):
+            metrics.TASKS.inc(status='processed')
+            metrics.STAGE_SECONDS.observe(0.3, stage='clean')
+            response = self.client.get('/metrics',
+                                       HTTP_AUTHORIZATION='Bearer secret')
+        with self.settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics').status_code, 403)
+        content = response.content.decode()
+        self.assertIn('ancestrydna_tasks_total{status="processed"} 1',
+                      content)
+        self.assertIn('ancestrydna_stage_seconds_bucket{stage="clean",'
+                      'le="0.25"} 0', content)
+        self.assertIn('ancestrydna_stage_seconds_bucket{stage="clean",'
+                      'le="0.5"} 1', content)
+        self.assertIn('ancestrydna_stage_seconds_count{stage="clean"} 1',
+                      content)
+
+    @unittest.skipIf(metrics.redis is None, 'redis is not installed')
+    def test_metrics_redis_down(self):
+        """
+        Test that updates are dropped for a while after Redis failed.
+        """
+        backend = metrics.RedisBackend('redis://localhost:1')
+        with mock.patch.object(metrics.REGISTRY, '_backend', backend), \
+                mock.patch('redis.client.Pipeline.execute',
+                           side_effect=metrics.redis.ConnectionError) as ex:
+            metrics.TASKS.inc(status='processed')
+            metrics.TASKS.inc(status='processed')
+        self.assertEqual(ex.call_count, 1)
+
     def test_ancestrydna_cleaning(self):
         """
         Test that cleanup works as expected
@@ -83,7 +325,67 @@ class ParsingTestCase(TestCase):
             cleaned_input.seek(0)
             lines = cleaned_input.read()
             self.assertEqual(lines.find('John Doe'), -1)
-            
+
+    def test_download_file(self):
+        """
+        Test that downloads are hashed and limited in size
+        """
+        get_url = 'http://example.com/AncestryDNA_file.txt'
+        content = b'x' * 1000
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', get_url, content=content, status_code=200)
+            with tempfile.TemporaryFile() as outfile:
+                download = download_file(get_url, outfile, 64, 1000, 1)
+                outfile.seek(0)
+                self.assertEqual(outfile.read(), content)
+            self.assertEqual(download.size, 1000)
+            self.assertEqual(download.sha256,
+                             hashlib.sha256(content).hexdigest())
+            with tempfile.TemporaryFile() as outfile:
+                with self.assertRaises(ValueError):
+                    download_file(get_url, outfile, 64, 999, 1)
+
+    def test_http_session(self):
+        """
+        Test that requests share a session with retries and timeouts
+        """
+        self.assertIs(http_helper.session(), http_helper.session())
+        self.assertIsInstance(http_helper.ohapi_api.requests,
+                              http_helper.SessionRequests)
+        self.assertIs(ohapi.api.requests, requests)
+        session = http_helper.build_session(4, 2, 0, (1, 5))
+        retry = session.get_adapter('https://').max_retries
+        self.assertEqual(retry.total, 2)
+        self.assertIn(503, retry.status_forcelist)
+        self.assertFalse(retry.is_retry('POST', 503))
+        self.assertTrue(retry.is_retry('GET', 503))
+        get_url = 'http://example.com/member/'
+        with requests_mock.Mocker() as m:
+            m.register_uri('GET', get_url, json={'next': None})
+            session.get(get_url)
+            self.assertEqual(m.last_request.timeout, (1, 5))
+            with mock.patch('main.http_helper.session',
+                            return_value=session):
+                self.assertEqual(http_helper.ohapi_api.get_page(get_url),
+                                 {'next': None})
+
+    @unittest.skipUnless(columnar_available(), 'NumPy is not installed')
+    def test_ancestrydna_columnar_cleaning(self):
+        """
+        Test that the columnar parser cleans like the line parser
+        """
+        for fixture in ('AncestryDNA_valid.txt', 'ancestrydna_invalid.txt'):
+            closed_input_file = open(os.path.join(
+                os.path.dirname(__file__), 'fixtures', fixture))
+            closed_input_file.close()
+            cleaned_input, chr_sex = clean_raw_ancestrydna(closed_input_file)
+            columnar_input, columnar_sex, body = (
+                clean_raw_ancestrydna_columnar(closed_input_file))
+            self.assertEqual(columnar_input.getvalue(),
+                             cleaned_input.getvalue())
+            self.assertEqual(columnar_sex, chr_sex)
+            self.assertTrue(len(body))
+
     @vcr.use_cassette('main/tests/fixtures/process_file.yaml',
                       record_mode='none')
     def test_process_file(self):
@@ -99,7 +401,100 @@ class ParsingTestCase(TestCase):
                  'metadata': {'tags': ['bar'], 'description': 'foo'},
                  'source': 'direct-sharing-1337'}
 
-        process_file(dfile, 'myaccesstoken', member, dfile['metadata'])
+        result = process_file(dfile, 'myaccesstoken', member,
+                              dfile['metadata'])
+        self.assertEqual(result['output_file_ids'], [12345, 23456])
+
+    def test_clean_uploaded_file_ledger(self):
+        """
+        Test that processed and failed files are recorded in the ledger.
+        """
+        member = {'project_member_id': '1234',
+                  'data': [{'id': 34567, 'basename': 'AncestryDNA.txt',
+                            'metadata': {}}]}
+        result = {'sha256': 'abc', 'stages': {'clean': {'wall': 1}},
+                  'output_file_ids': [1, 2]}
+        with mock.patch('main.celery.api.exchange_oauth2_member',
+                        return_value=member), \
+                mock.patch('main.celery.process_file',
+                           return_value=result):
+            clean_uploaded_file('myaccesstoken', 34567)
+        entry = ProcessedFile.objects.get(file_id=34567)
+        self.assertEqual(entry.status, ProcessedFile.PROCESSED)
+        self.assertEqual(entry.get_output_file_ids(), [1, 2])
+        self.assertEqual(entry.get_stages(), result['stages'])
+        with mock.patch('main.celery.api.exchange_oauth2_member',
+                        return_value=member), \
+                mock.patch('main.celery.process_file',
+                           side_effect=ValueError('broken')):
+            with self.assertRaises(ValueError):
+                clean_uploaded_file('myaccesstoken', 34567)
+        entry.refresh_from_db()
+        self.assertEqual(entry.status, ProcessedFile.FAILED)
+        self.assertEqual(
+            set(ProcessedFile.objects.members_to_requeue(entry.created)),
+            {'1234'})
+
+    def test_clean_uploaded_file_split(self):
+        """
+        Test the download, convert and upload tasks of split processing.
+        """
+        member = {'project_member_id': '1234',
+                  'data': [{'id': 34567, 'basename': 'AncestryDNA.txt',
+                            'download_url': 'https://example.com/file',
+                            'metadata': {}}]}
+
+        def download(url, output, *args):
+            with open('main/tests/fixtures/AncestryDNA_valid.txt',
+                      'rb') as f:
+                content = f.read()
+            output.write(content)
+            return Download(len(content),
+                            hashlib.sha256(content).hexdigest())
+
+        with mock.patch('main.celery.SPLIT_TASKS', True), \
+                mock.patch('main.celery.api.exchange_oauth2_member',
+                           return_value=member), \
+                mock.patch('main.celery.download_file', download), \
+                mock.patch('main.celery.chain') as chain, \
+                mock.patch('main.celery.upload_result',
+                           side_effect=[1, 2]) as upload, \
+                mock.patch('main.celery.delete_source_file') as delete:
+            state = clean_uploaded_file('myaccesstoken', 34567)
+            self.assertTrue(chain.return_value.delay.called)
+            self.assertEqual([task.options['queue'] for task in
+                              chain.call_args[0]], ['io', 'cpu', 'io'])
+            self.assertEqual(ProcessedFile.objects.get(file_id=34567).status,
+                             ProcessedFile.PROCESSING)
+            state = download_uploaded_file(state, member['data'][0],
+                                           'myaccesstoken')
+            self.assertIn('download', state['stages'])
+            state = convert_uploaded_file(state, 'myaccesstoken')
+            self.assertIn('convert_vcf', state['stages'])
+            result = upload_processed_files(state, 'myaccesstoken')
+        self.assertEqual(result['output_file_ids'], [1, 2])
+        self.assertEqual([c[0][4] for c in upload.call_args_list],
+                         [state['raw'], state['vcf']])
+        delete.assert_called_once_with('myaccesstoken', '1234', 34567)
+        self.assertFalse(os.path.exists(state['scratch']))
+        entry = ProcessedFile.objects.get(file_id=34567)
+        self.assertEqual(entry.status, ProcessedFile.PROCESSED)
+        self.assertEqual(entry.get_output_file_ids(), [1, 2])
+
+    def test_split_scratch_lost(self):
+        """
+        Test that a file whose scratch files are gone is failed, not
+        deleted, so it is queued again.
+        """
+        ProcessedFile.objects.mark_queued('1234', 34567, 'AncestryDNA.txt')
+        state = {'file_id': 34567, 'project_member_id': '1234',
+                 'scratch': os.path.join(tempfile.mkdtemp(), 'gone')}
+        with mock.patch('main.celery.delete_source_file') as delete:
+            with self.assertRaises(FileNotFoundError):
+                upload_processed_files(state, 'myaccesstoken')
+        delete.assert_not_called()
+        self.assertEqual(ProcessedFile.objects.get(file_id=34567).status,
+                         ProcessedFile.FAILED)
 
     @vcr.use_cassette('main/tests/fixtures/process_file_bz2.yaml',
                       record_mode='none')
@@ -151,3 +546,32 @@ class ParsingTestCase(TestCase):
                  'source': 'direct-sharing-1337'}
 
         process_file(dfile, 'myaccesstoken', member, dfile['metadata'])
+
+
+def convert_sharded(body, ref_file):
+    reference = ReferenceIndex.from_text(ref_file)
+    return ''.join(vcf_body_sharded(body, 'Male', reference, 2))
+
+
+class UploaderTestCase(TestCase):
+    """
+    Test the upload engine of the processed files.
+    """
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), 'upload.bin')
+        with open(self.path, 'wb') as f:
+            f.write(os.urandom(11 * 1024 * 1024))
+        self.addCleanup(os.remove, self.path)
+        self.uploader = Uploader(retries=2, backoff=0)
+
+    def test_presigned_retry(self):
+        with requests_mock.Mocker() as m:
+            m.put('http://example.com/upload',
+                  [{'status_code': 503}, {'status_code': 200}])
+            stats = self.uploader.upload(
+                self.path, PresignedTarget('http://example.com/upload'))
+        self.assertEqual(m.call_count, 2)
+        self.assertEqual(stats['retries'], 1)
+        self.assertEqual(stats['bytes'], 11 * 1024 * 1024)
+        self.assertGreater(stats['bytes_per_second'], 0)
@@ -1,11 +1,12 @@
 from django.test import TestCase, Client, RequestFactory
 from django.core.management import call_command
 from django.conf import settings
+from django.core.cache import cache
 from open_humans.models import OpenHumansMember
 from main.views import upload_file_to_oh
 import requests_mock
 from unittest.mock import mock_open, patch
-from main.templatetags.utilities import concatenate
+from main.templatetags.utilities import concatenate, markdown
 from main.helpers import get_create_member
 from urllib.error import HTTPError
 import vcr
@@ -223,6 +224,25 @@ class LoginTestCase(TestCase):
             self.assertEqual(data.status_code, 200)
             self.assertIn('<a href="www.foobar.com"', str(data.content))
 
+    def test_list_files_cached(self):
+        """
+        Test that member data is cached until the files change.
+        """
+        self.addCleanup(cache.clear)
+        with requests_mock.Mocker() as m:
+            m.get(OH_GET_URL, json={'project_member_id': '12345678',
+                                    'next': None,
+                                    'data': []})
+            c = Client()
+            c.login(username=self.user.username, password='foobar')
+            self.assertEqual(c.get("/list").status_code, 200)
+            self.assertEqual(c.get("/list").status_code, 200)
+            self.assertEqual(m.call_count, 1)
+            m.post(OH_API_BASE + '/project/files/delete/')
+            c.get("/delete/1")
+            self.assertEqual(c.get("/list").status_code, 200)
+            self.assertEqual(m.call_count, 3)
+
     def test_list_files_logged_out(self):
         """
         Test the list_files function when logged out.
@@ -237,6 +257,17 @@ class LoginTestCase(TestCase):
         """
         self.assertEqual(concatenate("a", "b", "c"), "a_b_c")
 
+    def test_markdown(self):
+        """
+        Test that markdown is rendered once per text
+        """
+        text = '# Cached heading'
+        with patch('main.markdown_helper.markdown_library.markdown',
+                   return_value='<h1>Cached heading</h1>') as render:
+            self.assertEqual(markdown(text), '<h1>Cached heading</h1>')
+            self.assertEqual(markdown(text), '<h1>Cached heading</h1>')
+        render.assert_called_once_with(text)
+
     @vcr.use_cassette('main/tests/fixtures/token_exchange_valid.yaml',
                       record_mode='none')
     def test_get_create(self):
@@ -3,7 +3,10 @@ import vcr
 from django.conf import settings
 from django.core.management import call_command
 from open_humans.models import OpenHumansMember
+from main.models import ProcessedFile, Watermark
 import requests_mock
+from io import StringIO
+from unittest import mock
 
 
 class ManagementTestCase(TestCase):
@@ -42,6 +45,66 @@ class ManagementTestCase(TestCase):
                                    'source': 'direct-sharing-1337'}]})
             call_command('process_files')
 
+    def test_management_process_files_dry_run(self):
+        files = [{'id': 34567,
+                  'basename': 'AncestryDNA_valid.txt',
+                  'metadata': {'tags': ['bar'], 'description': 'foo'}},
+                 {'id': 34568,
+                  'basename': 'AncestryDNA-genotyping.vcf.bz2',
+                  'metadata': {'tags': ['AncestryDNA', 'genotyping', 'vcf'],
+                               'description': 'AncestryDNA full genotyping '
+                                              'data, VCF format'}}]
+        command = 'main.management.commands.process_files'
+        out = StringIO()
+        with mock.patch(command + '.api.exchange_oauth2_member',
+                        return_value={'data': files}) as exchange, \
+                mock.patch(command + '.clean_uploaded_file') as task:
+            call_command('process_files', dry_run=True, rate=0, stdout=out)
+        exchange.assert_called_once_with(
+            'myaccesstoken', base_url=settings.OPENHUMANS_OH_BASE_URL)
+        task.delay.assert_not_called()
+        self.assertIn('1234: file 34567', out.getvalue())
+        self.assertIn('1/1 members scanned, 1 files to requeue, 0 errors',
+                      out.getvalue())
+
+    def test_management_process_files_incremental(self):
+        command = 'main.management.commands.process_files'
+        Watermark.set_timestamp('process_files')
+        with mock.patch(command + '.api.exchange_oauth2_member',
+                        return_value={'data': []}) as exchange:
+            call_command('process_files', rate=0, stdout=StringIO())
+            exchange.assert_not_called()
+            ProcessedFile.objects.mark_queued('1234', 34567,
+                                              'AncestryDNA_valid.txt')
+            # Queued since the last run, it may still be in flight.
+            call_command('process_files', rate=0, stdout=StringIO())
+            exchange.assert_not_called()
+            call_command('process_files', rate=0, stdout=StringIO())
+            exchange.assert_called_once()
+            call_command('process_files', rate=0, full=True,
+                         stdout=StringIO())
+            self.assertEqual(exchange.call_count, 2)
+
+    def test_management_process_files_failed_member(self):
+        command = 'main.management.commands.process_files'
+        ProcessedFile.objects.mark_queued('1234', 34567,
+                                          'AncestryDNA_valid.txt')
+        Watermark.set_timestamp('process_files')
+        with mock.patch(command + '.api.exchange_oauth2_member',
+                        side_effect=ValueError) as exchange:
+            call_command('process_files', rate=0, stdout=StringIO())
+        # The watermark moves on, the failed member is scanned again.
+        ProcessedFile.objects.all().delete()
+        self.assertTrue(Watermark.objects.filter(
+            name='process_files:failed:1234').exists())
+        with mock.patch(command + '.api.exchange_oauth2_member',
+                        return_value={'data': []}) as exchange:
+            call_command('process_files', rate=0, stdout=StringIO())
+            call_command('process_files', rate=0, stdout=StringIO())
+        exchange.assert_called_once()
+        self.assertFalse(Watermark.objects.filter(
+            name='process_files:failed:1234').exists())
+
     @vcr.use_cassette('main/tests/fixtures/import_test_file.yaml',
                       record_mode='none')
     def test_management_import_user(self):
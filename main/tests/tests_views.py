@@ -1,12 +1,27 @@
-from django.test import TestCase, Client
+from asgiref.sync import async_to_sync
+from django.test import TestCase, Client, RequestFactory
 from django.core.management import call_command
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
 from project_admin.models import ProjectConfiguration, FileMetaData
-from open_humans.models import OpenHumansMember
+from open_humans.models import OpenHumansMember, OH_TOKEN_URL
+from open_humans.token_helper import TokenCache
+from main import async_views
+from main import async_helper
+from main.async_helper import async_available
+from main.models import ProcessedFile
 import markdown
+import requests_mock
 import vcr
 import json
 from io import BytesIO
+import unittest
+from unittest import mock
+try:
+    import httpx
+except ImportError:
+    httpx = None
 
 
 class AboutPageTestCase(TestCase):
@@ -157,6 +172,70 @@ class LoginTestCase(TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'main/list.html')
 
+    @unittest.skipUnless(async_available(), 'httpx is not installed')
+    def test_async_list_files(self):
+        """
+        Tests the async file list, refreshing the expired token with the
+        asyncio client
+        """
+        data = {"access_token": 'foo',
+                "refresh_token": 'bar',
+                "expires_in": 0}
+        oh_member = OpenHumansMember.create(oh_id='1234567890abcdef',
+                                            data=data)
+        oh_member.save()
+        self.addCleanup(cache.clear)
+        member_data = {'project_member_id': oh_member.oh_id,
+                       'data': [{'id': 1,
+                                 'basename': 'AncestryDNA-genotyping.txt',
+                                 'metadata': {'tags': ['AncestryDNA']}}]}
+
+        def handler(request):
+            if str(request.url) == OH_TOKEN_URL:
+                return httpx.Response(200, json={'access_token': 'new',
+                                                 'refresh_token': 'baz',
+                                                 'expires_in': 36000})
+            self.assertEqual(request.url.params['access_token'], 'new')
+            return httpx.Response(200, json=member_data)
+
+        request = RequestFactory().get('/list')
+        request.user = oh_member.user
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch('main.async_helper.client', return_value=client), \
+                mock.patch('open_humans.models.TOKENS', TokenCache()), \
+                requests_mock.Mocker() as m:
+            response = async_to_sync(async_views.list_files)(request)
+        self.assertEqual(m.call_count, 0)
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'AncestryDNA-genotyping.txt', response.content)
+        oh_member.refresh_from_db()
+        self.assertEqual(oh_member.access_token, 'new')
+
+    @unittest.skipUnless(async_available(), 'httpx is not installed')
+    def test_async_upload_file(self):
+        """
+        Tests the async direct upload, reading the file on a thread
+        """
+        content = b'x' * (3 * 64 * 1024 + 1)
+        uploaded = SimpleUploadedFile('AncestryDNA.txt', content)
+        received = {}
+
+        def handler(request):
+            if request.method == 'PUT':
+                received['body'] = request.read()
+                return httpx.Response(200)
+            if request.url.path.endswith('/direct/'):
+                return httpx.Response(201, json={
+                    'url': 'http://example.com/upload', 'id': 42})
+            return httpx.Response(200)
+
+        client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+        with mock.patch('main.async_helper.client', return_value=client):
+            file_id = async_to_sync(async_helper.upload_file)(
+                'foo', '1234', uploaded, {'tags': []})
+        self.assertEqual(file_id, 42)
+        self.assertEqual(received['body'], content)
+
 
 class UploadTestCase(TestCase):
     def setUp(self):
@@ -215,3 +294,31 @@ class UploadTestCase(TestCase):
                              status_code=302)
         self.assertEqual(response.status_code, 200)
         self.assertTemplateUsed(response, 'main/overview.html')
+
+    def test_post_upload_csrf(self):
+        """
+        Test that a request failing the CSRF check sends nothing.
+        """
+        c = Client(enforce_csrf_checks=True)
+        c.login(username=self.user.username, password='foobar')
+        test_file = BytesIO(b'mybinarydata')
+        test_file.name = 'myimage.jpg'
+        with requests_mock.Mocker() as m:
+            response = c.post("/complete/",
+                              {'file_{}'.format(self.oh_file.id): test_file})
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(m.call_count, 0)
+        self.assertFalse(ProcessedFile.objects.exists())
+
+    def test_trigger_marks_queued(self):
+        c = Client()
+        c.login(username=self.user.username, password='foobar')
+        with requests_mock.Mocker() as m, \
+                mock.patch('main.views.clean_uploaded_file') as task:
+            c.post('/trigger_processing/',
+                   {'access_token': 'foo', 'file_id': '42'})
+        self.assertEqual(m.call_count, 0)
+        task.delay.assert_called_once_with('foo', 42)
+        entry = ProcessedFile.objects.get(file_id=42)
+        self.assertEqual((entry.oh_id, entry.status),
+                         ('1234567890abcdef', ProcessedFile.QUEUED))
@@ -0,0 +1,69 @@
+"""
+Upload engine for the processed files.
+
+Files go to presigned URLs, like those of Open Humans direct uploads, in a
+single PUT. The uploader is the only layer retrying, as it reopens the
+file for each attempt. Each upload reports its throughput.
+"""
+import logging
+import os
+import time
+
+from .http_helper import session
+from .metrics import UPLOAD_BYTES_PER_SECOND
+
+logger = logging.getLogger(__name__)
+
+
+class PresignedTarget(object):
+    """
+    A presigned URL taking the whole file in a single PUT.
+    """
+
+    def __init__(self, url):
+        self.url = url
+
+    def put(self, path):
+        # Without the session's retries, which would resend a consumed
+        # stream.
+        with open(path, 'rb') as stream:
+            response = session(retries=0).put(self.url, data=stream)
+        response.raise_for_status()
+
+
+class Uploader(object):
+    """
+    Upload files, trying each PUT up to retries more times.
+    """
+
+    def __init__(self, retries, backoff):
+        self.retries = retries
+        self.backoff = backoff
+
+    def upload(self, path, target):
+        """
+        Upload the file at path to target. Returns the stats of the upload:
+        its size, retries, wall time and throughput.
+        """
+        stats = {'bytes': os.path.getsize(path), 'retries': 0}
+        start = time.perf_counter()
+        self._try(stats, target.put, path)
+        stats['seconds'] = round(time.perf_counter() - start, 6)
+        stats['bytes_per_second'] = round(
+            stats['bytes'] / max(stats['seconds'], 1e-6))
+        UPLOAD_BYTES_PER_SECOND.observe(stats['bytes_per_second'])
+        logger.debug('Uploaded %s at %s bytes/s, %s retries',
+                     path, stats['bytes_per_second'], stats['retries'])
+        return stats
+
+    def _try(self, stats, func, *args):
+        for attempt in range(self.retries + 1):
+            try:
+                return func(*args)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                logger.warning('Upload attempt %s failed, retrying',
+                               attempt + 1, exc_info=True)
+                stats['retries'] += 1
+                time.sleep(self.backoff * 2 ** attempt)
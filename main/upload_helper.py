@@ -0,0 +1,62 @@
+"""
+Open Humans direct uploads.
+"""
+import json
+from urllib.error import HTTPError
+
+from django.conf import settings
+
+from .http_helper import session
+from .metrics import OH_API_SECONDS
+
+OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
+OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
+OH_DIRECT_UPLOAD = OH_API_BASE + '/project/files/upload/direct/'
+OH_DIRECT_UPLOAD_COMPLETE = OH_API_BASE + '/project/files/upload/complete/'
+
+
+def raise_http_error(url, response, message):
+    raise HTTPError(url, response.status_code, message, hdrs=None, fp=None)
+
+
+def start_direct_upload(access_token, project_member_id, filename, metadata):
+    """
+    Start a direct upload, returns the target with the upload URL and the
+    Open Humans ID of the file.
+    """
+    upload_url = '{}?access_token={}'.format(OH_DIRECT_UPLOAD, access_token)
+    with OH_API_SECONDS.time(endpoint='upload_direct'):
+        response = session().post(upload_url,
+                                  data={'project_member_id': project_member_id,
+                                        'filename': filename,
+                                        'metadata': json.dumps(metadata)})
+    if response.status_code != 201:
+        raise raise_http_error(upload_url, response,
+                               'Bad response when starting file upload.')
+    return response.json()
+
+
+def put_to_target(target, filehandle):
+    """
+    Upload the file to the storage target of a direct upload.
+    """
+    with OH_API_SECONDS.time(endpoint='upload_s3'):
+        response = session().put(url=target['url'], data=filehandle)
+    if response.status_code != 200:
+        raise raise_http_error(target['url'], response,
+                               'Bad response when uploading to target.')
+
+
+def complete_direct_upload(access_token, project_member_id, file_id):
+    """
+    Report a completed direct upload to Open Humans.
+    """
+    complete_url = '{}?access_token={}'.format(OH_DIRECT_UPLOAD_COMPLETE,
+                                               access_token)
+    with OH_API_SECONDS.time(endpoint='upload_complete'):
+        response = session().post(complete_url,
+                                  data={'project_member_id': project_member_id,
+                                        'file_id': file_id})
+    if response.status_code != 200:
+        raise raise_http_error(complete_url, response,
+                               'Bad response when completing upload.')
@@ -1,15 +1,24 @@
+from django.conf import settings
 from django.urls import re_path
 
 from . import views
 
+if settings.ASYNC_VIEWS:
+    # Served by oh_data_uploader.asgi, these call Open Humans without
+    # blocking.
+    from . import async_views as oh_views
+else:
+    oh_views = views
+
 urlpatterns = [
     re_path(r'^$', views.index, name='index'),
-    re_path(r'^complete/?$', views.complete, name='complete'),
+    re_path(r'^complete/?$', oh_views.complete, name='complete'),
     re_path(r'^logout/?$', views.logout_user, name='logout'),
-    re_path(r'^overview/?$', views.overview, name='overview'),
+    re_path(r'^overview/?$', oh_views.overview, name='overview'),
     re_path(r'^upload_simple/?$', views.upload_old, name='upload_old'),
     re_path(r'^about/?$', views.about, name='about'),
-    re_path(r'^list/?$', views.list_files, name='list'),
-    re_path(r'^delete/(?P<file_id>\w+)/?$', views.delete_file, name='delete'),
+    re_path(r'^list/?$', oh_views.list_files, name='list'),
+    re_path(r'^delete/(?P<file_id>\w+)/?$', oh_views.delete_file,
+            name='delete'),
     re_path(r'^trigger_processing/?$', views.trigger, name='trigger'),
 ]
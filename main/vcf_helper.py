@@ -157,3 +157,41 @@ CHROM_MAP = {
     '24': 'Y',
     '25': 'X',
 }
+
+BASES = ('A', 'C', 'G', 'T')
+
+
+def transcode_genotype(ref, allele1, allele2, haploid):
+    """
+    Return the VCF ALT and GT fields for a called genotype. Haploid calls
+    (X and Y in XY genomes) only use the first allele.
+    """
+    alleles = allele1 if haploid else allele1 + allele2
+    alt_alleles = []
+    for alle in alleles:
+        if alle != ref and alle not in alt_alleles:
+            alt_alleles.append(alle)
+    all_alleles = [ref] + alt_alleles
+    genotype_indexed = '/'.join([str(all_alleles.index(x))
+                                 for x in alleles])
+    return ','.join(alt_alleles) or '.', genotype_indexed
+
+
+def genotype_vcf_fields(ref, allele1, allele2, haploid):
+    """
+    Return the finished VCF text from REF to the genotype for a call, as
+    (REF..INFO text, whether INFO needs the position appended, FORMAT..GT
+    text). Calls matching the reference get INFO END=<position>.
+    """
+    alt, genotype_indexed = transcode_genotype(ref, allele1, allele2, haploid)
+    info = 'END=' if alt == '.' else '.'
+    return ('\t'.join([ref, alt, '.', '.', info]), alt == '.',
+            '\tGT\t' + genotype_indexed + '\n')
+
+
+# (REF, allele1, allele2, haploid) -> VCF fields for all base combinations.
+GENOTYPE_TABLE = {
+    (ref, allele1, allele2, haploid): genotype_vcf_fields(
+        ref, allele1, allele2, haploid)
+    for ref in BASES for allele1 in BASES for allele2 in BASES
+    for haploid in (False, True)}
@@ -1,23 +1,22 @@
 import json
 import logging
-try:
-    from urllib2 import HTTPError
-except ImportError:
-    from urllib.error import HTTPError
 
 from django.conf import settings
 from django.contrib.auth import login, logout
+from django.http import HttpResponse, HttpResponseForbidden
 from django.shortcuts import redirect, render
 from django.contrib import messages
 from django.utils.safestring import mark_safe
-from django.core.serializers import serialize
-
-import ohapi
-import requests
 
 from project_admin.models import ProjectConfiguration, FileMetaData
 from .helpers import oh_code_to_member
+from .http_helper import ohapi_api
 from .celery import clean_uploaded_file
+from .member_helper import get_member_data, invalidate_member_data
+from .metrics import OH_API_SECONDS, REGISTRY
+from .models import ProcessedFile
+from .upload_helper import (complete_direct_upload, put_to_target,
+                            start_direct_upload)
 
 logger = logging.getLogger(__name__)
 
@@ -35,12 +34,15 @@ def delete_file(request, file_id):
     """
     if request.user.is_authenticated and request.user.username != 'admin':
         oh_member = request.user.openhumansmember
-        client_info = ProjectConfiguration.objects.get(id=1).client_info
-        ohapi.api.delete_files(
-            project_member_id=oh_member.oh_id,
-            access_token=oh_member.get_access_token(**client_info),
-            file_id=file_id,
-            base_url=OH_BASE_URL)
+        client_info = ProjectConfiguration.get_cached().client_info
+        access_token = oh_member.get_access_token(**client_info)
+        with OH_API_SECONDS.time(endpoint='delete_files'):
+            ohapi_api.delete_files(
+                project_member_id=oh_member.oh_id,
+                access_token=access_token,
+                file_id=file_id,
+                base_url=OH_BASE_URL)
+        invalidate_member_data(oh_member.oh_id)
         return redirect('list')
     return redirect('index')
 
@@ -49,16 +51,15 @@ def delete_all_oh_files(oh_member):
     """
     Delete all current project files in Open Humans for this project member.
     """
-    client_info = ProjectConfiguration.objects.get(id=1).client_info
-    ohapi.api.delete_files(
-        project_member_id=oh_member.oh_id,
-        access_token=oh_member.get_access_token(**client_info),
-        all_files=True,
-        base_url=OH_BASE_URL)
-
-
-def raise_http_error(url, response, message):
-    raise HTTPError(url, response.status_code, message, hdrs=None, fp=None)
+    client_info = ProjectConfiguration.get_cached().client_info
+    access_token = oh_member.get_access_token(**client_info)
+    with OH_API_SECONDS.time(endpoint='delete_files'):
+        ohapi_api.delete_files(
+            project_member_id=oh_member.oh_id,
+            access_token=access_token,
+            all_files=True,
+            base_url=OH_BASE_URL)
+    invalidate_member_data(oh_member.oh_id)
 
 
 def upload_file_to_oh(oh_member, filehandle, metadata):
@@ -70,43 +71,23 @@ def upload_file_to_oh(oh_member, filehandle, metadata):
     This process is "direct to S3" using three steps: 1. get S3 target URL from
     Open Humans, 2. Perform the upload, 3. Notify Open Humans when complete.
     """
-    client_info = ProjectConfiguration.objects.get(id=1).client_info
-
-    # Get the S3 target from Open Humans.
-    upload_url = '{}?access_token={}'.format(
-        OH_DIRECT_UPLOAD, oh_member.get_access_token(**client_info))
-    req1 = requests.post(upload_url,
-                         data={'project_member_id': oh_member.oh_id,
-                               'filename': filehandle.name,
-                               'metadata': json.dumps(metadata)})
-    if req1.status_code != 201:
-        raise raise_http_error(upload_url, req1,
-                               'Bad response when starting file upload.')
-
-    # Upload to S3 target.
-    req2 = requests.put(url=req1.json()['url'], data=filehandle)
-    if req2.status_code != 200:
-        raise raise_http_error(req1.json()['url'], req2,
-                               'Bad response when uploading to target.')
-
-    # Report completed upload to Open Humans.
-    complete_url = ('{}?access_token={}'.format(
-        OH_DIRECT_UPLOAD_COMPLETE, oh_member.get_access_token(**client_info)))
-    req3 = requests.post(complete_url,
-                         data={'project_member_id': oh_member.oh_id,
-                               'file_id': req1.json()['id']})
-    if req3.status_code != 200:
-        raise raise_http_error(complete_url, req2,
-                               'Bad response when completing upload.')
-    clean_uploaded_file.delay(oh_member.get_access_token(**client_info),
-                              int(req1.json()['id']))
+    client_info = ProjectConfiguration.get_cached().client_info
+    access_token = oh_member.get_access_token(**client_info)
+    target = start_direct_upload(access_token, oh_member.oh_id,
+                                 filehandle.name, metadata)
+    put_to_target(target, filehandle)
+    complete_direct_upload(access_token, oh_member.oh_id, target['id'])
+    invalidate_member_data(oh_member.oh_id)
+    ProcessedFile.objects.mark_queued(oh_member.oh_id, int(target['id']),
+                                      str(filehandle.name))
+    clean_uploaded_file.delay(access_token, int(target['id']))
 
 
 def iterate_files_upload(request):
     """
     iterate over all files to upload them to OH.
     """
-    files = FileMetaData.objects.all()
+    files = FileMetaData.get_cached()
     for file in files:
         uploaded_file = request.FILES.get('file_{}'.format(file.id))
         if uploaded_file is not None:
@@ -119,8 +100,8 @@ def iterate_files_upload(request):
 
 
 def file_upload_prep_context(oh_member, proj_config):
-    files = FileMetaData.objects.all()
-    files_js = serialize('json', files)
+    files = FileMetaData.get_cached()
+    files_js = FileMetaData.get_cached_json()
     for file in files:
         file.tags = file.get_tags()
     context = {'oh_id': oh_member.oh_id,
@@ -135,7 +116,7 @@ def file_upload_prep_context(oh_member, proj_config):
 
 def set_auth_url(proj_config):
     if proj_config.oh_client_id:
-        auth_url = ohapi.api.oauth2_auth_url(
+        auth_url = ohapi_api.oauth2_auth_url(
             client_id=proj_config.oh_client_id,
             redirect_uri=OH_OAUTH2_REDIRECT_URI,
             base_url=OH_BASE_URL)
@@ -148,8 +129,8 @@ def index(request):
     """
     Starting page for app.
     """
-    proj_config = ProjectConfiguration.objects.get(id=1)
-    file_num = FileMetaData.objects.all().count()
+    proj_config = ProjectConfiguration.get_cached()
+    file_num = len(FileMetaData.get_cached())
     auth_url = set_auth_url(proj_config)
     if not proj_config.oh_client_secret or \
        not proj_config.oh_client_id or \
@@ -168,23 +149,29 @@ def index(request):
     return render(request, 'main/index.html', context=context)
 
 
+def overview_context(oh_member, proj_config, access_token):
+    files = FileMetaData.get_cached()
+    files_js = FileMetaData.get_cached_json()
+    for file in files:
+        file.tags = file.get_tags()
+    context = {'oh_id': oh_member.oh_id,
+               'oh_member': oh_member,
+               'files': files,
+               'files_js': files_js,
+               'access_token': access_token,
+               'oh_direct_upload_url': OH_DIRECT_UPLOAD,
+               'oh_direct_upload_complete_url': OH_DIRECT_UPLOAD_COMPLETE,
+               "overview": "".join(proj_config.overview)}
+    return context
+
+
 def overview(request):
-    client_info = ProjectConfiguration.objects.get(id=1).client_info
     if request.user.is_authenticated and request.user.username != 'admin':
         oh_member = request.user.openhumansmember
-        proj_config = ProjectConfiguration.objects.get(id=1)
-        files = FileMetaData.objects.all()
-        files_js = serialize('json', files)
-        for file in files:
-            file.tags = file.get_tags()
-        context = {'oh_id': oh_member.oh_id,
-                   'oh_member': oh_member,
-                   'files': files,
-                   'files_js': files_js,
-                   'access_token': oh_member.get_access_token(**client_info),
-                   'oh_direct_upload_url': OH_DIRECT_UPLOAD,
-                   'oh_direct_upload_complete_url': OH_DIRECT_UPLOAD_COMPLETE,
-                   "overview": "".join(proj_config.overview)}
+        proj_config = ProjectConfiguration.get_cached()
+        context = overview_context(
+            oh_member, proj_config,
+            oh_member.get_access_token(**proj_config.client_info))
         return render(request, 'main/overview.html', context=context)
     return redirect('index')
 
@@ -205,7 +192,7 @@ def complete(request):
     """
     logger.debug("Received user returning from Open Humans.")
 
-    proj_config = ProjectConfiguration.objects.get(id=1)
+    proj_config = ProjectConfiguration.get_cached()
 
     if request.method == 'GET':
         login_member(request)
@@ -233,8 +220,8 @@ def logout_user(request):
 
 
 def upload_old(request):
-    proj_config = ProjectConfiguration.objects.get(id=1)
-    files = FileMetaData.objects.all()
+    proj_config = ProjectConfiguration.get_cached()
+    files = FileMetaData.get_cached()
     for file in files:
         file.tags = file.get_tags()
     if request.user.is_authenticated:
@@ -249,7 +236,7 @@ def about(request):
     """
     Render about page
     """
-    proj_config = ProjectConfiguration.objects.get(id=1)
+    proj_config = ProjectConfiguration.get_cached()
     context = {'about': proj_config.about,
                'faq': proj_config.faq}
     return render(request, 'main/about.html',
@@ -259,18 +246,35 @@ def about(request):
 def list_files(request):
     if request.user.is_authenticated and request.user.username != 'admin':
         oh_member = request.user.openhumansmember
-        data = ohapi.api.exchange_oauth2_member(
-            oh_member.get_access_token(),
-            base_url=OH_BASE_URL)
+        access_token = oh_member.get_access_token()
+        data = get_member_data(oh_member.oh_id, access_token)
         context = {'files': data['data']}
         return render(request, 'main/list.html',
                       context=context)
     return redirect('index')
 
 
+def metrics(request):
+    """
+    Export metrics in the Prometheus text format. METRICS_TOKEN has to be
+    sent as a bearer token, without it set the metrics are not exported.
+    """
+    if not settings.METRICS_TOKEN or (
+            request.META.get('HTTP_AUTHORIZATION') !=
+            'Bearer {}'.format(settings.METRICS_TOKEN)):
+        return HttpResponseForbidden()
+    return HttpResponse(REGISTRY.render(),
+                        content_type='text/plain; version=0.0.4')
+
+
 def trigger(request):
     if request.method == 'POST':
         token = request.POST.get("access_token")
-        file_id = request.POST.get("file_id")
-        clean_uploaded_file.delay(token, int(file_id))
+        file_id = int(request.POST.get("file_id"))
+        # Recorded for the logged in member, the task fills in the basename
+        # and reports a bad token.
+        if hasattr(request.user, 'openhumansmember'):
+            ProcessedFile.objects.mark_queued(
+                request.user.openhumansmember.oh_id, file_id, '')
+        clean_uploaded_file.delay(token, file_id)
     return redirect('index')
@@ -0,0 +1,19 @@
+"""
+ASGI config for oh_data_uploader project.
+
+It exposes the ASGI callable as a module-level variable named
+``application``. The views calling Open Humans are served by their async
+versions in main.async_views.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/4.2/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault("DJANGO_SETTINGS_MODULE", "oh_data_uploader.settings")
+os.environ.setdefault("ASYNC_VIEWS", "true")
+
+application = get_asgi_application()
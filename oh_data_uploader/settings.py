@@ -50,6 +50,128 @@ OPENHUMANS_APP_BASE_URL = os.getenv('APP_BASE_URL', DEFAULT_BASE_URL)
 if OPENHUMANS_APP_BASE_URL[-1] == "/":
     OPENHUMANS_APP_BASE_URL = OPENHUMANS_APP_BASE_URL[:-1]
 
+# Requests to Open Humans and file storage share a connection pool of this
+# many connections per host and process. Failures are retried with
+# exponential backoff, timeouts are in seconds.
+OH_HTTP_POOL_SIZE = int(os.getenv('OH_HTTP_POOL_SIZE', 10))
+OH_HTTP_RETRIES = int(os.getenv('OH_HTTP_RETRIES', 3))
+OH_HTTP_BACKOFF = float(os.getenv('OH_HTTP_BACKOFF', 0.5))
+OH_HTTP_CONNECT_TIMEOUT = float(os.getenv('OH_HTTP_CONNECT_TIMEOUT', 10))
+OH_HTTP_READ_TIMEOUT = float(os.getenv('OH_HTTP_READ_TIMEOUT', 60))
+
+# Member tokens are cached and refreshed under a lock shared through this
+# Redis, or per process if it is empty. Tokens expiring within the
+# refresh-ahead seconds are refreshed before they are used. The lock
+# expires, and waiting for another process's refresh gives up, after the
+# lock timeout in seconds, by default longer than a refresh request takes.
+OH_TOKEN_CACHE_REDIS_URL = os.getenv('OH_TOKEN_CACHE_REDIS_URL',
+                                     os.getenv('REDIS_URL', ''))
+OH_TOKEN_REFRESH_AHEAD = int(os.getenv('OH_TOKEN_REFRESH_AHEAD', 300))
+OH_TOKEN_LOCK_TIMEOUT = int(os.getenv(
+    'OH_TOKEN_LOCK_TIMEOUT',
+    OH_HTTP_CONNECT_TIMEOUT + OH_HTTP_READ_TIMEOUT + 10))
+
+# Seconds the member data (including the file list) from Open Humans is
+# cached, 0 to disable.
+OH_MEMBER_CACHE_TTL = int(os.getenv('OH_MEMBER_CACHE_TTL', 60))
+
+# Seconds rendered markdown texts are kept in the cache, so texts no longer
+# shown are eventually dropped.
+MARKDOWN_CACHE_TTL = int(os.getenv('MARKDOWN_CACHE_TTL', 24 * 60 * 60))
+
+# Connections the async views open at most per process (needs httpx).
+OH_ASYNC_HTTP_MAX_CONNECTIONS = int(
+    os.getenv('OH_ASYNC_HTTP_MAX_CONNECTIONS', 100))
+
+# Serve the views calling Open Humans as async views, set by the ASGI
+# application. The Procfile serves WSGI; to opt in to ASGI, run the web
+# process as
+#   gunicorn oh_data_uploader.asgi:application \
+#       -k uvicorn_worker.UvicornWorker --log-file=-
+# Under ASGI the sync views and the database calls of the async views share
+# one thread per process.
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '').lower() == 'true'
+
+# Buffer size in bytes used when streaming files through the processing
+# task. Bounds the memory a task needs independently of the file size.
+ANCESTRYDNA_STREAM_BUFFER_SIZE = int(
+    os.getenv('ANCESTRYDNA_STREAM_BUFFER_SIZE', 1024 * 1024))
+
+# Validate and convert the AncestryDNA body as NumPy columns (needs numpy).
+# Output is identical, it's faster for bulk reprocessing of many files.
+ANCESTRYDNA_COLUMNAR_PARSER = (
+    os.getenv('ANCESTRYDNA_COLUMNAR_PARSER', '').lower() == 'true')
+
+# The VCF output is compressed in blocks of this many bytes on a pool of
+# this many threads. One worker writes a single stream bz2 file.
+ANCESTRYDNA_COMPRESS_BLOCK_SIZE = int(
+    os.getenv('ANCESTRYDNA_COMPRESS_BLOCK_SIZE', 4 * 1024 * 1024))
+ANCESTRYDNA_COMPRESS_WORKERS = int(
+    os.getenv('ANCESTRYDNA_COMPRESS_WORKERS', min(os.cpu_count() or 1, 4)))
+
+# Log the time, bytes and lines of each processing stage per task.
+ANCESTRYDNA_STAGE_TIMING = (
+    os.getenv('ANCESTRYDNA_STAGE_TIMING', 'true').lower() == 'true')
+
+# Number of threads uploading processed files to Open Humans.
+ANCESTRYDNA_UPLOAD_WORKERS = int(os.getenv('ANCESTRYDNA_UPLOAD_WORKERS', 2))
+
+# Retries of each upload of a processed file.
+ANCESTRYDNA_UPLOAD_RETRIES = int(os.getenv('ANCESTRYDNA_UPLOAD_RETRIES', 3))
+
+# Processes converting a file to VCF in chromosome shards, 1 converts in
+# the task process. Files below the minimum size in bytes always do, and so
+# do pool workers of a prefork Celery worker, which can't start processes
+# (run the worker with --pool=solo or threads to shard).
+ANCESTRYDNA_CONVERT_WORKERS = int(os.getenv('ANCESTRYDNA_CONVERT_WORKERS', 1))
+ANCESTRYDNA_CONVERT_SHARD_MIN_SIZE = int(
+    os.getenv('ANCESTRYDNA_CONVERT_SHARD_MIN_SIZE', 4 * 1024 * 1024))
+
+# Directory where processed files are kept to skip processing re-uploads,
+# unset to disable. This keeps members' processed genomes on the worker
+# disk after their uploads are deleted, so it is off by default. Least
+# recently used files are removed above the size budget in bytes.
+ANCESTRYDNA_RESULT_CACHE_DIR = (
+    os.getenv('ANCESTRYDNA_RESULT_CACHE_DIR') or None)
+ANCESTRYDNA_RESULT_CACHE_MAX_SIZE = int(
+    os.getenv('ANCESTRYDNA_RESULT_CACHE_MAX_SIZE', 1024 * 1024 * 1024))
+
+# Split processing into download, conversion and upload tasks. Conversion
+# runs on the CPU queue, download and uploads on the I/O queue. The tasks
+# pass files through the scratch directory, which has to be storage shared
+# by all workers; processing isn't split without it. The Procfile worker
+# only consumes the default queue, split processing also needs workers for
+# the other two, for example:
+#   celery -A main worker -Q cpu --concurrency=<cores>
+#   celery -A main worker -Q io --pool=threads --concurrency=8
+ANCESTRYDNA_SPLIT_TASKS = (
+    os.getenv('ANCESTRYDNA_SPLIT_TASKS', '').lower() == 'true')
+ANCESTRYDNA_SCRATCH_DIR = os.getenv('ANCESTRYDNA_SCRATCH_DIR', '')
+ANCESTRYDNA_CPU_QUEUE = os.getenv('ANCESTRYDNA_CPU_QUEUE', 'cpu')
+ANCESTRYDNA_IO_QUEUE = os.getenv('ANCESTRYDNA_IO_QUEUE', 'io')
+
+# Downloads of uploaded files are streamed to disk in chunks of this many
+# bytes. Larger downloads are rejected, timeouts are in seconds.
+ANCESTRYDNA_DOWNLOAD_CHUNK_SIZE = int(
+    os.getenv('ANCESTRYDNA_DOWNLOAD_CHUNK_SIZE', 1024 * 1024))
+ANCESTRYDNA_DOWNLOAD_MAX_SIZE = int(
+    os.getenv('ANCESTRYDNA_DOWNLOAD_MAX_SIZE', 200 * 1024 * 1024))
+ANCESTRYDNA_DOWNLOAD_CONNECT_TIMEOUT = float(
+    os.getenv('ANCESTRYDNA_DOWNLOAD_CONNECT_TIMEOUT', 10))
+ANCESTRYDNA_DOWNLOAD_READ_TIMEOUT = float(
+    os.getenv('ANCESTRYDNA_DOWNLOAD_READ_TIMEOUT', 60))
+
+# Metrics are shared between processes through this Redis, or kept per
+# process if it is empty. Queue lengths are read from the broker.
+METRICS_REDIS_URL = os.getenv('METRICS_REDIS_URL', os.getenv('REDIS_URL', ''))
+METRICS_BROKER_URL = os.getenv('REDIS_URL', 'redis://')
+METRICS_QUEUES = os.getenv(
+    'METRICS_QUEUES', ','.join(['celery', ANCESTRYDNA_CPU_QUEUE,
+                                ANCESTRYDNA_IO_QUEUE])).split(',')
+# /metrics requires "Authorization: Bearer <METRICS_TOKEN>", and is denied
+# while it is empty.
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+
 # Admin account password for configuration.
 ADMIN_PASSWORD = os.getenv('ADMIN_PASSWORD', '')
 
@@ -122,6 +244,7 @@ TEMPLATES = [
 ]
 
 WSGI_APPLICATION = 'oh_data_uploader.wsgi.application'
+ASGI_APPLICATION = 'oh_data_uploader.asgi.application'
 
 
 # Database
@@ -138,6 +261,29 @@ if ON_HEROKU:
     db_from_env = dj_database_url.config(conn_max_age=500)
     DATABASES = {'default': db_from_env}
 
+# Cache shared by all processes through Redis if CACHE_REDIS_URL (REDIS_URL
+# by default) is set, otherwise kept per process.
+CACHE_REDIS_URL = os.getenv('CACHE_REDIS_URL', os.getenv('REDIS_URL', ''))
+if CACHE_REDIS_URL:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.redis.RedisCache',
+            'LOCATION': CACHE_REDIS_URL,
+        }
+    }
+else:
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        }
+    }
+
+
+# Without a shared cache, saving the project configuration only reloads it
+# in the process that saved it. Other processes reload it after this many
+# seconds.
+PROJECT_CONFIG_CACHE_TTL = int(os.getenv('PROJECT_CONFIG_CACHE_TTL', 30))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/1.11/ref/settings/#auth-password-validators
@@ -16,11 +16,14 @@ Including another URLconf
 from django.contrib import admin
 from django.urls import include, path
 
+from main import views as main_views
+
 urlpatterns = [
     path('admin/', admin.site.urls),
 ]
 
 urlpatterns = [
+    path('metrics', main_views.metrics, name='metrics'),
     path('project-admin/', include('project_admin.urls')),
     path('', include('main.urls')),
     path('admin/', admin.site.urls),
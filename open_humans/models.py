@@ -1,11 +1,17 @@
 from datetime import timedelta
 
 import arrow
+from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.db import models
 import requests
 
+from main import async_helper
+from main.http_helper import session
+from main.metrics import OH_API_SECONDS, TOKEN_REFRESHES
+from .token_helper import TOKENS
+
 OH_BASE_URL = settings.OPENHUMANS_OH_BASE_URL
 OH_TOKEN_URL = OH_BASE_URL + '/oauth2/token/'
 OH_API_BASE = OH_BASE_URL + '/api/direct-sharing'
@@ -72,28 +78,109 @@ class OpenHumansMember(models.Model):
                          client_id=settings.OPENHUMANS_CLIENT_ID,
                          client_secret=settings.OPENHUMANS_CLIENT_SECRET):
         """
-        Return access token. Refresh first if necessary.
+        Return access token, taking newer tokens from the token cache.
+        Refresh first if it expires within OH_TOKEN_REFRESH_AHEAD seconds,
+        so callers don't get a token a refresh is about to revoke.
+        """
+        TOKENS.load(self)
+        ahead = settings.OH_TOKEN_REFRESH_AHEAD
+        if self.token_expiring(ahead):
+            self.refresh_tokens_once(client_id=client_id,
+                                     client_secret=client_secret,
+                                     ahead=ahead)
+        return self.access_token
+
+    async def aget_access_token(
+            self, client_id=settings.OPENHUMANS_CLIENT_ID,
+            client_secret=settings.OPENHUMANS_CLIENT_SECRET):
+        """
+        Return access token like get_access_token, refreshing it with the
+        asyncio client. Waiting for the lock runs on a thread of its own,
+        so it doesn't hold up the database calls of other requests.
         """
-        # Also refresh if nearly expired (less than 60s remaining).
-        delta = timedelta(seconds=60)
-        if arrow.get(self.token_expires) - delta < arrow.now():
-            self._refresh_tokens(client_id=client_id,
-                                 client_secret=client_secret)
+        await sync_to_async(TOKENS.load, thread_sensitive=False)(self)
+        ahead = settings.OH_TOKEN_REFRESH_AHEAD
+        if self.token_expiring(ahead):
+            await self.arefresh_tokens_once(client_id=client_id,
+                                            client_secret=client_secret,
+                                            ahead=ahead)
         return self.access_token
 
+    def token_expiring(self, seconds=60):
+        """
+        Whether the token expires within seconds.
+        """
+        delta = timedelta(seconds=seconds)
+        return arrow.get(self.token_expires) - delta < arrow.now()
+
+    def refresh_tokens_once(self, client_id, client_secret, ahead=60):
+        """
+        Refresh access token if it expires within ahead seconds, while
+        holding the member's refresh lock. If another process refreshed
+        while we waited, take its tokens.
+        """
+        lock = TOKENS.acquire(self.oh_id)
+        try:
+            if not self._state.adding:
+                self.refresh_from_db(fields=['access_token', 'refresh_token',
+                                             'token_expires'])
+            if self.token_expiring(ahead):
+                self._refresh_tokens(client_id=client_id,
+                                     client_secret=client_secret)
+            else:
+                TOKENS.save(self)
+        finally:
+            if lock is not None:
+                TOKENS.release(lock)
+
+    async def arefresh_tokens_once(self, client_id, client_secret, ahead=60):
+        """
+        Refresh access token like refresh_tokens_once, with the asyncio
+        client.
+        """
+        in_thread = sync_to_async(thread_sensitive=False)
+        lock = await in_thread(TOKENS.acquire)(self.oh_id)
+        try:
+            if not self._state.adding:
+                await self.arefresh_from_db(fields=['access_token',
+                                                    'refresh_token',
+                                                    'token_expires'])
+            if self.token_expiring(ahead):
+                response = await async_helper.refresh_tokens(
+                    client_id, client_secret, self.refresh_token)
+                if response.status_code == 200:
+                    self._set_tokens(response.json())
+                    await self.asave()
+                    await in_thread(TOKENS.save)(self)
+                await in_thread(TOKEN_REFRESHES.inc)(
+                    status='success' if response.status_code == 200
+                    else 'failure')
+            else:
+                await in_thread(TOKENS.save)(self)
+        finally:
+            if lock is not None:
+                await in_thread(TOKENS.release)(lock)
+
+    def _set_tokens(self, data):
+        self.access_token = data['access_token']
+        self.refresh_token = data['refresh_token']
+        self.token_expires = self.get_expiration(data['expires_in'])
+
     def _refresh_tokens(self, client_id, client_secret):
         """
         Refresh access token.
         """
-        response = requests.post(
-            OH_TOKEN_URL,
-            data={
-                'grant_type': 'refresh_token',
-                'refresh_token': self.refresh_token},
-            auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
+        with OH_API_SECONDS.time(endpoint='oauth2_token'):
+            response = session().post(
+                OH_TOKEN_URL,
+                data={
+                    'grant_type': 'refresh_token',
+                    'refresh_token': self.refresh_token},
+                auth=requests.auth.HTTPBasicAuth(client_id, client_secret))
         if response.status_code == 200:
-            data = response.json()
-            self.access_token = data['access_token']
-            self.refresh_token = data['refresh_token']
-            self.token_expires = self.get_expiration(data['expires_in'])
+            self._set_tokens(response.json())
             self.save()
+            TOKENS.save(self)
+            TOKEN_REFRESHES.inc(status='success')
+        else:
+            TOKEN_REFRESHES.inc(status='failure')
@@ -1,8 +1,12 @@
 from django.test import TestCase
 from django.core.management import call_command
 from django.conf import settings
-from open_humans.models import OpenHumansMember, make_unique_username
+from open_humans.models import (OpenHumansMember, make_unique_username,
+                                 OH_TOKEN_URL)
+from open_humans.token_helper import TokenCache
 from django.contrib.auth.models import User
+from unittest import mock
+import requests_mock
 import vcr
 
 
@@ -17,6 +21,9 @@ class OpenHumansMemberTest(TestCase):
                                                  data=data)
         self.user = User(username='user1')
         self.user.save()
+        patcher = mock.patch('open_humans.models.TOKENS', TokenCache())
+        self.tokens = patcher.start()
+        self.addCleanup(patcher.stop)
 
     def tests_str_(self):
         self.assertEqual(str(self.oh_member),
@@ -33,3 +40,38 @@ class OpenHumansMemberTest(TestCase):
         self.oh_member._refresh_tokens('client_id', 'heregoesyoursecretkey')
         assert old_access_token != self.oh_member.access_token
         self.assertEqual(self.oh_member.access_token, "anewaccesstoken")
+
+    def tests_refresh_token_once(self):
+        data = {"access_token": 'foo',
+                "refresh_token": 'bar',
+                "expires_in": 0}
+        OpenHumansMember.create(oh_id='5678', data=data).save()
+        first = OpenHumansMember.objects.get(oh_id='5678')
+        second = OpenHumansMember.objects.get(oh_id='5678')
+        third = OpenHumansMember.objects.get(oh_id='5678')
+        with requests_mock.Mocker() as m:
+            m.post(OH_TOKEN_URL, json={'access_token': 'new',
+                                       'refresh_token': 'baz',
+                                       'expires_in': 36000})
+            self.assertEqual(first.get_access_token('id', 'secret'), 'new')
+            # Cached tokens are used, and without them the saved ones.
+            self.assertEqual(second.get_access_token('id', 'secret'), 'new')
+            with mock.patch('open_humans.models.TOKENS', TokenCache()):
+                self.assertEqual(third.get_access_token('id', 'secret'),
+                                 'new')
+            self.assertEqual(m.call_count, 1)
+
+    def tests_refresh_token_ahead(self):
+        self.oh_member.token_expires = OpenHumansMember.get_expiration(120)
+        self.oh_member.save()
+        with requests_mock.Mocker() as m:
+            m.post(OH_TOKEN_URL, json={'access_token': 'new',
+                                       'refresh_token': 'baz',
+                                       'expires_in': 36000})
+            # The token would be revoked by the refresh, the new one is
+            # returned.
+            self.assertEqual(self.oh_member.get_access_token('id', 'secret'),
+                             'new')
+            self.assertEqual(self.oh_member.get_access_token('id', 'secret'),
+                             'new')
+        self.assertEqual(m.call_count, 1)
@@ -0,0 +1,158 @@
+"""
+Cache of member tokens shared by the web and worker processes.
+
+With OH_TOKEN_CACHE_REDIS_URL (REDIS_URL by default) set, tokens and the
+per-member refresh locks are kept in Redis, otherwise in the memory of
+this process. One process at a time refreshes the tokens of a member, the
+others wait for its lock and then use the new tokens, so a refresh token
+is never used twice. A failing Redis falls back to the database.
+"""
+import json
+import logging
+import threading
+
+import arrow
+from django.conf import settings
+
+try:
+    import redis
+except ImportError:
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+KEY_PREFIX = 'oh-token:'
+LOCK_PREFIX = 'oh-token-lock:'
+
+TOKEN_FIELDS = ('access_token', 'refresh_token', 'token_expires')
+
+
+class LocalStore(object):
+    """
+    Tokens and locks in dicts of this process.
+    """
+
+    def __init__(self):
+        self._tokens = dict()
+        self._locks = dict()
+        self._lock = threading.Lock()
+
+    def get(self, oh_id):
+        with self._lock:
+            return self._tokens.get(oh_id)
+
+    def set(self, oh_id, tokens, ttl):
+        with self._lock:
+            self._tokens[oh_id] = tokens
+
+    def acquire(self, oh_id, blocking, timeout):
+        with self._lock:
+            lock = self._locks.setdefault(oh_id, threading.Lock())
+        if lock.acquire(blocking, timeout if blocking else -1):
+            return lock
+        return None
+
+    def release(self, lock):
+        lock.release()
+
+
+class RedisStore(object):
+    """
+    Tokens and locks in Redis, shared by all processes. Locks expire after
+    the timeout, in case their process dies while refreshing. They may be
+    released by another thread than the one that took them, like with
+    sync_to_async.
+    """
+
+    def __init__(self, url):
+        self._redis = redis.Redis.from_url(
+            url, socket_connect_timeout=1, socket_timeout=5)
+
+    def get(self, oh_id):
+        value = self._redis.get(KEY_PREFIX + oh_id)
+        return json.loads(value) if value else None
+
+    def set(self, oh_id, tokens, ttl):
+        self._redis.set(KEY_PREFIX + oh_id, json.dumps(tokens),
+                        ex=max(int(ttl), 1))
+
+    def acquire(self, oh_id, blocking, timeout):
+        lock = self._redis.lock(LOCK_PREFIX + oh_id, timeout=timeout,
+                                thread_local=False)
+        if lock.acquire(blocking=blocking, blocking_timeout=timeout):
+            return lock
+        return None
+
+    def release(self, lock):
+        try:
+            lock.release()
+        except redis.exceptions.LockError:
+            logger.warning('Token refresh lock %s expired', lock.name)
+
+
+class TokenCache(object):
+
+    def __init__(self):
+        self._store = None
+
+    @property
+    def store(self):
+        if self._store is None:
+            url = settings.OH_TOKEN_CACHE_REDIS_URL
+            if url and redis is not None:
+                self._store = RedisStore(url)
+            else:
+                self._store = LocalStore()
+        return self._store
+
+    def load(self, member):
+        """
+        Take the cached tokens of member if they are newer than its own.
+        """
+        try:
+            tokens = self.store.get(str(member.oh_id))
+        except Exception:
+            logger.warning('Could not read cached tokens of %s', member,
+                           exc_info=True)
+            return
+        if tokens and (arrow.get(tokens['token_expires']) >
+                       arrow.get(member.token_expires)):
+            for field in TOKEN_FIELDS:
+                setattr(member, field, tokens[field])
+
+    def save(self, member):
+        """
+        Cache the tokens of member until they expire.
+        """
+        expires = arrow.get(member.token_expires)
+        tokens = {'access_token': member.access_token,
+                  'refresh_token': member.refresh_token,
+                  'token_expires': expires.isoformat()}
+        try:
+            self.store.set(str(member.oh_id), tokens,
+                           (expires - arrow.now()).total_seconds())
+        except Exception:
+            logger.warning('Could not cache tokens of %s', member,
+                           exc_info=True)
+
+    def acquire(self, oh_id):
+        """
+        Take the refresh lock of a member and return it. Returns None if
+        it wasn't released within OH_TOKEN_LOCK_TIMEOUT seconds.
+        """
+        try:
+            return self.store.acquire(str(oh_id), True,
+                                      settings.OH_TOKEN_LOCK_TIMEOUT)
+        except Exception:
+            logger.warning('Could not lock tokens of %s', oh_id,
+                           exc_info=True)
+            return None
+
+    def release(self, lock):
+        try:
+            self.store.release(lock)
+        except Exception:
+            logger.warning('Could not unlock tokens', exc_info=True)
+
+
+TOKENS = TokenCache()
@@ -0,0 +1,83 @@
+"""
+Process-level cache of the project configuration and file metadata.
+
+Values are kept in the memory of each process, under a version number
+kept in the Django cache. Saving or deleting a configuration object bumps
+the version, so every process reloads them from the database on its next
+read. With CACHE_REDIS_URL set the version is shared by all processes.
+Otherwise a save only reaches the process it happened in, so values are
+also reloaded after PROJECT_CONFIG_CACHE_TTL seconds.
+"""
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+
+VERSION_KEY = 'project-config-version'
+
+
+class ConfigCache(object):
+
+    def __init__(self):
+        self._version = None
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def version(self):
+        version = cache.get(VERSION_KEY)
+        if version is None:
+            # A new version, as values of an evicted one may be stale.
+            cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+            version = cache.get(VERSION_KEY)
+        return version
+
+    def ttl(self):
+        """
+        Seconds values are kept, None if the version is shared.
+        """
+        backend = settings.CACHES['default']['BACKEND']
+        if backend.endswith(('LocMemCache', 'DummyCache')):
+            return settings.PROJECT_CONFIG_CACHE_TTL
+        return None
+
+    def get(self, name, load):
+        """
+        Return the value cached under name, calling load to read it on a
+        miss or once it expired.
+        """
+        version = self.version()
+        ttl = self.ttl()
+        now = time.monotonic()
+        with self._lock:
+            if version != self._version:
+                self._values = dict()
+                self._version = version
+            elif name in self._values:
+                value, loaded = self._values[name]
+                if ttl is None or now - loaded < ttl:
+                    return value
+        value = load()
+        with self._lock:
+            if version == self._version:
+                self._values[name] = (value, now)
+        return value
+
+    def _bump(self):
+        try:
+            cache.incr(VERSION_KEY)
+        except ValueError:
+            cache.add(VERSION_KEY, time.time_ns(), timeout=None)
+
+    def invalidate(self):
+        """
+        Make all processes reload the configuration, now and again after
+        the current transaction commits, so no process keeps rows read
+        before the commit.
+        """
+        self._bump()
+        transaction.on_commit(self._bump)
+
+
+CONFIG = ConfigCache()
@@ -1,7 +1,11 @@
 from django.core.exceptions import ValidationError
+from django.core.serializers import serialize
 from django.db import models
+import copy
 import json
 
+from .config_helper import CONFIG
+
 
 class ProjectConfiguration(models.Model):
     """
@@ -42,10 +46,24 @@ class ProjectConfiguration(models.Model):
         return {'client_id': self.oh_client_id,
                 'client_secret': self.oh_client_secret}
 
+    @classmethod
+    def get_cached(cls):
+        """
+        Return a copy of the configuration from the configuration cache.
+        """
+        return copy.copy(CONFIG.get('config', lambda: cls.objects.get(id=1)))
+
     def save(self, *args, **kwargs):
         if ProjectConfiguration.objects.exists() and not self.pk:
             raise ValidationError('Only one ProjectConfiguration allowed')
-        return super(ProjectConfiguration, self).save(*args, **kwargs)
+        result = super(ProjectConfiguration, self).save(*args, **kwargs)
+        CONFIG.invalidate()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(ProjectConfiguration, self).delete(*args, **kwargs)
+        CONFIG.invalidate()
+        return result
 
 
 class FileMetaData(models.Model):
@@ -66,3 +84,30 @@ class FileMetaData(models.Model):
 
     def get_tags(self):
         return ','.join(json.loads(self.tags)) if self.tags else ''
+
+    @classmethod
+    def get_cached(cls):
+        """
+        Return copies of all file metadata from the configuration cache.
+        """
+        return [copy.copy(file) for file in
+                CONFIG.get('files', lambda: list(cls.objects.all()))]
+
+    @classmethod
+    def get_cached_json(cls):
+        """
+        Return all file metadata serialized to JSON, from the configuration
+        cache.
+        """
+        return CONFIG.get('files_js',
+                          lambda: serialize('json', cls.get_cached()))
+
+    def save(self, *args, **kwargs):
+        result = super(FileMetaData, self).save(*args, **kwargs)
+        CONFIG.invalidate()
+        return result
+
+    def delete(self, *args, **kwargs):
+        result = super(FileMetaData, self).delete(*args, **kwargs)
+        CONFIG.invalidate()
+        return result
@@ -1,7 +1,11 @@
 from django.test import TestCase, Client
 from django.core.management import call_command
 from django.conf import settings
-from project_admin.models import FileMetaData
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from project_admin.models import FileMetaData, ProjectConfiguration
+from unittest import mock
+import time
 
 
 class AdminLoginTestCase(TestCase):
@@ -321,3 +325,41 @@ class AdminLoginTestCase(TestCase):
         self.assertEqual(FileMetaData.objects.all().count(), 0)
         self.assertRedirects(response,
                              '/project-admin/config-file-settings')
+
+    def test_config_cache(self):
+        """
+        Test that warm pages read no configuration and saving reloads it.
+        """
+        c = Client()
+        c.get('/')
+        with CaptureQueriesContext(connection) as queries:
+            response = c.get('/')
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries.captured_queries
+                          if 'project_admin_' in q['sql']])
+        c.post("/project-admin/login/", {'password': 'test1234'})
+        c.post("/project-admin/config-homepage-text/",
+               {'faq': 'foo',
+                'about': 'bar',
+                'overview': 'foo-bar',
+                'homepage_text': 'cached homepage',
+                'upload_description': 'foo_bar'})
+        response = Client().get('/')
+        self.assertIn(b'cached homepage', response.content)
+
+    def test_config_cache_ttl(self):
+        """
+        Test that a save in another process is read after the TTL when
+        the cache isn't shared.
+        """
+        Client().get('/')
+        # An update that doesn't invalidate this process' cache.
+        ProjectConfiguration.objects.filter(id=1).update(
+            homepage_text='saved elsewhere')
+        response = Client().get('/')
+        self.assertNotIn(b'saved elsewhere', response.content)
+        later = mock.Mock(return_value=time.monotonic() +
+                          settings.PROJECT_CONFIG_CACHE_TTL)
+        with mock.patch('project_admin.config_helper.time.monotonic', later):
+            response = Client().get('/')
+        self.assertIn(b'saved elsewhere', response.content)
@@ -2,6 +2,7 @@ from django.conf import settings
 from django.contrib.auth import get_user_model, login
 from django.shortcuts import redirect, render
 
+from main.markdown_helper import prerender_markdown
 from .models import ProjectConfiguration, FileMetaData
 import json
 
@@ -114,6 +115,9 @@ def config_homepage_text(request):
         project_config.overview = request.POST['overview']
         project_config.upload_description = request.POST['upload_description']
         project_config.save()
+        prerender_markdown(project_config.homepage_text, project_config.about,
+                           project_config.faq, project_config.overview,
+                           project_config.upload_description)
         return redirect('project-admin:home')
 
     return render(request, 'project_admin/config-homepage-text.html')